@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# AccurateRip and CRC32 checksums of the audio tracks of a rip, so there is
+# a record of whether the PCM was read right after it has gone into lossy
+# mp3's.
+#
+# A track is 44.1 kHz 16 bit stereo, so each sample is one little endian
+# 32 bit word, left in the low half. AccurateRip v1 is the sum of each
+# word times its position in the track (from 1), mod 2^32. v2 takes the
+# same 64 bit products and adds both halves of each. Samples are handled
+# as NumPy uint32 arrays, a chunk at a time, as they stream past.
+#
+# The first 5 sectors of the first track on the disc, less one sample,
+# and the last 5 sectors of the last, are left out of both, as drives
+# with different read offsets can't all read them. The CRC32 is of the
+# whole track, as EAC has it.
+#
+# extract_audio.py works these out as it encodes, from the BIN or from
+# cdparanoia, and they are kept in the manifest.
+#
+# Usage:
+#   accuraterip.py game_ns.toc|game.cue
+#   accuraterip.py --benchmark [megabytes]
+
+import sys, os
+import time
+import zlib
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+HAVE_NUMPY = np is not None
+
+from toc_file import SAMPLES_PER_SECTOR, parse_disc
+from hashing import manifest_name, update_manifest
+
+SKIP_FIRST = 5 * SAMPLES_PER_SECTOR - 1
+SKIP_LAST = 5 * SAMPLES_PER_SECTOR
+SAMPLE_SIZE = 4
+MASK = 0xFFFFFFFF
+
+
+def _need_numpy():
+	if np is None:
+		raise Exception("AccurateRip checksums need the numpy module")
+
+
+# The checksums of one track, fed its little endian PCM in chunks of any
+# size. samples is how long the track is, which the last track needs to
+# know where to stop.
+class TrackChecksum(object):
+	def __init__(self, samples, first = False, last = False):
+		_need_numpy()
+		self.samples = samples
+		self.check_from = SKIP_FIRST if first else 0
+		self.check_to = samples - SKIP_LAST if last else samples
+		self.pos = 0
+		self._crc = 0
+		self._v1 = 0
+		self._high = 0
+		self._rest = b''
+
+	def update(self, data):
+		self._crc = zlib.crc32(data, self._crc)
+		if self._rest:
+			data = self._rest + bytes(data)
+		count = len(data) // SAMPLE_SIZE
+		self._rest = bytes(data[count * SAMPLE_SIZE : ])
+
+		lo = max(self.check_from - self.pos, 0)
+		hi = min(self.check_to - self.pos, count)
+		if lo < hi:
+			words = np.frombuffer(data, '<u4', count)[lo : hi].astype(np.uint64)
+			words *= np.arange(self.pos + lo + 1, self.pos + hi + 1, dtype = np.uint64)
+			# The low halves add up to the sum mod 2^32, overflow or not
+			self._v1 = (self._v1 + int(words.sum())) & MASK
+			words >>= 32
+			self._high = (self._high + int(words.sum())) & MASK
+		self.pos += count
+
+	def digests(self):
+		return {
+			'samples' : self.pos,
+			'crc32' : '{0:08x}'.format(self._crc & MASK),
+			'accuraterip_v1' : '{0:08x}'.format(self._v1),
+			'accuraterip_v2' : '{0:08x}'.format((self._v1 + self._high) & MASK),
+		}
+
+
+# A TrackChecksum for an audio track of a disc
+def track_checksum(disc, track):
+	start, end = disc.play_range(track)
+	return TrackChecksum((end - start) * SAMPLES_PER_SECTOR, track is disc.tracks[0], track is disc.tracks[-1])
+
+
+# Pass a WAV stream through, checksumming the PCM after the header.
+# Yields the stream unchanged.
+def checksum_stream(stream, checksum, header_size):
+	skip = header_size
+	for chunk in stream:
+		if skip:
+			checksum.update(chunk[skip : ])
+			skip = max(skip - len(chunk), 0)
+		else:
+			checksum.update(chunk)
+		yield chunk
+
+
+def format_checksums(results):
+	return ["Track {0:02d}: CRC32 {1}, AccurateRip v1 {2}, v2 {3}".format(
+		result['number'], result['crc32'], result['accuraterip_v1'], result['accuraterip_v2']) for result in results]
+
+
+def store_checksums(disc_name, results):
+	update_manifest(manifest_name(disc_name), audio = results)
+
+
+# The checksums of every audio track of a rip, from its BIN
+def disc_checksums(disc_name):
+	from extract_audio import BinFiles, iter_pcm
+	disc = parse_disc(disc_name)
+	bin_files = BinFiles()
+	results = []
+	try:
+		for track in disc.audio_tracks:
+			checksum = track_checksum(disc, track)
+			for chunk in iter_pcm(disc, *disc.play_range(track), bin_files = bin_files):
+				checksum.update(chunk)
+			results.append(dict(number = track.number, **checksum.digests()))
+	finally:
+		bin_files.close()
+	return results
+
+
+def benchmark(megabytes = 64):
+	_need_numpy()
+	sectors = megabytes * 1024 * 1024 // (SAMPLES_PER_SECTOR * SAMPLE_SIZE)
+	data = os.urandom(sectors * SAMPLES_PER_SECTOR * SAMPLE_SIZE)
+
+	start = time.time()
+	checksum = TrackChecksum(len(data) // SAMPLE_SIZE, True, True)
+	view = memoryview(data)
+	for i in range(0, len(data), 1024 * 1024):
+		checksum.update(view[i : i + 1024 * 1024])
+	elapsed = time.time() - start
+
+	size = len(data) / 1048576.0
+	print("{0} sectors ({1:.1f} MB) in {2:.2f} s, {3:.1f} MB/s".format(sectors, size, elapsed, size / elapsed))
+
+
+def main(args):
+	if args and args[0] == '--benchmark':
+		benchmark(*[int(a) for a in args[1 : ]])
+		return 0
+
+	if len(args) != 1:
+		print("usage: accuraterip.py game.toc|game.cue | --benchmark [megabytes]")
+		return 1
+
+	results = disc_checksums(args[0])
+	for line in format_checksums(results):
+		print(line)
+	store_checksums(args[0], results)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
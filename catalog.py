@@ -0,0 +1,303 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# An index of everything in the library, so finding a serial, a title or
+# the discs that were ripped twice doesn't mean walking the tree and
+# identifying every image again.
+#
+# The catalog is RIP_PATH/.ps_ripper/catalog.db, with the path, size,
+# mtime, fingerprint, serial, region, title and hashes of each image: the
+# isos (or csos) in PLAYSTATION_2, and the _ns.toc of each CD rip. A scan
+# stats every image and only identifies those that are new or whose size
+# or mtime changed, on a pool of threads. Hashes come from the manifests
+# when they are there (see hashing.py).
+#
+# Usage:
+#   catalog.py scan rip_path [workers]
+#   catalog.py find rip_path serial|title|region value
+#   catalog.py duplicates rip_path
+#   catalog.py unidentified rip_path
+
+import sys, os
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from toc_file import get_data_files, resolve_data_file
+from redump import find_images, file_digests, DISC_EXTS
+from hashing import manifest_name, read_manifest
+from fingerprint import fingerprint_image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'identify_playstation2_games'))
+
+CATALOG_NAME = 'catalog.db'
+SCAN_WORKERS = 4
+COMMIT_EVERY = 64
+
+COLUMNS = ['path', 'kind', 'size', 'mtime', 'fingerprint', 'serial', 'region', 'title',
+	'disc_type', 'crc32', 'md5', 'sha1', 'redump', 'error', 'scanned']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+	path TEXT PRIMARY KEY,
+	kind TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	mtime REAL NOT NULL,
+	fingerprint TEXT,
+	serial TEXT COLLATE NOCASE,
+	region TEXT COLLATE NOCASE,
+	title TEXT COLLATE NOCASE,
+	disc_type TEXT,
+	crc32 TEXT,
+	md5 TEXT,
+	sha1 TEXT,
+	redump TEXT,
+	error TEXT,
+	scanned REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_serial ON images (serial);
+CREATE INDEX IF NOT EXISTS images_title ON images (title);
+CREATE INDEX IF NOT EXISTS images_region ON images (region);
+CREATE INDEX IF NOT EXISTS images_fingerprint ON images (fingerprint);
+'''
+
+SEARCH_COLUMNS = ['serial', 'title', 'region']
+
+
+class Catalog(object):
+	def __init__(self, db_name):
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(db_name, timeout = 30, check_same_thread = False, isolation_level = None)
+		self._db.row_factory = sqlite3.Row
+		self._db.executescript(SCHEMA)
+
+	def close(self):
+		self._db.close()
+
+	# {path : (size, mtime)} of everything under rip_path
+	def stats(self, rip_path):
+		prefix = os.path.join(os.path.abspath(rip_path), '')
+		with self._lock:
+			rows = self._db.execute("SELECT path, size, mtime FROM images WHERE substr(path, 1, ?) = ?",
+				(len(prefix), prefix)).fetchall()
+		return dict([(row['path'], (row['size'], row['mtime'])) for row in rows])
+
+	# Add or replace records, in one transaction
+	def update(self, records):
+		sql = "INSERT OR REPLACE INTO images ({0}) VALUES ({1})".format(', '.join(COLUMNS), ', '.join(['?'] * len(COLUMNS)))
+		with self._lock:
+			self._db.execute("BEGIN")
+			try:
+				for record in records:
+					self._db.execute(sql, [record.get(column) for column in COLUMNS])
+				self._db.execute("COMMIT")
+			except:
+				self._db.execute("ROLLBACK")
+				raise
+
+	def remove(self, paths):
+		with self._lock:
+			self._db.execute("BEGIN")
+			self._db.executemany("DELETE FROM images WHERE path = ?", [(path, ) for path in paths])
+			self._db.execute("COMMIT")
+
+	# Images by serial, region or the start of their title
+	def find(self, column, value):
+		if column not in SEARCH_COLUMNS:
+			raise Exception("Can't search by {0}".format(column))
+		if column == 'title':
+			where, value = "title LIKE ?", value.replace('%', '') + '%'
+		else:
+			where = "{0} = ?".format(column)
+		with self._lock:
+			return self._db.execute("SELECT * FROM images WHERE " + where + " ORDER BY title, path", (value, )).fetchall()
+
+	# Discs that are in the library more than once, as lists of images
+	def duplicates(self):
+		with self._lock:
+			rows = self._db.execute('''SELECT * FROM images WHERE fingerprint IN
+				(SELECT fingerprint FROM images WHERE fingerprint IS NOT NULL GROUP BY fingerprint HAVING count(*) > 1)
+				ORDER BY fingerprint, path''').fetchall()
+		groups = []
+		for row in rows:
+			if groups and groups[-1][0]['fingerprint'] == row['fingerprint']:
+				groups[-1].append(row)
+			else:
+				groups.append([row])
+		return groups
+
+	# Images that no serial was found for, like DVDs named by their UUID
+	def unidentified(self):
+		with self._lock:
+			return self._db.execute("SELECT * FROM images WHERE serial IS NULL ORDER BY path").fetchall()
+
+
+def open_catalog(rip_path):
+	state_dir = os.path.join(rip_path, '.ps_ripper')
+	if not os.path.isdir(state_dir):
+		os.makedirs(state_dir)
+	return Catalog(os.path.join(state_dir, CATALOG_NAME))
+
+
+# The image and the data files it refers to. A CD's toc hardly changes,
+# its BIN is what has to be checked.
+def _image_files(image_name):
+	if os.path.splitext(image_name)[1].lower() not in DISC_EXTS:
+		return [image_name]
+	with open(image_name, 'r') as f:
+		data_files = get_data_files(f.read())
+	return [image_name] + [resolve_data_file(image_name, data_file) for data_file in data_files]
+
+
+# (size, mtime) of an image and its data files together
+def image_stat(image_name):
+	size, mtime = 0, 0
+	for file_name in _image_files(image_name):
+		st = os.stat(file_name)
+		size += st.st_size
+		mtime = max(mtime, st.st_mtime)
+	return size, mtime
+
+
+def _get_identify():
+	try:
+		from identify_playstation2_games import get_playstation2_game_info
+	except Exception as e:
+		print("Can't identify games: {0}".format(e))
+		return None
+	return get_playstation2_game_info
+
+
+def _text(value):
+	if isinstance(value, bytes):
+		return value.decode('utf-8', 'replace')
+	return value
+
+
+# Everything the catalog keeps about one image
+def scan_image(image_name, identify = None):
+	files = _image_files(image_name)
+	is_cd = len(files) > 1
+	size, mtime = image_stat(image_name)
+	record = {
+		'path' : os.path.abspath(image_name),
+		'kind' : 'cd' if is_cd else 'dvd',
+		'size' : size,
+		'mtime' : mtime,
+		'scanned' : time.time(),
+	}
+	errors = []
+
+	try:
+		record['fingerprint'] = fingerprint_image(image_name)
+	except Exception as e:
+		errors.append("fingerprint: {0}".format(e))
+
+	# A CD is identified by its data, the identifier doesn't read tocs
+	if identify:
+		try:
+			info = identify(files[1] if is_cd else image_name)
+			for key in ['serial_number', 'region', 'title', 'disc_type']:
+				record[key.replace('serial_number', 'serial')] = _text(info.get(key))
+		except Exception as e:
+			errors.append("identify: {0}".format(e))
+
+	try:
+		digests = file_digests(files[1] if is_cd else image_name)
+		for key in ['crc32', 'md5', 'sha1']:
+			record[key] = digests.get(key)
+	except Exception as e:
+		errors.append("hash: {0}".format(e))
+
+	redump = read_manifest(manifest_name(image_name)).get('redump')
+	if redump:
+		record['redump'] = redump.get('status')
+		record['title'] = record.get('title') or redump.get('title')
+
+	record['error'] = '; '.join(errors) or None
+	return record
+
+
+# Bring the catalog up to date with what is under rip_path. Returns the
+# counts of images that were added, changed, removed and unchanged.
+def scan(catalog, rip_path, workers = SCAN_WORKERS, identify = None):
+	known = catalog.stats(rip_path)
+	seen = set()
+	todo = []
+	counts = {'added' : 0, 'changed' : 0, 'removed' : 0, 'unchanged' : 0}
+	for image_name in find_images(rip_path):
+		path = os.path.abspath(image_name)
+		seen.add(path)
+		try:
+			stat = image_stat(image_name)
+		except (IOError, OSError) as e:
+			print("{0}: {1}".format(image_name, e))
+			continue
+		if path not in known:
+			counts['added'] += 1
+		elif tuple(known[path]) != stat:
+			counts['changed'] += 1
+		else:
+			counts['unchanged'] += 1
+			continue
+		todo.append(image_name)
+
+	gone = [path for path in known if path not in seen]
+	if gone:
+		catalog.remove(gone)
+		counts['removed'] = len(gone)
+
+	# The identifier loads its databases on import, which has to be done
+	# before the threads start
+	if todo and identify is None:
+		identify = _get_identify()
+
+	records = []
+	with ThreadPoolExecutor(max_workers = workers) as executor:
+		futures = [executor.submit(scan_image, image_name, identify) for image_name in todo]
+		for future in as_completed(futures):
+			record = future.result()
+			print("{0}: {1} {2}".format(record['path'], record.get('serial') or '-', record.get('title') or ''))
+			records.append(record)
+			if len(records) >= COMMIT_EVERY:
+				catalog.update(records)
+				records = []
+	if records:
+		catalog.update(records)
+	return counts
+
+
+def _print_rows(rows):
+	for row in rows:
+		print("{0}\t{1}\t{2}\t{3}".format(row['serial'] or '-', row['region'] or '-', row['title'] or '-', row['path']))
+
+
+def main(args):
+	if len(args) in [2, 3] and args[0] == 'scan':
+		catalog = open_catalog(args[1])
+		start = time.time()
+		counts = scan(catalog, args[1], *[int(a) for a in args[2 : ]])
+		print("{0} added, {1} changed, {2} removed, {3} unchanged in {4:.1f} s".format(
+			counts['added'], counts['changed'], counts['removed'], counts['unchanged'], time.time() - start))
+	elif len(args) == 4 and args[0] == 'find':
+		catalog = open_catalog(args[1])
+		_print_rows(catalog.find(args[2], args[3]))
+	elif len(args) == 2 and args[0] == 'duplicates':
+		catalog = open_catalog(args[1])
+		for group in catalog.duplicates():
+			_print_rows(group)
+			print('')
+	elif len(args) == 2 and args[0] == 'unidentified':
+		catalog = open_catalog(args[1])
+		_print_rows(catalog.unidentified())
+	else:
+		print("usage: catalog.py scan rip_path [workers] | find rip_path serial|title|region value | duplicates rip_path | unidentified rip_path")
+		return 1
+
+	catalog.close()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
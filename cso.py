@@ -0,0 +1,295 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Writes block compressed images, CSO (deflate) or ZSO (lz4), which PCSX2
+# and most other emulators read in place of an .iso.
+#
+# The file is a 24 byte header, an index with the offset of every block,
+# then the blocks. Blocks are compressed a batch at a time on a thread pool
+# (zlib and lz4 let go of the GIL while they work) and written out in
+# order. PS2 DVDs are mostly padding, so all zero blocks skip the
+# compressor and get a copy of one compressed zero block.
+#
+# CsoWriter is a file object, so the image can be written as it comes off
+# the drive instead of being compressed from a finished .iso.
+#
+# Usage:
+#   cso.py [--zso] [--workers N] image.iso image.cso
+#   cso.py --benchmark [megabytes]
+
+import sys, os
+import time
+import zlib
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+	import lz4.block as lz4_block
+except ImportError:
+	lz4_block = None
+
+BLOCK_SIZE = 2048
+BATCH_BLOCKS = 512
+HEADER_SIZE = 0x18
+HEADER = '<4sIQIBB2x'
+PLAIN_BLOCK = 0x80000000
+DEFLATE_LEVEL = 9
+READ_SIZE = 1024 * 1024 * 4
+
+MAGIC = {'cso' : b'CISO', 'zso' : b'ZISO'}
+
+
+def _compressor(fmt, level):
+	if fmt == 'zso':
+		if not lz4_block:
+			raise Exception("ZSO needs the lz4 module")
+		return lambda block: lz4_block.compress(block, mode = 'high_compression', store_size = False)
+
+	# Raw deflate, no zlib header
+	def deflate(block):
+		c = zlib.compressobj(level, zlib.DEFLATED, -15)
+		return c.compress(block) + c.flush()
+	return deflate
+
+
+# Compress a batch of blocks. Returns a list of (data, is plain). Blocks
+# that don't get any smaller are stored as they are.
+def _compress_batch(batch, block_size, compress, zero_block, zero_data):
+	retval = []
+	view = memoryview(batch)
+	for i in range(0, len(batch), block_size):
+		# startswith is a memcmp, comparing memoryviews goes byte by byte
+		if batch.startswith(zero_block, i):
+			retval.append((zero_data, False))
+			continue
+		block = view[i : i + block_size]
+		data = compress(block)
+		if len(data) >= len(block):
+			retval.append((bytes(block), True))
+		else:
+			retval.append((data, False))
+	return retval
+
+
+class CsoWriter(object):
+	# total_size has to be known up front, as the index comes before the
+	# blocks. f has to be seekable, the index is filled in on close().
+	def __init__(self, f, total_size, fmt = 'cso', block_size = BLOCK_SIZE, workers = None, executor = None, level = DEFLATE_LEVEL):
+		if fmt not in MAGIC:
+			raise Exception("Unknown format {0}".format(fmt))
+		self.f = f
+		self.total_size = total_size
+		self.block_size = block_size
+		self.blocks = (total_size + block_size - 1) // block_size
+		self.written = 0
+
+		self._compress = _compressor(fmt, level)
+		self._zero_block = bytes(block_size)
+		self._zero_data = self._compress(self._zero_block)
+
+		# Offsets in the index are stored shifted right by align, so images
+		# over 2 GB need their blocks aligned
+		index_size = (self.blocks + 1) * 4
+		self.align = 0
+		while (HEADER_SIZE + index_size + self.blocks * (block_size + (1 << self.align))) >> self.align >= PLAIN_BLOCK:
+			self.align += 1
+
+		self._own_executor = executor is None
+		self.workers = workers or os.cpu_count() or 1
+		self._executor = executor or ThreadPoolExecutor(max_workers = self.workers)
+		self._pending = bytearray()
+		self._futures = collections.deque()
+		self._index = []
+		self._pos = HEADER_SIZE + index_size
+		self.stored = 0
+		self.zero_blocks = 0
+
+		f.write(struct.pack(HEADER, MAGIC[fmt], HEADER_SIZE, total_size, block_size, 1, self.align))
+		f.write(bytes(index_size))
+
+	def _submit(self, batch):
+		self._futures.append(self._executor.submit(_compress_batch, batch, self.block_size,
+			self._compress, self._zero_block, self._zero_data))
+		# Keep a couple of batches per worker in flight, and write the
+		# oldest as soon as there are too many
+		while len(self._futures) > self.workers * 2:
+			self._write_blocks(self._futures.popleft().result())
+
+	def _write_blocks(self, blocks):
+		for data, plain in blocks:
+			padding = -self._pos % (1 << self.align)
+			if padding:
+				self.f.write(bytes(padding))
+				self._pos += padding
+			self._index.append((self._pos >> self.align) | (PLAIN_BLOCK if plain else 0))
+			self.f.write(data)
+			self._pos += len(data)
+			self.stored += len(data)
+			if data is self._zero_data:
+				self.zero_blocks += 1
+
+	def write(self, data):
+		self.written += len(data)
+		if self.written > self.total_size:
+			raise Exception("Wrote {0} bytes to a {1} byte image".format(self.written, self.total_size))
+		self._pending += data
+		batch_size = self.block_size * BATCH_BLOCKS
+		if len(self._pending) >= batch_size:
+			whole = len(self._pending) - len(self._pending) % batch_size
+			for i in range(0, whole, batch_size):
+				self._submit(bytes(self._pending[i : i + batch_size]))
+			del self._pending[ : whole]
+		return len(data)
+
+	def close(self):
+		if self.written != self.total_size:
+			raise Exception("Image is {0} bytes, expected {1}".format(self.written, self.total_size))
+		if self._pending:
+			# Readers expect whole blocks, the header says where the image ends
+			self._pending += bytes(-len(self._pending) % self.block_size)
+			self._submit(bytes(self._pending))
+			self._pending = bytearray()
+		while self._futures:
+			self._write_blocks(self._futures.popleft().result())
+		if self._own_executor:
+			self._executor.shutdown()
+
+		# The last entry marks where the last block ends
+		self._index.append(self._pos >> self.align)
+		self.f.seek(HEADER_SIZE)
+		self.f.write(struct.pack('<{0}I'.format(len(self._index)), *self._index))
+		self.f.seek(0, os.SEEK_END)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		if type is None:
+			self.close()
+		elif self._own_executor:
+			self._executor.shutdown()
+
+
+# A compressed copy of an image that is being written somewhere else, like
+# a rip coming off the drive. open() is called once the size is known. The
+# file only gets its real name once it is complete.
+class CsoOutput(object):
+	def __init__(self, file_name, fmt = 'cso', executor = None):
+		self.file_name = file_name
+		self.fmt = fmt
+		self.executor = executor
+		self.done = False
+		self._f = None
+
+	def open(self, total_size):
+		self._f = open(self.file_name + '.part', 'wb')
+		self._writer = CsoWriter(self._f, total_size, self.fmt, executor = self.executor)
+
+	def write(self, data):
+		return self._writer.write(data)
+
+	def close(self):
+		self._writer.close()
+		self._f.close()
+		os.rename(self.file_name + '.part', self.file_name)
+		self.done = True
+
+	# Drop what has been written, when the rip didn't come through in one go
+	def abandon(self):
+		if self._f:
+			self._f.close()
+			os.remove(self.file_name + '.part')
+			self._f = None
+
+
+def output_name(image_name, fmt):
+	return os.path.splitext(image_name)[0] + '.' + fmt
+
+
+# Compress a finished image. Returns (size in, size out).
+def compress_image(src_name, dst_name, fmt = 'cso', workers = None, executor = None):
+	tmp_name = dst_name + '.part'
+	size = os.path.getsize(src_name)
+	with open(src_name, 'rb') as src, open(tmp_name, 'wb') as dst:
+		with CsoWriter(dst, size, fmt, workers = workers, executor = executor) as writer:
+			while True:
+				chunk = src.read(READ_SIZE)
+				if not chunk:
+					break
+				writer.write(chunk)
+	os.rename(tmp_name, dst_name)
+	return size, os.path.getsize(dst_name)
+
+
+# Something like a PS2 DVD: half padding, the rest a mix of data that
+# compresses well and data that doesn't
+def _benchmark_data(megabytes):
+	chunk = bytearray()
+	text = b''.join([b'SLUS_200.00;1 SYSTEM.CNF BOOT2 = cdrom0:\\' + str(i).encode('ascii') for i in range(2048)])
+	noise = os.urandom(1024 * 1024)
+	while len(chunk) < 4 * 1024 * 1024:
+		chunk += bytes(1024 * 1024 * 2) + text[ : 1024 * 1024] + noise
+	chunk = bytes(chunk[ : 4 * 1024 * 1024])
+	return chunk, megabytes * 1024 * 1024 // len(chunk)
+
+
+def benchmark(megabytes = 256):
+	chunk, count = _benchmark_data(megabytes)
+	size = len(chunk) * count
+	cpus = os.cpu_count() or 1
+	workers = sorted(set([1, 2, 4, cpus, cpus * 2]))
+
+	print("{0:.0f} MB image, {1} CPUs".format(size / 1048576.0, cpus))
+	for n in workers:
+		out = _NullFile()
+		start = time.time()
+		with CsoWriter(out, size, workers = n) as writer:
+			for i in range(count):
+				writer.write(chunk)
+		elapsed = time.time() - start
+		print("{0:2d} workers: {1:.2f} s, {2:.1f} MB/s, {3:.1f}% of original, {4} zero blocks".format(
+			n, elapsed, size / 1048576.0 / elapsed, out.size * 100.0 / size, writer.zero_blocks))
+
+
+# Counts what is written, for the benchmark
+class _NullFile(object):
+	def __init__(self):
+		self.size = 0
+		self.pos = 0
+
+	def write(self, data):
+		self.pos += len(data)
+		self.size = max(self.size, self.pos)
+
+	def seek(self, pos, whence = 0):
+		self.pos = pos if whence == 0 else self.size
+
+
+def main(args):
+	if args and args[0] == '--benchmark':
+		benchmark(*[int(a) for a in args[1 : ]])
+		return 0
+
+	fmt, workers = 'cso', None
+	while args and args[0] in ['--zso', '--workers']:
+		if args[0] == '--zso':
+			fmt = 'zso'
+			args = args[1 : ]
+		else:
+			workers = int(args[1])
+			args = args[2 : ]
+
+	if len(args) != 2:
+		print("usage: cso.py [--zso] [--workers N] image.iso image.cso | --benchmark [megabytes]")
+		return 1
+
+	start = time.time()
+	size_in, size_out = compress_image(args[0], args[1], fmt, workers)
+	print("{0}: {1:.1f} MB to {2:.1f} MB ({3:.1f}%) in {4:.1f} s".format(
+		args[1], size_in / 1048576.0, size_out / 1048576.0, size_out * 100.0 / max(size_in, 1), time.time() - start))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
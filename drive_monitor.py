@@ -0,0 +1,347 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Waits for discs to show up in an optical drive and hands their udev
+# properties to the rip scripts.
+#
+# Media changes are picked up from the udev netlink socket, so a rip can
+# start as soon as the disc is readable instead of on the next 15 second
+# poll.  If the socket can not be opened it falls back to polling udevadm.
+#
+# Usage from bash:
+#   eval "$(./drive_monitor.py --wait /dev/sr0)"
+#   echo ${DISC[ID_FS_LABEL]}
+#   ./drive_monitor.py --eject /dev/sr0
+
+import sys, os
+import re
+import time
+import fcntl
+import select
+import socket
+import struct
+import threading
+import subprocess
+
+NETLINK_KOBJECT_UEVENT = 15
+UDEV_MONITOR_GROUP = 2
+UDEV_MONITOR_MAGIC = 0xfeedcafe
+# Only the magic is big endian, libudev writes the rest in host byte order
+UDEV_HEADER = struct.Struct('=8s4sIII')
+UDEV_MAGIC = struct.Struct('>I')
+
+POLL_INTERVAL = 15
+READABLE_INTERVAL = 0.5
+STOP_INTERVAL = 1
+PROBE_SECTOR = 16
+PROBE_SIZE = 2048
+CDROM_DRIVE_STATUS = 0x5326
+CDSL_CURRENT = 0x7fffffff
+CDS_DISC_OK = 4
+
+SHELL_KEY = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+# Turn the output of "udevadm info --query=property" into a dict
+def parse_properties(text):
+	properties = {}
+	for line in text.splitlines():
+		key, sep, value = line.partition('=')
+		if sep and key:
+			properties[key] = value
+	return properties
+
+
+def query_properties(drive):
+	output = subprocess.check_output(['udevadm', 'info', '--query=property', drive])
+	return parse_properties(output.decode('utf-8', 'replace'))
+
+
+def has_media(properties):
+	return properties.get('ID_CDROM_MEDIA') == '1'
+
+
+# A CD with audio tracks and no data track, by the properties cdrom_id
+# gives it
+def is_audio_only(properties):
+	return bool(properties.get('ID_CDROM_MEDIA_TRACK_COUNT_AUDIO')) and not properties.get('ID_CDROM_MEDIA_TRACK_COUNT_DATA')
+
+
+# The drive reports media long before it can actually read it, so try to
+# read a sector instead of trusting udev. A pure audio CD has no sector to
+# read that way, so for one the drive is asked if the disc is ready.
+def is_readable(drive, audio_only = False):
+	try:
+		fd = os.open(drive, os.O_RDONLY | os.O_NONBLOCK)
+	except OSError:
+		return False
+
+	try:
+		if audio_only:
+			return fcntl.ioctl(fd, CDROM_DRIVE_STATUS, CDSL_CURRENT) == CDS_DISC_OK
+		return len(os.pread(fd, PROBE_SIZE, PROBE_SECTOR * PROBE_SIZE)) == PROBE_SIZE
+	except (IOError, OSError):
+		return False
+	finally:
+		os.close(fd)
+
+
+# Parse a message from the udev netlink group into a dict of properties
+def parse_udev_message(message):
+	if len(message) < UDEV_HEADER.size:
+		return None
+
+	prefix, magic, header_size, properties_off, properties_len = UDEV_HEADER.unpack_from(message)
+	if prefix != b'libudev\0' or UDEV_MAGIC.unpack(magic)[0] != UDEV_MONITOR_MAGIC:
+		return None
+
+	raw = message[properties_off : properties_off + properties_len]
+	properties = {}
+	for entry in raw.split(b'\0'):
+		key, sep, value = entry.partition(b'=')
+		if sep:
+			properties[key.decode('utf-8', 'replace')] = value.decode('utf-8', 'replace')
+	return properties
+
+
+class DriveState(object): # enum
+	empty = 'empty'
+	spinning_up = 'spinning_up'
+	ready = 'ready'
+	ejecting = 'ejecting'
+
+
+# Watches a real drive through the udev netlink socket
+class UdevBackend(object):
+	def __init__(self, drive):
+		self.drive = drive
+		self.devname = os.path.realpath(drive)
+		self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_KOBJECT_UEVENT)
+		self._sock.bind((0, UDEV_MONITOR_GROUP))
+
+	def properties(self):
+		return query_properties(self.drive)
+
+	# Block until the next event for this drive, or until the timeout runs out.
+	# Returns the properties from the event, or None on timeout.
+	def wait_event(self, timeout):
+		deadline = time.time() + timeout
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return None
+
+			readable, _, _ = select.select([self._sock], [], [], remaining)
+			if not readable:
+				return None
+
+			event = parse_udev_message(self._sock.recv(16384))
+			if event and event.get('DEVNAME') == self.devname:
+				return event
+
+	# properties are the disc's, as last seen by the monitor
+	def readable(self, properties = None):
+		return is_readable(self.drive, is_audio_only(properties or {}))
+
+	def eject(self):
+		subprocess.call(['eject', self.drive])
+
+	def close(self):
+		self._sock.close()
+
+
+# Used when the netlink socket is not available, eg in a container
+class PollingBackend(UdevBackend):
+	def __init__(self, drive, interval = POLL_INTERVAL):
+		self.drive = drive
+		self.devname = os.path.realpath(drive)
+		self.interval = interval
+
+	def wait_event(self, timeout):
+		time.sleep(min(timeout, self.interval))
+		return None
+
+	def close(self):
+		pass
+
+
+# A drive with no hardware behind it. Tests and the scheduler's fake drives
+# insert and remove discs from another thread and the monitor reacts to it
+# exactly like it would to udev events.
+class SimulatedDrive(object):
+	def __init__(self, drive = '/dev/sim0', spin_up_checks = 0):
+		self.drive = drive
+		self.devname = drive
+		self.spin_up_checks = spin_up_checks
+		self.ejects = 0
+		self.image = None
+		self._properties = {'DEVNAME' : drive}
+		self._checks_left = 0
+		self._events = []
+		self._cond = threading.Condition()
+
+	def insert(self, properties, image = None):
+		with self._cond:
+			self._properties = dict(properties)
+			self._properties['DEVNAME'] = self.drive
+			self._properties['ID_CDROM_MEDIA'] = '1'
+			self._checks_left = self.spin_up_checks
+			self.image = image
+			self._events.append(dict(self._properties))
+			self._cond.notify_all()
+
+	def remove(self):
+		with self._cond:
+			self._properties = {'DEVNAME' : self.drive}
+			self.image = None
+			self._events.append(dict(self._properties))
+			self._cond.notify_all()
+
+	def properties(self):
+		with self._cond:
+			return dict(self._properties)
+
+	def wait_event(self, timeout):
+		with self._cond:
+			if not self._events:
+				self._cond.wait(timeout)
+			if self._events:
+				return self._events.pop(0)
+			return None
+
+	def readable(self, properties = None):
+		with self._cond:
+			if not has_media(self._properties):
+				return False
+			if self._checks_left > 0:
+				self._checks_left -= 1
+				return False
+			return True
+
+	def eject(self):
+		self.ejects += 1
+		self.remove()
+
+	def close(self):
+		pass
+
+
+def open_backend(drive):
+	try:
+		return UdevBackend(drive)
+	except (OSError, AttributeError):
+		return PollingBackend(drive)
+
+
+# The disc state machine:
+#   empty -> spinning_up -> ready -> ejecting -> empty
+class DriveMonitor(object):
+	def __init__(self, backend, readable_interval = READABLE_INTERVAL):
+		self.backend = backend
+		self.readable_interval = readable_interval
+		self.state = DriveState.empty
+		self.properties = {}
+
+	def _update(self, properties):
+		if has_media(properties):
+			if self.state == DriveState.empty:
+				self.state = DriveState.spinning_up
+		else:
+			self.state = DriveState.empty
+		self.properties = properties
+
+	# Wait for the next event, but give up early once stop is set
+	def _wait_event(self, wait, stop):
+		if stop is None:
+			return self.backend.wait_event(wait)
+
+		deadline = time.time() + wait
+		while not stop.is_set():
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			event = self.backend.wait_event(min(remaining, STOP_INTERVAL))
+			if event is not None:
+				return event
+		return None
+
+	# Block until a readable disc is in the drive and return its properties.
+	# Returns None if the timeout runs out or the stop event is set first.
+	def wait_for_disc(self, timeout = None, stop = None):
+		deadline = None if timeout is None else time.time() + timeout
+		self.state = DriveState.empty
+		self._update(self.backend.properties())
+
+		while True:
+			if self.state == DriveState.spinning_up and self.backend.readable(self.properties):
+				# The event may have been sent before the filesystem was probed
+				self.properties = self.backend.properties()
+				self.state = DriveState.ready
+				return self.properties
+
+			wait = POLL_INTERVAL
+			if self.state == DriveState.spinning_up:
+				wait = self.readable_interval
+			if deadline is not None:
+				wait = min(wait, deadline - time.time())
+				if wait <= 0:
+					return None
+
+			event = self._wait_event(wait, stop)
+			if stop is not None and stop.is_set():
+				return None
+			if event is None:
+				event = self.backend.properties()
+			self._update(event)
+
+	# Eject the disc and wait for the drive to notice it is gone
+	def eject(self, timeout = 10):
+		self.state = DriveState.ejecting
+		self.backend.eject()
+
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			properties = self.backend.properties()
+			if not has_media(properties):
+				break
+			self.backend.wait_event(min(self.readable_interval, deadline - time.time()))
+
+		self.state = DriveState.empty
+		self.properties = {}
+
+
+# Bash associative array assignment, safe to eval
+def to_shell(properties, name = 'DISC'):
+	entries = []
+	for key in sorted(properties):
+		if SHELL_KEY.match(key):
+			value = properties[key].replace("'", "'\\''")
+			entries.append("[{0}]='{1}'".format(key, value))
+	return "declare -A {0}=({1})".format(name, ' '.join(entries))
+
+
+def main(args):
+	if len(args) != 2 or args[0] not in ['--wait', '--eject', '--properties']:
+		print("usage: drive_monitor.py --wait|--eject|--properties drive")
+		return 1
+
+	command, drive = args
+	if command == '--properties':
+		print(to_shell(query_properties(drive)))
+		return 0
+
+	backend = open_backend(drive)
+	monitor = DriveMonitor(backend)
+	try:
+		if command == '--wait':
+			print(to_shell(monitor.wait_for_disc()))
+		else:
+			monitor.eject()
+	finally:
+		backend.close()
+
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
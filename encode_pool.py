@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Encodes audio tracks to mp3 with one lame per CPU, instead of one track
+# at a time.
+#
+# Each job is a track name plus either a WAV file or a function that
+# yields the WAV stream. A job's temp files are only removed once its mp3
+# has been written and checked.
+#
+# Usage:
+#   encode_pool.py [--remove] output_dir track01.cdda.wav track02.cdda.wav ...
+
+import sys, os
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+LAME_ARGS = ['lame', '-k', '-h', '-m', 'j', '-v', '-V', '4']
+
+
+class EncodeJob(object):
+	def __init__(self, short_name, out_name, wav_file = None, stream = None, temp_files = None):
+		self.short_name = short_name
+		self.out_name = out_name
+		self.wav_file = wav_file
+		self.stream = stream
+		self.temp_files = temp_files or []
+		self.elapsed = None
+		self.error = None
+
+
+# A finished mp3 should be non empty and start with a tag or a frame sync
+def verify_mp3(out_name):
+	try:
+		with open(out_name, 'rb') as f:
+			head = f.read(3)
+	except IOError:
+		return False
+
+	if head == b'ID3':
+		return True
+	return len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0
+
+
+def run_job(job):
+	start = time.time()
+
+	if job.stream:
+		proc = subprocess.Popen(LAME_ARGS + ['--quiet', '-', job.out_name], stdin = subprocess.PIPE)
+		try:
+			for chunk in job.stream():
+				proc.stdin.write(chunk)
+		except:
+			# Don't leave lame encoding half a track when the stream fails
+			proc.kill()
+			raise
+		finally:
+			try:
+				proc.stdin.close()
+			except (IOError, OSError):
+				# lame is gone, its exit code says why
+				pass
+			proc.wait()
+	else:
+		proc = subprocess.Popen(LAME_ARGS + ['--quiet', job.wav_file, job.out_name])
+
+	if proc.wait() != 0:
+		raise Exception("lame failed on {0}".format(job.short_name))
+
+	if not verify_mp3(job.out_name):
+		raise Exception("{0} is not a valid mp3".format(job.out_name))
+
+	for temp_file in job.temp_files:
+		os.remove(temp_file)
+
+	job.elapsed = time.time() - start
+	return job
+
+
+# Pass in an executor, and how many workers it has, to share one set of
+# encoders between several discs
+class EncodePool(object):
+	def __init__(self, workers = None, executor = None):
+		self.workers = workers or os.cpu_count() or 1
+		self.executor = executor
+		self._print_lock = threading.Lock()
+
+	def _run(self, job):
+		try:
+			run_job(job)
+		except Exception as e:
+			job.error = e
+			with self._print_lock:
+				print("{0}: failed, {1}".format(job.short_name, e))
+			return job
+
+		with self._print_lock:
+			print("{0}: {1:.1f} s".format(job.short_name, job.elapsed))
+		return job
+
+	# Encode all the jobs, and raise if any of them failed
+	def encode_all(self, jobs):
+		start = time.time()
+		if self.executor:
+			jobs = list(self.executor.map(self._run, jobs))
+		else:
+			with ThreadPoolExecutor(max_workers = self.workers) as executor:
+				jobs = list(executor.map(self._run, jobs))
+		elapsed = time.time() - start
+
+		track_time = sum([j.elapsed for j in jobs if j.elapsed])
+		print("Encoded {0} tracks in {1:.1f} s wall time ({2:.1f} s of encoding, {3} workers)".format(
+			len(jobs), elapsed, track_time, self.workers))
+
+		failed = [j for j in jobs if j.error]
+		if failed:
+			raise Exception("Failed to encode {0}".format(', '.join([j.short_name for j in failed])))
+
+		return jobs
+
+
+# cdparanoia names its files track01.cdda.wav
+def short_name(wav_file):
+	name = os.path.basename(wav_file)
+	for ext in ['.cdda.wav', '.wav']:
+		if name.endswith(ext):
+			return name[ : -len(ext)]
+	return name
+
+
+def main(args):
+	remove = '--remove' in args
+	args = [a for a in args if a != '--remove']
+	if len(args) < 2:
+		print("usage: encode_pool.py [--remove] output_dir file.wav ...")
+		return 1
+
+	out_dir, wav_files = args[0], args[1 : ]
+	jobs = []
+	for wav_file in wav_files:
+		short = short_name(wav_file)
+		temp_files = [wav_file] if remove else []
+		jobs.append(EncodeJob(short, os.path.join(out_dir, short + '.mp3'), wav_file = wav_file, temp_files = temp_files))
+
+	EncodePool().encode_all(jobs)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
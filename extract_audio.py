@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Encodes the audio tracks of a disc straight out of the ripped BIN, instead
+# of reading them off the disc again with cdparanoia.
+#
+# The .toc or .cue says where each track is, the BIN is memory mapped, and
+# the sectors of each track are streamed into lame behind a WAV header made
+# up on the spot, so no WAV files are ever written. Tracks are encoded in
+# parallel, see pipeline.py.
+#
+# With --drive the tracks are read with cdparanoia instead, still streamed
+# straight into the encoders.
+#
+# Either way the PCM is checksummed on its way to lame (see accuraterip.py),
+# and the checksums go in the manifest.
+#
+# Usage:
+#   extract_audio.py game_ns.toc output_dir
+#   extract_audio.py --drive /dev/sr0 game_ns.toc output_dir
+
+import sys, os
+import mmap
+import struct
+import threading
+
+from toc_file import RAW_SECTOR_SIZE, parse_disc
+from pipeline import encode_streamed, cdparanoia_source
+from accuraterip import track_checksum, checksum_stream, store_checksums, format_checksums, HAVE_NUMPY
+
+SECTORS_PER_CHUNK = 256
+
+CHANNELS = 2
+SAMPLE_RATE = 44100
+BITS_PER_SAMPLE = 16
+WAV_HEADER_SIZE = 44
+
+
+def wav_header(data_size):
+	block_align = CHANNELS * BITS_PER_SAMPLE // 8
+	return struct.pack('<4sI4s4sIHHIIHH4sI',
+		b'RIFF', 36 + data_size, b'WAVE',
+		b'fmt ', 16, 1, CHANNELS, SAMPLE_RATE, SAMPLE_RATE * block_align, block_align, BITS_PER_SAMPLE,
+		b'data', data_size)
+
+
+def swap_samples(chunk):
+	swapped = bytearray(len(chunk))
+	swapped[0::2] = chunk[1::2]
+	swapped[1::2] = chunk[0::2]
+	return swapped
+
+
+class BinFiles(object):
+	def __init__(self):
+		self._maps = {}
+		self._lock = threading.Lock()
+
+	def get(self, data_file):
+		with self._lock:
+			if data_file not in self._maps:
+				with open(data_file, 'rb') as f:
+					self._maps[data_file] = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+			return self._maps[data_file]
+
+	def close(self):
+		for m in self._maps.values():
+			m.close()
+		self._maps = {}
+
+
+# Yield the little endian PCM of sectors start to end, a chunk at a time
+def iter_pcm(disc, start, end, bin_files, sectors_per_chunk = SECTORS_PER_CHUNK):
+	for segment in disc.segments_between(start, end):
+		done = 0
+		while done < segment.length:
+			count = min(sectors_per_chunk, segment.length - done)
+
+			if segment.data_file is None:
+				yield bytes(count * RAW_SECTOR_SIZE)
+				done += count
+				continue
+
+			data = bin_files.get(segment.data_file)
+			pos = segment.file_offset + done * segment.sector_size
+			view = memoryview(data)[pos : pos + count * segment.sector_size]
+
+			# Drop any sub-channel data stored after each sector
+			if segment.sector_size != RAW_SECTOR_SIZE:
+				chunk = b''.join([view[i : i + RAW_SECTOR_SIZE] for i in range(0, len(view), segment.sector_size)])
+			else:
+				chunk = view
+
+			if segment.big_endian:
+				chunk = swap_samples(chunk)
+
+			yield chunk
+			view.release()
+			done += count
+
+
+def track_file_name(track):
+	return 'track{0:02d}'.format(track.number)
+
+
+# The WAV stream of one track, for feeding to lame
+def track_stream(disc, track, bin_files):
+	start, end = disc.play_range(track)
+	def stream():
+		yield wav_header((end - start) * RAW_SECTOR_SIZE)
+		for chunk in iter_pcm(disc, start, end, bin_files):
+			yield chunk
+	return stream
+
+
+# Checksum a WAV stream as it is read
+def checksummed(source, checksum):
+	def stream():
+		return checksum_stream(source(), checksum, WAV_HEADER_SIZE)
+	return stream
+
+
+# Encode the audio tracks, and return their checksums
+def extract_audio(disc_name, out_dir, workers = None, drive = None, executor = None):
+	disc = parse_disc(disc_name)
+	bin_files = BinFiles()
+	checksums = []
+	try:
+		tracks = []
+		for track in disc.audio_tracks:
+			short = track_file_name(track)
+			out_name = os.path.join(out_dir, short + '.mp3')
+			if drive:
+				source = cdparanoia_source(drive, track.number)
+			else:
+				source = track_stream(disc, track, bin_files)
+			if HAVE_NUMPY:
+				checksums.append((track.number, track_checksum(disc, track)))
+				source = checksummed(source, checksums[-1][1])
+			tracks.append((short, out_name, source))
+		encode_streamed(tracks, workers, executor = executor, shared_reader = bool(drive))
+	finally:
+		bin_files.close()
+
+	results = [dict(number = number, **checksum.digests()) for number, checksum in checksums]
+	if results:
+		store_checksums(disc_name, results)
+	return results
+
+
+def main(args):
+	drive = None
+	if len(args) == 4 and args[0] == '--drive':
+		drive, args = args[1], args[2 : ]
+
+	if len(args) != 2:
+		print("usage: extract_audio.py [--drive drive] disc.toc|disc.cue output_dir")
+		return 1
+
+	for line in format_checksums(extract_audio(args[0], args[1], drive = drive)):
+		print(line)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Tells whether a disc is already in the library, before it is ripped.
+#
+# The fingerprint is a SHA-1 of a few sectors read off the disc: the volume
+# descriptors, the root directory and a sample from the end of the volume,
+# along with where each track starts. That takes a few seconds to read,
+# where a full rip takes 10-20 minutes. Fingerprints of finished rips are
+# kept in RIP_PATH/.ps_ripper/library.db.
+#
+# The same fingerprint can be taken from an image (.iso, .cso, or the .toc
+# or .cue of a CD), so discs that were ripped before can be added too.
+#
+# Usage:
+#   fingerprint.py drive|image
+#   fingerprint.py --check rip_path drive     exits 0 if the disc is known
+#   fingerprint.py --add rip_path drive|image path
+
+import sys, os
+import time
+import fcntl
+import struct
+import hashlib
+import sqlite3
+import threading
+
+from toc_file import parse_disc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'identify_playstation2_games'))
+from image_file import open_image
+
+SECTOR_SIZE = 2048
+FIRST_DESCRIPTOR = 16
+MAX_DESCRIPTORS = 16
+END_SECTORS = 16
+LIBRARY_NAME = 'library.db'
+
+# linux/cdrom.h
+CDROMREADTOCHDR = 0x5305
+CDROMREADTOCENTRY = 0x5306
+CDROM_LBA = 0x01
+TOC_ENTRY = 'BBBxiB3x'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS discs (
+	fingerprint TEXT PRIMARY KEY,
+	path TEXT NOT NULL,
+	kind TEXT,
+	added REAL NOT NULL
+);
+'''
+
+
+# Reads the 2048 byte sectors of a drive
+class DeviceSectors(object):
+	def __init__(self, drive):
+		self.drive = drive
+		self.f = open(drive, 'rb')
+
+	def read(self, lba, count = 1):
+		self.f.seek(lba * SECTOR_SIZE)
+		return self.f.read(count * SECTOR_SIZE)
+
+	# [(track number, lba, is data)] from the drive's TOC, or None if it
+	# doesn't have one
+	def tracks(self):
+		try:
+			header = fcntl.ioctl(self.f.fileno(), CDROMREADTOCHDR, bytes(2))
+		except (IOError, OSError):
+			return None
+
+		first, last = struct.unpack('BB', header)
+		retval = []
+		for number in range(first, last + 1):
+			entry = struct.pack(TOC_ENTRY, number, 0, CDROM_LBA, 0, 0)
+			entry = fcntl.ioctl(self.f.fileno(), CDROMREADTOCENTRY, entry)
+			track, adr_ctrl, format, lba, mode = struct.unpack(TOC_ENTRY, entry)
+			retval.append((track, lba, bool(adr_ctrl & 0x40)))
+		return retval
+
+	def close(self):
+		self.f.close()
+
+
+# Reads the 2048 bytes of user data of each sector of an image, as the
+# drive would hand them over
+class ImageSectors(object):
+	def __init__(self, image_name):
+		self.disc = None
+		self._files = {}
+		if os.path.splitext(image_name)[1].lower() in ['.toc', '.cue']:
+			self.disc = parse_disc(image_name)
+		else:
+			self.f = open_image(image_name)
+
+	def _open(self, data_file):
+		if data_file not in self._files:
+			self._files[data_file] = open(data_file, 'rb')
+		return self._files[data_file]
+
+	def read(self, lba, count = 1):
+		if not self.disc:
+			self.f.seek(lba * SECTOR_SIZE)
+			return self.f.read(count * SECTOR_SIZE)
+
+		retval = []
+		for segment in self.disc.segments_between(lba, lba + count):
+			for i in range(segment.length):
+				if segment.data_file is None:
+					retval.append(bytes(SECTOR_SIZE))
+					continue
+				f = self._open(segment.data_file)
+				f.seek(segment.file_offset + i * segment.sector_size)
+				sector = f.read(segment.sector_size)
+				offset = _user_data_offset(sector)
+				retval.append(sector[offset : offset + SECTOR_SIZE])
+		return b''.join(retval)
+
+	def tracks(self):
+		if not self.disc:
+			return [(1, 0, True)]
+		return [(t.number, t.index1, not t.is_audio) for t in self.disc.tracks]
+
+	def close(self):
+		if not self.disc:
+			self.f.close()
+		for f in self._files.values():
+			f.close()
+
+
+# Where the user data starts in a sector as it is stored in an image
+def _user_data_offset(sector):
+	if len(sector) >= 2352:
+		# Raw, with sync and header. Mode 2 has a sub-header after it.
+		return 24 if sector[15] == 2 else 16
+	if len(sector) == 2336:
+		return 8
+	return 0
+
+
+# Where the root directory is, and how many sectors the volume has, from
+# the ISO 9660 primary volume descriptor. PS2 DVDs have one next to UDF.
+def _parse_pvd(sector):
+	if len(sector) < SECTOR_SIZE or sector[0 : 6] != b'\x01CD001':
+		return None
+	volume_size = struct.unpack('<I', sector[80 : 84])[0]
+	root_lba, root_length = struct.unpack('<I4xI', sector[158 : 170])
+	return volume_size, root_lba, root_length
+
+
+# Sectors off a sector reader, or a marker in their place if they can't be
+# read. Scratched discs mostly fail at the end, which is read here too, and
+# such a disc still needs a fingerprint to be ripped and carried on with.
+def _read_sectors(sectors, lba, count = 1):
+	try:
+		return sectors.read(lba, count)
+	except (IOError, OSError):
+		return 'unreadable {0} {1}'.format(lba, count).encode('ascii')
+
+
+# The fingerprint of what a sector reader reads: a DeviceSectors or an
+# ImageSectors
+def fingerprint(sectors):
+	sha1 = hashlib.sha1()
+
+	# Tracks are compared by where they start, the end of the volume is
+	# already in the primary volume descriptor
+	tracks = sectors.tracks() or [(1, 0, True)]
+	sha1.update(repr([tuple(t) for t in tracks]).encode('ascii'))
+
+	pvd = None
+	for lba in range(FIRST_DESCRIPTOR, FIRST_DESCRIPTOR + MAX_DESCRIPTORS):
+		sector = _read_sectors(sectors, lba)
+		if not sector:
+			break
+		sha1.update(sector)
+		pvd = pvd or _parse_pvd(sector)
+		# The set terminator, after which come the UDF descriptors, which
+		# end with the first empty sector
+		if not sector.strip(b'\x00'):
+			break
+
+	if pvd:
+		volume_size, root_lba, root_length = pvd
+		root_sectors = max(1, min((root_length + SECTOR_SIZE - 1) // SECTOR_SIZE, MAX_DESCRIPTORS))
+		sha1.update(_read_sectors(sectors, root_lba, root_sectors))
+		if volume_size > END_SECTORS:
+			sha1.update(_read_sectors(sectors, volume_size - END_SECTORS, END_SECTORS))
+
+	return sha1.hexdigest()
+
+
+def fingerprint_device(drive):
+	sectors = DeviceSectors(drive)
+	try:
+		return fingerprint(sectors)
+	finally:
+		sectors.close()
+
+
+def fingerprint_image(image_name):
+	sectors = ImageSectors(image_name)
+	try:
+		return fingerprint(sectors)
+	finally:
+		sectors.close()
+
+
+def fingerprint_any(name):
+	if os.path.isfile(name):
+		return fingerprint_image(name)
+	return fingerprint_device(name)
+
+
+# The discs that have been ripped, by fingerprint
+class DiscLibrary(object):
+	def __init__(self, db_name):
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(db_name, timeout = 30, check_same_thread = False, isolation_level = None)
+		self._db.executescript(SCHEMA)
+
+	def close(self):
+		self._db.close()
+
+	# The path of a disc in the library, or None. A disc whose files have
+	# gone counts as not ripped.
+	def lookup(self, fingerprint):
+		with self._lock:
+			row = self._db.execute("SELECT path FROM discs WHERE fingerprint = ?", (fingerprint, )).fetchone()
+		if row and os.path.exists(row[0]):
+			return row[0]
+		return None
+
+	def add(self, fingerprint, path, kind = None):
+		with self._lock:
+			self._db.execute("INSERT OR REPLACE INTO discs (fingerprint, path, kind, added) VALUES (?, ?, ?, ?)",
+				(fingerprint, os.path.abspath(path), kind, time.time()))
+
+
+def open_library(rip_path):
+	state_dir = os.path.join(rip_path, '.ps_ripper')
+	if not os.path.isdir(state_dir):
+		os.makedirs(state_dir)
+	return DiscLibrary(os.path.join(state_dir, LIBRARY_NAME))
+
+
+def main(args):
+	if len(args) == 1:
+		print(fingerprint_any(args[0]))
+		return 0
+
+	if len(args) == 3 and args[0] == '--check':
+		library = open_library(args[1])
+		path = library.lookup(fingerprint_any(args[2]))
+		library.close()
+		if path:
+			print("Already ripped to {0}".format(path))
+			return 0
+		return 1
+
+	if len(args) == 4 and args[0] == '--add':
+		library = open_library(args[1])
+		library.add(fingerprint_any(args[2]), args[3])
+		library.close()
+		return 0
+
+	print("usage: fingerprint.py drive|image | --check rip_path drive | --add rip_path drive|image path")
+	return 2
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
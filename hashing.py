@@ -0,0 +1,231 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Hashes images while they are being written, so checking a rip against
+# redump never needs a second read of a multi GB file.
+#
+# Each chunk is handed to one thread per hash (CRC32, MD5 and SHA-1 all
+# release the GIL on big buffers), so the hashes run next to the write
+# instead of after it. The digests go in a sidecar manifest,
+# <name>.manifest.json, next to the image.
+#
+# Usage:
+#   hashing.py image.iso
+#   hashing.py --benchmark [megabytes]
+
+import sys, os
+import json
+import time
+import zlib
+import queue
+import hashlib
+import tempfile
+import threading
+
+CHUNK_SIZE = 1024 * 1024 * 4
+QUEUE_CHUNKS = 4
+FOLLOW_INTERVAL = 0.5
+MANIFEST_EXT = '.manifest.json'
+
+
+class Crc32(object):
+	def __init__(self):
+		self.value = 0
+
+	def update(self, data):
+		self.value = zlib.crc32(data, self.value)
+
+	def hexdigest(self):
+		return '{0:08x}'.format(self.value & 0xFFFFFFFF)
+
+
+def _hash_worker(hasher, chunks):
+	while True:
+		chunk = chunks.get()
+		if chunk is None:
+			return
+		hasher.update(chunk)
+
+
+# CRC32, MD5 and SHA-1 of everything passed to update(), each computed on
+# its own thread
+class MultiHasher(object):
+	def __init__(self):
+		self.size = 0
+		self._hashers = {'crc32' : Crc32(), 'md5' : hashlib.md5(), 'sha1' : hashlib.sha1()}
+		self._queues = []
+		self._threads = []
+		for hasher in self._hashers.values():
+			chunks = queue.Queue(QUEUE_CHUNKS)
+			thread = threading.Thread(target = _hash_worker, args = (hasher, chunks))
+			thread.daemon = True
+			thread.start()
+			self._queues.append(chunks)
+			self._threads.append(thread)
+
+	def update(self, data):
+		# The chunk is shared by all the workers, so it can't change under them
+		if not isinstance(data, bytes):
+			data = bytes(data)
+		self.size += len(data)
+		for chunks in self._queues:
+			chunks.put(data)
+
+	# Wait for the workers and return {'size', 'crc32', 'md5', 'sha1'}
+	def digests(self):
+		for chunks in self._queues:
+			chunks.put(None)
+		for thread in self._threads:
+			thread.join()
+
+		retval = {'size' : self.size}
+		for name, hasher in self._hashers.items():
+			retval[name] = hasher.hexdigest()
+		return retval
+
+
+# A file object that hashes everything written to it
+class HashTee(object):
+	def __init__(self, dst, hasher = None):
+		self.dst = dst
+		self.hasher = hasher or MultiHasher()
+
+	def write(self, data):
+		self.hasher.update(data)
+		return self.dst.write(data)
+
+	def writelines(self, lines):
+		self.write(b''.join(lines))
+
+	def digests(self):
+		return self.hasher.digests()
+
+
+# Copy src to dst in big chunks, hashing on the way
+def copy_hashed(src, dst, chunk_size = CHUNK_SIZE):
+	tee = HashTee(dst)
+	while True:
+		chunk = src.read(chunk_size)
+		if not chunk:
+			break
+		tee.write(chunk)
+	return tee.digests()
+
+
+# Hash a file another process is writing sequentially, like cdrdao does,
+# reading each part right after it lands so it still comes from the page
+# cache. is_done should return True once the writer has exited.
+def follow_file(file_name, is_done, chunk_size = CHUNK_SIZE, interval = FOLLOW_INTERVAL):
+	hasher = MultiHasher()
+	while not os.path.exists(file_name):
+		if is_done():
+			return None
+		time.sleep(interval)
+
+	with open(file_name, 'rb') as f:
+		while True:
+			done = is_done()
+			chunk = f.read(chunk_size)
+			if chunk:
+				hasher.update(chunk)
+			elif done:
+				break
+			else:
+				time.sleep(interval)
+
+	return hasher.digests()
+
+
+def hash_stream(f, chunk_size = CHUNK_SIZE):
+	hasher = MultiHasher()
+	while True:
+		chunk = f.read(chunk_size)
+		if not chunk:
+			break
+		hasher.update(chunk)
+	return hasher.digests()
+
+
+def hash_file(file_name, chunk_size = CHUNK_SIZE):
+	with open(file_name, 'rb') as f:
+		return hash_stream(f, chunk_size)
+
+
+# The manifest for an image. A CD rip shares one manifest between
+# NAME.bin and NAME_ns.bin.
+def manifest_name(image_name):
+	base = os.path.splitext(image_name)[0]
+	if base.endswith('_ns') and os.path.exists(base[ : -3] + MANIFEST_EXT):
+		base = base[ : -3]
+	return base + MANIFEST_EXT
+
+
+def read_manifest(file_name):
+	if not os.path.exists(file_name):
+		return {'files' : {}}
+	with open(file_name, 'r') as f:
+		return json.load(f)
+
+
+# Merge the digests of some files into a manifest. files maps the image
+# file names, relative to the manifest, to their digests.
+def update_manifest(file_name, files = None, **sections):
+	manifest = read_manifest(file_name)
+	manifest.setdefault('files', {}).update(files or {})
+	manifest.update(sections)
+
+	tmp_name = file_name + '.part'
+	with open(tmp_name, 'w') as f:
+		json.dump(manifest, f, indent = 1, sort_keys = True)
+	os.rename(tmp_name, file_name)
+	return manifest
+
+
+def benchmark(megabytes = 512, rounds = 3):
+	chunk = os.urandom(CHUNK_SIZE)
+	count = megabytes * 1024 * 1024 // CHUNK_SIZE
+	tmp_dir = tempfile.mkdtemp()
+	results = {False : [], True : []}
+	try:
+		for i in range(rounds):
+			for hashed in [False, True]:
+				file_name = os.path.join(tmp_dir, 'bench.iso')
+				start = time.time()
+				with open(file_name, 'wb') as f:
+					dst = HashTee(f) if hashed else f
+					for j in range(count):
+						dst.write(chunk)
+					if hashed:
+						dst.digests()
+					f.flush()
+					os.fsync(f.fileno())
+				results[hashed].append(time.time() - start)
+				os.remove(file_name)
+	finally:
+		os.rmdir(tmp_dir)
+
+	size = count * CHUNK_SIZE / 1048576.0
+	plain, hashed = min(results[False]), min(results[True])
+	print("Plain write:  {0:.1f} MB in {1:.2f} s, {2:.1f} MB/s".format(size, plain, size / plain))
+	print("Hashed write: {0:.1f} MB in {1:.2f} s, {2:.1f} MB/s".format(size, hashed, size / hashed))
+	print("Overhead: {0:.1f}% (best of {1} rounds)".format((hashed - plain) / plain * 100, rounds))
+
+
+def main(args):
+	if args and args[0] == '--benchmark':
+		benchmark(*[int(a) for a in args[1 : ]])
+		return 0
+
+	if len(args) != 1:
+		print("usage: hashing.py image | --benchmark [megabytes]")
+		return 1
+
+	image_name = args[0]
+	digests = hash_file(image_name)
+	update_manifest(manifest_name(image_name), {os.path.basename(image_name) : digests})
+	print(json.dumps(digests, indent = 1, sort_keys = True))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -31,6 +31,7 @@ import re
 import json
 import read_udf
 import iso9660
+from image_file import open_image, image_size
 
 IS_PY2 = sys.version_info[0] == 2
 
@@ -125,7 +126,7 @@ dbs = [
 	db_playstation2_official_us
 ]
 for db in dbs:
-	keys = db.keys()
+	keys = list(db.keys())
 	for key in keys:
 		# Get the value
 		val = db[key]
@@ -140,9 +141,75 @@ for db in dbs:
 			db[bytes(key, 'utf-8')] = val
 
 
+# Serials are matched in upper case, with the ISO 9660 version (";1") cut
+# off and everything but letters and digits taken out, so "SLUS_203.12;1",
+# "slus20312" and "SLUS-20312" are all the same serial
+NOT_SERIAL_CHARS = re.compile(b'[^A-Z0-9]')
+SERIAL_END = -1
+
+def _normalize_serial(name):
+	if not isinstance(name, bytes):
+		name = name.encode('utf-8')
+	name = name.split(b';')[0]
+	return bytearray(NOT_SERIAL_CHARS.sub(b'', name.upper()))
+
+
+# A trie of every serial in the databases, normalized, a dict per character.
+# Where a serial ends, SERIAL_END holds (serial, region, title). A serial in
+# more than one database goes by the first, in this order.
+def _build_serial_trie():
+	regions = [
+		("Asia", db_playstation2_official_as),
+		("Australia", db_playstation2_official_au),
+		("Europe", db_playstation2_official_eu),
+		("Japan", db_playstation2_official_jp),
+		("Korea", db_playstation2_official_ko),
+		("USA", db_playstation2_official_us),
+	]
+	trie = {}
+	for region, db in regions:
+		for serial, title in db.items():
+			node = trie
+			for ch in _normalize_serial(serial):
+				node = node.setdefault(ch, {})
+			node.setdefault(SERIAL_END, (serial, region, title))
+	return trie
+
+SERIAL_TRIE = _build_serial_trie()
+
+
+def _is_digit(ch):
+	return 48 <= ch <= 57
+
+
+# The (serial, region, title) of a file name or serial, in one walk down
+# the trie, or None. The longest serial the name starts with wins, so
+# suffixes after it like "_DISC1" are ignored, but not more digits, as
+# "SLUS_203.123" is not SLUS-20312.
+def match_serial(name):
+	key = _normalize_serial(name)
+	node = SERIAL_TRIE
+	found = None
+	for i in range(len(key)):
+		node = node.get(key[i])
+		if node is None:
+			break
+		if SERIAL_END in node and not (i + 1 < len(key) and _is_digit(key[i]) and _is_digit(key[i + 1])):
+			found = node[SERIAL_END]
+	return found
+
+
+# Any of the prefixes, then something like "_203.12;", in one pass over
+# the buffer. Longer prefixes first, so "SLPM" isn't cut short by "SLP".
+SERIAL_IN_BINARY = re.compile(b'(?:' +
+	b'|'.join([re.escape(prefix) for prefix in sorted(PREFIXES, key = len, reverse = True)]) +
+	b')[_-][0-9.]+;')
+
+
 def _find_in_binary(file_name):
-	f = open(file_name, 'rb')
-	file_size = os.path.getsize(file_name)
+	f = open_image(file_name)
+	f.seek(0)
+	file_size = image_size(f)
 	while True:
 		# Read into the buffer
 		rom_data = f.read(BUFFER_SIZE)
@@ -155,18 +222,20 @@ def _find_in_binary(file_name):
 		# This is done to stop the serial number from being spread over multiple buffers
 		pos = f.tell()
 		use_offset = False
-		if pos > MAX_PREFIX_LEN and pos < file_size:
+		if pos > MAX_PREFIX_LEN and (file_size is None or pos < file_size):
 			use_offset = True
 
-		# Check if the prefix is in the buffer
-		for prefix in PREFIXES:
-			m = re.search(prefix + b"[\_|\-][\d|\.]+\;", rom_data)
-			if m and m.group() and b'999.99' not in m.group():
-				# Get the serial number location
-				serial_number = m.group().replace(b'.', b'').replace(b'_', b'-').replace(b';', b'')
-				#print('serial_number', serial_number)
-
-				return serial_number
+		# Look for serial numbers in the buffer. The first one in the
+		# databases wins, or failing that the first one found.
+		first = None
+		for m in SERIAL_IN_BINARY.finditer(rom_data):
+			if b'999.99' in m.group():
+				continue
+			if match_serial(m.group()):
+				return m.group()
+			first = first or m.group()
+		if first:
+			return first
 
 		if use_offset:
 			f.seek(pos - MAX_PREFIX_LEN)
@@ -175,16 +244,29 @@ def _find_in_binary(file_name):
 
 
 def get_playstation2_game_info(file_name):
-	# Skip if not an ISO
-	if not os.path.splitext(file_name)[1].lower() in ['.iso', '.bin']:
-		raise Exception("Not an ISO or BIN file.")
+	# Skip if not an ISO, allowing for compressed ones like game.iso.gz
+	name = file_name
+	if os.path.splitext(name)[1].lower() == '.gz':
+		name = os.path.splitext(name)[0]
+	if not os.path.splitext(name)[1].lower() in ['.iso', '.bin', '.cso', '.zso']:
+		raise Exception("Not an ISO, BIN, CSO or ZSO file.")
+
+	# Opened once for all the ways of reading it, so a compressed image
+	# keeps what it has decompressed
+	image = open_image(file_name)
+	try:
+		return _get_game_info(image)
+	finally:
+		image.close()
 
+
+def _get_game_info(image):
 	# Look at each file in the DVD ISO
 	disc_type = None
 	entries = []
 
 	try:
-		root_directory = read_udf.read_udf_file(file_name)
+		root_directory = read_udf.read_udf_file(image)
 		
 		for sub_entry in root_directory.all_entries:
 			entries.append(sub_entry.file_identifier)
@@ -195,7 +277,7 @@ def get_playstation2_game_info(file_name):
 	# Look at each file in the CD ISO
 	try:
 		if not disc_type:
-			cd = iso9660.ISO9660(file_name)
+			cd = iso9660.ISO9660(image)
 			for sub_entry in cd.tree():
 				entries.append(sub_entry.lstrip('/'))
 			disc_type = 'CD'
@@ -204,7 +286,7 @@ def get_playstation2_game_info(file_name):
 
 	# Look at the entire binary
 	if not disc_type:
-		entries = [_find_in_binary(file_name)]
+		entries = [_find_in_binary(image)]
 		disc_type = 'Binary'
 
 	# Not a supported format
@@ -212,38 +294,13 @@ def get_playstation2_game_info(file_name):
 		raise Exception("Failed to read as a CD ISO, DVD ISO, or Binary.")
 
 	for sub_entry in entries:
-
-		# Sanitize the file name with the serial number
-		serial_number = sub_entry.upper().replace(b'.', b'').replace(b'_', b'-')
-
-		# Skip if the serial number has an invalid prefix
-		if serial_number.split(b'-')[0] not in PREFIXES:
+		# Skip if not a known serial number
+		if not sub_entry:
 			continue
-
-		# Look up the proper name
-		title, region = None, None
-		if serial_number in db_playstation2_official_as:
-			region = "Asia"
-			title = db_playstation2_official_as[serial_number]
-		elif serial_number in db_playstation2_official_au:
-			region = "Australia"
-			title = db_playstation2_official_au[serial_number]
-		elif serial_number in db_playstation2_official_eu:
-			region = "Europe"
-			title = db_playstation2_official_eu[serial_number]
-		elif serial_number in db_playstation2_official_jp:
-			region = "Japan"
-			title = db_playstation2_official_jp[serial_number]
-		elif serial_number in db_playstation2_official_ko:
-			region = "Korea"
-			title = db_playstation2_official_ko[serial_number]
-		elif serial_number in db_playstation2_official_us:
-			region = "USA"
-			title = db_playstation2_official_us[serial_number]
-
-		# Skip if unknown serial number
-		if not title or not region:
+		match = match_serial(sub_entry)
+		if not match:
 			continue
+		serial_number, region, title = match
 
 		return {
 			'serial_number' : serial_number,
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Random access to disc images that are stored compressed, so they can be
+# identified without unpacking them first.
+#
+# CSO and ZSO images have an index with the offset of every block, so a
+# read only decompresses the blocks it touches, and the last few are kept
+# in a small cache. A gzip'd image has no index, so one is built as it is
+# read: every few MB the state of the decompressor is saved, and a seek
+# starts from the nearest saved state before it instead of the start.
+#
+# open_image() gives a file object for any of them, or a plain image.
+
+import sys, os
+import io
+import zlib
+import bisect
+import struct
+import collections
+
+try:
+	import lz4.block as lz4_block
+except ImportError:
+	lz4_block = None
+
+CSO_HEADER = '<4sIQIBB2x'
+CSO_HEADER_SIZE = struct.calcsize(CSO_HEADER)
+CSO_MAGIC = {b'CISO' : 'cso', b'ZISO' : 'zso'}
+PLAIN_BLOCK = 0x80000000
+INDEX_CHUNK = 1024
+CACHE_BLOCKS = 64
+
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_READ_SIZE = 1024 * 64
+GZIP_CHECKPOINT = 1024 * 1024 * 8
+GZIP_RECENT = 1024 * 64
+
+
+# A CSO or ZSO image
+class CompressedImage(io.RawIOBase):
+	def __init__(self, file, cache_blocks = CACHE_BLOCKS):
+		super(CompressedImage, self).__init__()
+		self._file = file
+		self._file.seek(0)
+		header = self._file.read(CSO_HEADER_SIZE)
+		if len(header) < CSO_HEADER_SIZE or header[0 : 4] not in CSO_MAGIC:
+			raise Exception("Not a CSO or ZSO image.")
+
+		magic, header_size, self.size, self.block_size, version, self.align = struct.unpack(CSO_HEADER, header)
+		self.format = CSO_MAGIC[magic]
+		if self.format == 'zso' and not lz4_block:
+			raise Exception("Reading ZSO images needs the lz4 module.")
+
+		self.blocks = (self.size + self.block_size - 1) // self.block_size
+		self._index_start = header_size
+		self._index = {}
+		self._cache = collections.OrderedDict()
+		self._cache_blocks = cache_blocks
+		self._pos = 0
+		self.blocks_read = 0
+
+	# The index is read a chunk at a time, as it is needed
+	def _index_entry(self, block):
+		chunk = block // INDEX_CHUNK
+		if chunk not in self._index:
+			first = chunk * INDEX_CHUNK
+			count = min(INDEX_CHUNK, self.blocks + 1 - first)
+			self._file.seek(self._index_start + first * 4)
+			self._index[chunk] = struct.unpack('<{0}I'.format(count), self._file.read(count * 4))
+		return self._index[chunk][block % INDEX_CHUNK]
+
+	def _block(self, block):
+		if block in self._cache:
+			self._cache[block] = self._cache.pop(block)
+			return self._cache[block]
+
+		entry, next_entry = self._index_entry(block), self._index_entry(block + 1)
+		start = (entry & ~PLAIN_BLOCK) << self.align
+		end = (next_entry & ~PLAIN_BLOCK) << self.align
+		self._file.seek(start)
+		if entry & PLAIN_BLOCK:
+			data = self._file.read(self.block_size)
+		elif self.format == 'zso':
+			data = lz4_block.decompress(self._file.read(end - start), uncompressed_size = self.block_size)
+		else:
+			data = zlib.decompressobj(-15).decompress(self._file.read(end - start))
+		self.blocks_read += 1
+
+		self._cache[block] = data
+		if len(self._cache) > self._cache_blocks:
+			self._cache.popitem(last = False)
+		return data
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self._pos
+
+	def seek(self, offset, whence = io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			offset += self._pos
+		elif whence == io.SEEK_END:
+			offset += self.size
+		self._pos = max(offset, 0)
+		return self._pos
+
+	def readinto(self, buffer):
+		count = max(min(len(buffer), self.size - self._pos), 0)
+		done = 0
+		while done < count:
+			block, offset = divmod(self._pos + done, self.block_size)
+			data = self._block(block)
+			length = min(len(data) - offset, count - done)
+			if length <= 0:
+				break
+			buffer[done : done + length] = data[offset : offset + length]
+			done += length
+		self._pos += done
+		return done
+
+	def close(self):
+		self._file.close()
+		super(CompressedImage, self).close()
+
+
+# A gzip'd image. The size isn't known up front, since gzip only stores it
+# modulo 4 GB, so size is None.
+class GzipImage(io.RawIOBase):
+	def __init__(self, file, checkpoint_every = GZIP_CHECKPOINT):
+		super(GzipImage, self).__init__()
+		self._file = file
+		self.size = None
+		self._checkpoint_every = checkpoint_every
+		self._checkpoints = []
+		self._restart(0, 0, zlib.decompressobj(16 + zlib.MAX_WBITS), b'')
+		self._save_checkpoint()
+		self._pos = 0
+		self.inflated = 0
+
+	def _restart(self, pos, file_pos, decompressor, tail):
+		self._out_pos = pos
+		self._file.seek(file_pos)
+		self._decompressor = decompressor.copy()
+		self._tail = tail
+		self._recent = b''
+
+	def _save_checkpoint(self):
+		self._checkpoints.append((self._out_pos, self._file.tell(), self._decompressor.copy(), self._tail))
+
+	# Up to count more bytes from where the decompressor is, or b'' at the end
+	def _inflate(self, count):
+		# Stop on checkpoint boundaries, so one can be saved there
+		next_checkpoint = (self._out_pos // self._checkpoint_every + 1) * self._checkpoint_every
+		count = min(count, next_checkpoint - self._out_pos)
+
+		while True:
+			data = self._tail or self._file.read(GZIP_READ_SIZE)
+			if not data:
+				return b''
+			retval = self._decompressor.decompress(data, count)
+			self._tail = self._decompressor.unconsumed_tail
+
+			# Images can be several gzip members one after the other
+			if self._decompressor.eof:
+				# unused_data is all that is left of data, unconsumed_tail
+				# can still hold a stale copy of it
+				self._tail = self._decompressor.unused_data
+				self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+				if not self._tail.startswith(GZIP_MAGIC[ : len(self._tail)]):
+					self._tail = b''
+					self._file.seek(0, io.SEEK_END)
+
+			if retval:
+				self._out_pos += len(retval)
+				self.inflated += len(retval)
+				self._recent = (self._recent + retval)[-GZIP_RECENT : ]
+				if self._out_pos == next_checkpoint and self._out_pos > self._checkpoints[-1][0]:
+					self._save_checkpoint()
+				return retval
+
+	# Get the decompressor to pos, from the last checkpoint before it if
+	# that is closer than where it is now
+	def _move_to(self, pos):
+		i = bisect.bisect_right([c[0] for c in self._checkpoints], pos) - 1
+		checkpoint = self._checkpoints[i]
+		if pos < self._out_pos or checkpoint[0] > self._out_pos:
+			self._restart(*checkpoint)
+
+		while self._out_pos < pos:
+			if not self._inflate(pos - self._out_pos):
+				break
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self._pos
+
+	def seek(self, offset, whence = io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			offset += self._pos
+		elif whence == io.SEEK_END:
+			# Have to go through all of it to find the end
+			self._move_to(sys.maxsize)
+			self.size = self._out_pos
+			offset += self.size
+		self._pos = max(offset, 0)
+		return self._pos
+
+	def readinto(self, buffer):
+		done = 0
+		# Short seeks back, like over a line that was split between two
+		# reads, come from what was just inflated
+		recent_pos = self._out_pos - len(self._recent)
+		if recent_pos <= self._pos < self._out_pos:
+			start = self._pos - recent_pos
+			data = self._recent[start : start + len(buffer)]
+			buffer[0 : len(data)] = data
+			done = len(data)
+		else:
+			self._move_to(self._pos)
+
+		while done < len(buffer) and self._out_pos == self._pos + done:
+			data = self._inflate(len(buffer) - done)
+			if not data:
+				break
+			buffer[done : done + len(data)] = data
+			done += len(data)
+		self._pos += done
+		return done
+
+	def close(self):
+		self._file.close()
+		super(GzipImage, self).close()
+
+
+# Open an image for reading, decompressing it on the fly if it is a CSO,
+# ZSO or gzip file. Anything that is already a file object is returned as
+# it is.
+def open_image(file_name):
+	if hasattr(file_name, 'read'):
+		return file_name
+
+	file = open(file_name, 'rb')
+	magic = file.read(4)
+	file.seek(0)
+	if magic in CSO_MAGIC:
+		return io.BufferedReader(CompressedImage(file))
+	elif magic[0 : 2] == GZIP_MAGIC:
+		return io.BufferedReader(GzipImage(file))
+	return file
+
+
+# The size of what an image holds, or None if that can't be known without
+# reading all of it
+def image_size(file):
+	raw = getattr(file, 'raw', file)
+	if isinstance(raw, (CompressedImage, GzipImage)):
+		return raw.size
+	pos = file.tell()
+	size = file.seek(0, io.SEEK_END)
+	file.seek(pos)
+	return size
+
+
+def is_compressed_name(file_name):
+	return os.path.splitext(file_name)[1].lower() in ['.cso', '.zso', '.gz']
@@ -28,6 +28,7 @@ import sys
 import urllib
 import struct
 import datetime
+from image_file import open_image
 
 PY2 = (sys.version_info[0] == 2)
 
@@ -57,9 +58,23 @@ class ISO9660(object):
         self._paths = []   #path table
 
         self._url   = url
+        self._file  = None #open image, for files
+        self._owns_file = False #opened here, not handed in
         if not hasattr(self, '_get_sector'): #it might have been set by a subclass
-            self._get_sector = self._get_sector_url if url.startswith('http') else self._get_sector_file
+            if hasattr(url, 'read') or not url.startswith('http'):
+                self._file = open_image(url)
+                self._owns_file = self._file is not url
+                self._get_sector = self._get_sector_file
+            else:
+                self._get_sector = self._get_sector_url
+
+        try:
+            self._read_descriptors()
+        except:
+            self.close()
+            raise
 
+    def _read_descriptors(self):
         ### Volume Descriptors
         sector = 0x10
         while True:
@@ -97,6 +112,22 @@ class ISO9660(object):
 
         assert l0 == 0
 
+    ##
+    ## Close the image, if it was opened from a path. A file object that was
+    ## passed in is left for the caller to close.
+    ##
+
+    def close(self):
+        if self._owns_file:
+            self._file.close()
+            self._owns_file = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     ##
     ## Generator listing available files/folders
     ##
@@ -162,9 +193,9 @@ class ISO9660(object):
         self._buff = opener.open(self._url)
 
     def _get_sector_file(self, sector, length):
-        with open(self._url, 'rb') as f:
-            f.seek(sector*SECTOR_SIZE)
-            self._buff = BytesIO(f.read(length))
+        # Kept open, so a compressed image keeps its cache between reads
+        self._file.seek(sector*SECTOR_SIZE)
+        self._buff = BytesIO(self._file.read(length))
 
     ##
     ## Return the record for final directory in a path
@@ -349,9 +380,9 @@ if __name__ == '__main__':
     else:
         iso_path = sys.argv[1]
         ret_path = sys.argv[2] if len(sys.argv) > 2 else None
-        cd = ISO9660(iso_path)
-        if ret_path:
-            sys.stdout.write(cd.get_file(ret_path))
-        else:
-            for path in cd.tree():
-                print(path)
+        with ISO9660(iso_path) as cd:
+            if ret_path:
+                sys.stdout.write(cd.get_file(ret_path))
+            else:
+                for path in cd.tree():
+                    print(path)
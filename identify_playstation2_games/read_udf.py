@@ -34,13 +34,22 @@
 
 
 import sys, os
+import io
 import struct
+import bisect
+import binascii
+from image_file import open_image, image_size
 
 IS_PY2 = sys.version_info[0] == 2
 
 MAX_INT = 2 ** (struct.Struct('i').size * 8 - 1) - 1
 HEADER_SIZE = 1024 * 32
 SECTOR_SIZE = 1024 * 2 # FIXME: This should not be hard coded
+VRS_SECTORS = 16
+ANCHOR_SECTOR = 256
+ANCHOR_SECTOR_SIZES = [2048, 4096, 1024, 512]
+MAX_VDS_SECTORS = 64
+MAX_VDS_EXTENTS = 8
 
 
 def to_uint8(buffer, start = 0):
@@ -76,38 +85,26 @@ def to_dstring(buffer, offset, count):
 	byte_len = to_uint8(buffer, offset + count - 1)
 	return to_dchars(buffer, offset, byte_len)
 
+# OSTA compressed unicode, as UTF-8 bytes. The first byte is the
+# compression ID: 8 for one byte characters, 16 for big endian two byte
+# ones. Both are decoded in one go by the codec for them.
+# "2.1.1 Character Sets" of http://www.osta.org/specs/pdf/udf260.pdf
 def to_dchars(buffer, offset, count):
 	if count == 0:
 		return b""
 
 	alg = to_uint8(buffer, offset)
-
-	if alg not in [8, 16]:
-		raise Exception("Corrupt compressed unicode string")
-
-	result = []
-
-	pos = 1
-	while pos < count:
-		ch = to_uint8(b"\0")
-
-		if alg == 16:
-			ch = (to_uint8(buffer, offset + pos) << 8)
-			pos += 1
-
-		if pos < count:
-			ch |= to_uint8(buffer, offset + pos)
-			pos += 1
-
-		result.append(ch)
-
-	# Convert from ints to chars
-	if IS_PY2:
-		result = [bytes(chr(n)) for n in result]
+	data = bytes(buffer[offset + 1 : offset + count])
+
+	if alg == 8:
+		return data.decode('latin-1').encode('utf-8')
+	elif alg == 16:
+		# A last odd byte is the high half of a character
+		if len(data) % 2:
+			data += b"\0"
+		return data.decode('utf-16-be', 'replace').encode('utf-8')
 	else:
-		result = [bytes(chr(n), 'utf-8') for n in result]
-
-	return b''.join(result)
+		raise Exception("Corrupt compressed unicode string")
 
 
 class BaseTag(object):
@@ -160,12 +157,23 @@ class BaseTag(object):
 				raise Exception("Reserve space at {0} was not zero.".format(start))
 
 
+# A descriptor whose CRC doesn't match its contents, from a bad read most
+# likely. location is the tag's own, which is a sector number for volume
+# descriptors and a logical block in the partition for the rest.
+class DescriptorCRCError(Exception):
+	def __init__(self, tag_identifier, location, message):
+		super(DescriptorCRCError, self).__init__("Tag Identifier {0} at LBA {1}: {2}".format(tag_identifier, location, message))
+		self.tag_identifier = tag_identifier
+		self.location = location
+
+
 class UdfContext(object):
-	def __init__(self, file, physical_sector_size):
+	def __init__(self, file, physical_sector_size, strict = False):
 		self.file = file
 		self.logical_partitions = []
 		self.physical_partitions = {}
 		self.physical_sector_size = physical_sector_size
+		self.strict = strict
 
 
 # "2.1.5 Entity Identifier" of http://www.osta.org/specs/pdf/udf260.pdf
@@ -208,6 +216,7 @@ class TagIdentifier(object): # enum
 	LogicalVolumeIntegrityDescriptor = 9
 	FileSetDescriptor = 256
 	FileIdentifierDescriptor = 257
+	AllocationExtentDescriptor = 258
 	FileEntry = 261
 
 
@@ -233,6 +242,20 @@ class DescriptorTag(BaseTag):
 		self._assert_checksum(buffer, start, self.tag_check_sum)
 		self._assert_reserve_space(buffer, start + 5, 1)
 
+	# Make sure the CRC-ITU of the descriptor after the tag matches. This is
+	# left to strict mode, as the tag checksum alone catches most damage.
+	# page 3/3 of http://www.ecma-international.org/publications/files/ECMA-ST/Ecma-167.pdf
+	def check_crc(self, buffer, start = 0):
+		data = buffer[start + 16 : start + 16 + self.descriptor_crc_length]
+		if len(data) < self.descriptor_crc_length:
+			raise DescriptorCRCError(self.tag_identifier, self.tag_location,
+				"CRC covers {0} bytes, but buffer only has {1}".format(self.descriptor_crc_length, len(data)))
+
+		crc = binascii.crc_hqx(data, 0)
+		if crc != self.descriptor_crc:
+			raise DescriptorCRCError(self.tag_identifier, self.tag_location,
+				"CRC was {0:04x}, but {1:04x} was expected".format(crc, self.descriptor_crc))
+
 
 # page 3/3 of http://www.ecma-international.org/publications/files/ECMA-ST/Ecma-167.pdf
 class ExtentDescriptor(BaseTag):
@@ -440,7 +463,9 @@ class LongAllocationDescriptor(BaseTag):
 	def __init__(self, buffer, start = 0):
 		super(LongAllocationDescriptor, self).__init__(16, buffer, start)
 
-		self.extent_length = to_uint32(buffer, start + 0)
+		length = to_uint32(buffer, start + 0)
+		self.extent_length = length & 0x3FFFFFFF
+		self.flags = (length >> 30) & 0x3
 		self.extent_location = LogicalBlockAddress(buffer, start + 4)
 		self.implementation_use = buffer[start + 10 : start + 16]
 
@@ -520,7 +545,7 @@ class FileEntry(BaseTag):
 		self.implementation_identifier = EntityID(EntityIdType.ImplementationIdentifier, buffer, start + 128)
 		self.uinque_id = to_uint64(buffer, start + 160)
 		self.length_of_extended_attributes = to_uint32(buffer, start + 168)
-		self.length_of_allocation_descriptors = to_uint32(buffer, start + 173)
+		self.length_of_allocation_descriptors = to_uint32(buffer, start + 172)
 		self.extended_attributes = buffer[start + 176 : start + 176 + self.length_of_extended_attributes]
 		self.allocation_descriptors = buffer[start + 176 + self.length_of_extended_attributes : start + 176 + self.length_of_extended_attributes + self.length_of_allocation_descriptors]
 
@@ -563,14 +588,18 @@ class ICBTag(BaseTag):
 		self._assert_reserve_space(buffer, start + 10, 1)
 
 
+# A run of the file's bytes on the disc. Extents that are allocated but not
+# recorded, or not allocated at all, read as zeros.
 class CookedExtent(object):
-	def __init__(self, file_content_offset, partition, start_pos, length):
+	def __init__(self, file_content_offset, partition, start_pos, length, recorded = True):
 		self.file_content_offset = file_content_offset
 		self.partition = partition
 		self.start_pos = start_pos
 		self.length = length
+		self.recorded = recorded
 
 
+# page 4/36 of http://www.ecma-international.org/publications/files/ECMA-ST/Ecma-167.pdf
 class ShortAllocationDescriptor(BaseTag):
 	def __init__(self, buffer, start = 0):
 		super(ShortAllocationDescriptor, self).__init__(8, buffer, start)
@@ -580,6 +609,32 @@ class ShortAllocationDescriptor(BaseTag):
 		self.flags = (length >> 30) & 0x3
 
 
+# page 4/37 of http://www.ecma-international.org/publications/files/ECMA-ST/Ecma-167.pdf
+class ExtendedAllocationDescriptor(BaseTag):
+	def __init__(self, buffer, start = 0):
+		super(ExtendedAllocationDescriptor, self).__init__(20, buffer, start)
+		length = to_uint32(buffer, start)
+		self.extent_length = length & 0x3FFFFFFF
+		self.flags = (length >> 30) & 0x3
+		self.recorded_length = to_uint32(buffer, start + 4) & 0x3FFFFFFF
+		self.information_length = to_uint32(buffer, start + 8)
+		self.extent_location = LogicalBlockAddress(buffer, start + 12)
+		self.implementation_use = buffer[start + 18 : start + 20]
+
+
+# page 4/32 of http://www.ecma-international.org/publications/files/ECMA-ST/Ecma-167.pdf
+class AllocationExtentDescriptor(BaseTag):
+	def __init__(self, buffer, start = 0):
+		super(AllocationExtentDescriptor, self).__init__(24, buffer, start)
+
+		self.descriptor_tag = DescriptorTag(buffer, start)
+		self._assert_tag_identifier(TagIdentifier.AllocationExtentDescriptor)
+
+		self.previous_allocation_extent_location = to_uint32(buffer, start + 16)
+		self.length_of_allocation_descriptors = to_uint32(buffer, start + 20)
+		self.allocation_descriptors = buffer[start + 24 : start + 24 + self.length_of_allocation_descriptors]
+
+
 class AllocationType(object): # enum
 	short_descriptors = 0
 	long_descriptors = 1
@@ -587,6 +642,22 @@ class AllocationType(object): # enum
 	embedded = 3
 
 
+# The top two bits of an allocation descriptor's length
+# page 4/36 of http://www.ecma-international.org/publications/files/ECMA-ST/Ecma-167.pdf
+class ExtentType(object): # enum
+	recorded = 0
+	allocated = 1
+	unallocated = 2
+	continuation = 3
+
+
+ALLOCATION_DESCRIPTORS = {
+	AllocationType.short_descriptors : ShortAllocationDescriptor,
+	AllocationType.long_descriptors : LongAllocationDescriptor,
+	AllocationType.extended_descriptors : ExtendedAllocationDescriptor,
+}
+
+
 class FileContentBuffer(object):
 	def __init__(self, context, partition, file_entry, block_size):
 		self.context = context
@@ -594,86 +665,151 @@ class FileContentBuffer(object):
 		self.file_entry = file_entry
 		self.block_size = block_size
 		self.extents = None
+		self._extent_starts = None
 
 		self.load_extents()
 
 	def load_extents(self):
 		self.extents = []
-		active_buffer = self.file_entry.allocation_descriptors
+		self._extent_starts = []
 
-		# Short descriptors
+		# Embedded data is in the allocation descriptors' place
 		alloc_type = self.file_entry.icb_tag.allocation_type
-		if alloc_type == AllocationType.short_descriptors:
-			file_pos = 0
+		if alloc_type == AllocationType.embedded:
+			return
+		if alloc_type not in ALLOCATION_DESCRIPTORS:
+			raise NotImplementedError("FIXME: Add support for allocation type {0}".format(alloc_type))
+		descriptor_type = ALLOCATION_DESCRIPTORS[alloc_type]
+
+		# The descriptors can go on in Allocation Extent Descriptors
+		active_buffer = self.file_entry.allocation_descriptors
+		file_pos = 0
+		while active_buffer is not None:
+			next_buffer = None
 			i = 0
 			while i < len(active_buffer):
-				sad = ShortAllocationDescriptor(active_buffer, i)
-				if sad.extent_length == 0:
+				ad = descriptor_type(active_buffer, i)
+				if ad.extent_length == 0:
 					break
-				if sad.flags != 0:
-					raise NotImplementedError("Can't use extents that are not recorded and allocated.")
-
-				new_extent = CookedExtent(file_pos, MAX_INT, sad.extent_location * self.block_size, sad.extent_length)
-				self.extents.append(new_extent)
-				file_pos += sad.extent_length
-				i += sad.size
-		elif alloc_type == AllocationType.embedded:
-			raise NotImplementedError()
-		elif alloc_type == AllocationType.long_descriptors:
-			raise NotImplementedError()
-		else:
-			raise NotImplementedError("FIXME: Add support for allocation type {0}".format(alloc_type))
+				i += ad.size
+
+				partition, block = self._location(ad)
+				if ad.flags == ExtentType.continuation:
+					next_buffer = self._read_allocation_extent(partition, block, ad.extent_length)
+					break
+
+				recorded = ad.flags == ExtentType.recorded
+				self.extents.append(CookedExtent(file_pos, partition, block * self.block_size, ad.extent_length, recorded))
+				self._extent_starts.append(file_pos)
+				file_pos += ad.extent_length
+			active_buffer = next_buffer
+
+	# (partition, logical block) of an allocation descriptor. A short one is
+	# in the file's own partition.
+	def _location(self, ad):
+		location = ad.extent_location
+		if isinstance(location, LogicalBlockAddress):
+			return location.partition_reference_number, location.logical_block_number
+		return MAX_INT, location
+
+	def _partition(self, partition):
+		if partition != MAX_INT:
+			return self.context.logical_partitions[partition]
+		return self.partition
+
+	def _read_allocation_extent(self, partition, block, length):
+		physical_partition = self._partition(partition).physical_partition
+		physical_partition._file.seek(physical_partition._start + block * self.block_size)
+		buffer = physical_partition._file.read(length)
+		aed = AllocationExtentDescriptor(buffer)
+		if self.context.strict:
+			aed.descriptor_tag.check_crc(buffer)
+		return aed.allocation_descriptors
 
 	def get_capacity(self):
 		return self.file_entry.information_length
 	capacity = property(get_capacity)
 
-	def read(self, pos, offset, count):
-		buffer = []
+	# Read bytes from pos into a writable buffer. Returns how many were
+	# read, fewer than asked for only at the end of the file.
+	def readinto(self, pos, buffer):
+		count = max(min(len(buffer), self.capacity - pos), 0)
 		if self.file_entry.icb_tag.allocation_type == AllocationType.embedded:
 			src_buffer = self.file_entry.allocation_descriptors
-			if pos > len(src_buffer):
-				return buffer
+			count = max(min(count, len(src_buffer) - pos), 0)
+			buffer[0 : count] = src_buffer[pos : pos + count]
+			return count
+
+		done = 0
+		i = bisect.bisect_right(self._extent_starts, pos) - 1
+		while done < count and 0 <= i < len(self.extents):
+			extent = self.extents[i]
+			extent_offset = (pos + done) - extent.file_content_offset
+			to_read = min(count - done, extent.length - extent_offset)
+			if to_read <= 0:
+				i += 1
+				continue
 
-			to_copy = min(len(src_buffer) - pos, count)
-			buffer[offset : offset + to_copy] = src_buffer[pos : pos + to_copy]
-			return buffer
-		else:
-			return self.read_from_extents(pos, offset, count)
+			if extent.recorded:
+				physical_partition = self._partition(extent.partition).physical_partition
+				physical_partition._file.seek(physical_partition._start + extent.start_pos + extent_offset)
+				to_read = physical_partition._file.readinto(buffer[done : done + to_read])
+				if not to_read:
+					break
+			else:
+				buffer[done : done + to_read] = bytes(to_read)
+			done += to_read
+
+		return done
+
+	# offset is where in the returned buffer the data would start, and is
+	# kept for the signature DiscUtils has
+	def read(self, pos, offset, count):
+		buffer = bytearray(max(min(count, self.capacity - pos), 0))
+		count = self.readinto(pos, memoryview(buffer))
+		return bytes(buffer[0 : count])
 
 	def read_from_extents(self, pos, offset, count):
-		total_to_read = min(self.capacity - pos, count)
-		total_read = 0
-		buffer = []
+		return self.read(pos, offset, count)
 
-		while total_read < total_to_read:
-			extent = self.find_extent(pos + total_read)
+	def find_extent(self, pos):
+		i = bisect.bisect_right(self._extent_starts, pos) - 1
+		if i < 0 or pos >= self._extent_starts[i] + self.extents[i].length:
+			return None
+		return self.extents[i]
 
-			extent_offset = (pos + total_read) - extent.file_content_offset
-			to_read = min(total_to_read - total_read, extent.length - extent_offset)
 
-			part = None
-			if extent.partition != MAX_INT:
-				part = self.logical_partitions[extent.partition]
-			else:
-				part = self.partition
+# A file in the image as a file object, reading straight from the image
+# into the caller's buffer. It shares the image's file, so isn't thread safe.
+class UdfFileIO(io.RawIOBase):
+	def __init__(self, content):
+		super(UdfFileIO, self).__init__()
+		self._content = content
+		self._pos = 0
+		self.size = content.capacity
 
-			new_pos = extent.start_pos + extent_offset + part.physical_partition._start
-			part.physical_partition._file.seek(new_pos)
-			buffer = part.physical_partition._file.read(to_read)
-			if len(buffer) == 0:
-				return buffer
+	def readable(self):
+		return True
 
-			total_read += len(buffer)
+	def seekable(self):
+		return True
 
-		return buffer
+	def tell(self):
+		return self._pos
 
-	def find_extent(self, pos):
-		for extent in self.extents:
-			if extent.file_content_offset + extent.length > pos:
-				return extent
+	def seek(self, offset, whence = io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			offset += self._pos
+		elif whence == io.SEEK_END:
+			offset += self.size
+		self._pos = max(offset, 0)
+		return self._pos
 
-		return None
+	def readinto(self, buffer):
+		view = memoryview(buffer).cast('B')
+		done = self._content.readinto(self._pos, view)
+		self._pos += done
+		return done
 
 
 class File(object):
@@ -690,12 +826,16 @@ class File(object):
 		root_data_dir = read_extent(context, icb)
 
 		dt = DescriptorTag(root_data_dir)
+		if context.strict:
+			dt.check_crc(root_data_dir)
 		if dt.tag_identifier == TagIdentifier.FileEntry:
 			file_entry = FileEntry(root_data_dir)
 			if file_entry.icb_tag.file_type == FileType.directory:
 				return Directory(context, partition, file_entry)
+			elif file_entry.icb_tag.file_type == FileType.sequence_of_bytes:
+				return File(context, partition, file_entry, partition.logical_block_size)
 			else:
-				raise NotImplementedError("FIXME: Expected a directory not a FileType of {0}".format(file_entry.icb_tag.file_type))
+				raise NotImplementedError("FIXME: Add support for FileType of {0}".format(file_entry.icb_tag.file_type))
 		else:
 			raise NotImplementedError("FIXME: Add the code for handling Tag Identifier {0}".format(dt.tag_identifier))
 
@@ -707,6 +847,13 @@ class File(object):
 		return self.content
 	file_content = property(get_file_content)
 
+	def get_size(self):
+		return self.file_entry.information_length
+	size = property(get_size)
+
+	def open(self):
+		return UdfFileIO(self.file_content)
+
 
 class FileCharacteristic(object): # enum
 	existence = 0x01
@@ -752,6 +899,8 @@ class Directory(File):
 		pos = 0
 		while pos < len(content_bytes):
 			id = FileIdentifierDescriptor(content_bytes, int(pos))
+			if self.context.strict:
+				id.descriptor_tag.check_crc(content_bytes, int(pos))
 
 			if (id.file_characteristics & (FileCharacteristic.deleted | FileCharacteristic.parent)) == 0:
 				self._entries.append(id)
@@ -762,6 +911,42 @@ class Directory(File):
 		return self._entries
 	all_entries = property(get_all_entries)
 
+	# The File or Directory an entry refers to
+	def get_entry(self, name):
+		if not isinstance(name, bytes):
+			name = name.encode('utf-8')
+		for entry in self._entries:
+			if entry.file_identifier == name:
+				return File.from_descriptor(self.context, entry.ICB)
+		raise Exception("No such file '{0}'".format(name.decode('utf-8', 'replace')))
+
+	# Find a file by its path, like "MODULES/IOPRP.IMG"
+	def find(self, path):
+		entry = self
+		for name in [n for n in path.replace('\\', '/').split('/') if n]:
+			if not isinstance(entry, Directory):
+				raise Exception("Not a directory in path '{0}'".format(path))
+			entry = entry.get_entry(name)
+		return entry
+
+	# Open a file by its path, as a file object
+	def open(self, path):
+		entry = self.find(path)
+		if isinstance(entry, Directory):
+			raise Exception("Is a directory '{0}'".format(path))
+		return entry.open()
+
+	# Every File and Directory under this one, as (path, entry), loading
+	# each one's File Entry
+	def walk(self, path = ''):
+		for fid in self._entries:
+			name = path + fid.file_identifier.decode('utf-8', 'replace')
+			entry = File.from_descriptor(self.context, fid.ICB)
+			yield name, entry
+			if isinstance(entry, Directory):
+				for child in entry.walk(name + '/'):
+					yield child
+
 
 def read_extent(context, extent):
 	partition = context.logical_partitions[extent.extent_location.partition_reference_number]
@@ -775,30 +960,23 @@ def read_extent(context, extent):
 
 # FIXME: This assumes the sector size is 2048
 def is_valid_udf(file, file_size):
-	# Move to the start of the file
-	file.seek(0)
-
 	# Make sure there is enough space for a header and sector
-	if file_size < HEADER_SIZE + SECTOR_SIZE:
+	if file_size is not None and file_size < HEADER_SIZE + SECTOR_SIZE:
 		return False
 
-	# Move past 32K of empty space
+	# The whole Volume Recognition Sequence, after 32K of empty space, in
+	# one read
 	file.seek(HEADER_SIZE)
+	buffer = file.read(VRS_SECTORS * SECTOR_SIZE)
 
-	is_valid = True
 	has_bea, has_vsd, has_tea = False, False, False
 
 	# Look at each sector
-	while(is_valid):
-		# Read the next sector
-		buffer = file.read(SECTOR_SIZE)
-		if len(buffer) < SECTOR_SIZE:
-			break
-
+	for start in range(0, len(buffer) - SECTOR_SIZE + 1, SECTOR_SIZE):
 		# Get the sector meta data
-		structure_type = to_uint8(buffer, 0)
-		standard_identifier = buffer[1 : 6]
-		structure_version = to_uint8(buffer, 6)
+		structure_type = to_uint8(buffer, start + 0)
+		standard_identifier = buffer[start + 1 : start + 6]
+		structure_version = to_uint8(buffer, start + 6)
 
 		# Check if we have the beginning, middle, or end
 		if standard_identifier in [b'BEA01']:
@@ -810,134 +988,182 @@ def is_valid_udf(file, file_size):
 		elif standard_identifier in [b'BOOT2', b'CD001', b'CDW02']:
 			pass
 		else:
-			is_valid = False
+			break
 
 	return has_bea and has_vsd and has_tea
 
 
-def get_sector_size(file, file_size):
-	sizes = [4096, 2048, 1024, 512]
-	for size in sizes:
+# The Anchor Volume Descriptor Pointer in a sector, or None
+def _read_anchor(file, sector_size, sector, strict = False):
+	file.seek(sector * sector_size)
+	buffer = file.read(512)
+	try:
+		tag = DescriptorTag(buffer)
+	except Exception:
+		return None
+	if tag.tag_location != sector or tag.tag_identifier != TagIdentifier.AnchorVolumeDescriptorPointer:
+		return None
+	if strict:
+		tag.check_crc(buffer)
+	try:
+		return AnchorVolumeDescriptorPointer(buffer)
+	except Exception:
+		return None
+
+
+# The sector size and the anchor. "3/8.4.2.1" of ECMA-167 puts anchors at
+# sector 256, the last sector and 256 before that. Sector 256 is tried
+# first, with DVD sectors first, and the end of the image only if that
+# fails, for discs that are damaged there. That needs the size, which a
+# gzip'd image doesn't have. In strict mode an anchor with a bad CRC is
+# passed over the same way, and its error raised if no other is found.
+def find_anchor(file, file_size, strict = False):
+	candidates = []
+	for size in ANCHOR_SECTOR_SIZES:
 		# Skip this size if the file is too small for all the sectors
-		if file_size < 257 * size:
+		if file_size is not None and file_size < (ANCHOR_SECTOR + 1) * size:
 			continue
+		candidates.append((size, ANCHOR_SECTOR))
 
-		# Move to the last sector
-		file.seek(256 * size)
+	if file_size is not None:
+		for size in ANCHOR_SECTOR_SIZES:
+			last = file_size // size - 1
+			for sector in [last, last - ANCHOR_SECTOR]:
+				if sector > ANCHOR_SECTOR:
+					candidates.append((size, sector))
 
-		# Read the Descriptor Tag
-		buffer = file.read(16)
-		tag = None
+	error = None
+	for size, sector in candidates:
 		try:
-			tag = DescriptorTag(buffer)
-		# Skip if the tag is not valid
-		except:
+			avdp = _read_anchor(file, size, sector, strict)
+		except DescriptorCRCError as e:
+			error = error or e
 			continue
+		if avdp:
+			return size, avdp
 
-		# Skip if the tag thinks it is at the wrong sector
-		if not tag.tag_location == 256:
-			continue
+	if error:
+		raise error
+	raise Exception("Could not get file sector size.")
 
-		# Skip if the sector is not an Anchor Volume Description Pointer
-		if not tag.tag_identifier == TagIdentifier.AnchorVolumeDescriptorPointer:
-			continue
 
-		# Got the correct size
-		return size
+def get_sector_size(file, file_size):
+	return find_anchor(file, file_size)[0]
+
+
+# The descriptors of a Volume Descriptor Sequence, read an extent at a
+# time and parsed out of the buffer. Returns {tag identifier : [descriptor]}.
+# In strict mode every descriptor's CRC is checked too.
+def read_volume_descriptors(file, sector_size, extent, strict = False):
+	descriptors = {}
+	for hop in range(MAX_VDS_EXTENTS):
+		length = min(extent.extent_length, MAX_VDS_SECTORS * sector_size)
+		file.seek(extent.extent_location * sector_size)
+		buffer = file.read(length)
+
+		next_extent = None
+		for start in range(0, len(buffer) - 16 + 1, sector_size):
+			# Skip if not a valid tag
+			try:
+				tag = DescriptorTag(buffer, start)
+			except Exception:
+				continue
+
+			sector_buffer = buffer[start : start + sector_size]
+			if strict:
+				tag.check_crc(sector_buffer)
+			if tag.tag_identifier == TagIdentifier.PrimaryVolumeDescriptor:
+				desc = PrimaryVolumeDescriptor(sector_buffer)
+			elif tag.tag_identifier == TagIdentifier.AnchorVolumeDescriptorPointer:
+				desc = AnchorVolumeDescriptorPointer(sector_buffer)
+			elif tag.tag_identifier == TagIdentifier.VolumeDescriptorPointer:
+				# The sequence carries on somewhere else
+				next_extent = ExtentDescriptor(sector_buffer, 20)
+				desc = next_extent
+			elif tag.tag_identifier == TagIdentifier.PartitionDescriptor:
+				desc = PartitionDescriptor(sector_buffer)
+			elif tag.tag_identifier == TagIdentifier.LogicalVolumeDescriptor:
+				desc = LogicalVolumeDescriptor(sector_buffer)
+			elif tag.tag_identifier == TagIdentifier.TerminatingDescriptor:
+				desc = TerminatingDescriptor(sector_buffer)
+			elif tag.tag_identifier in [TagIdentifier.ImplementationUseVolumeDescriptor,
+					TagIdentifier.UnallocatedSpaceDescriptor, TagIdentifier.LogicalVolumeIntegrityDescriptor]:
+				desc = None
+			else:
+				raise NotImplementedError("Unexpected Descriptor Tag :{0}".format(tag.tag_identifier))
+
+			descriptors.setdefault(tag.tag_identifier, []).append(desc)
+			if tag.tag_identifier in [TagIdentifier.VolumeDescriptorPointer, TagIdentifier.TerminatingDescriptor]:
+				break
 
-	raise Exception("Could not get file sector size.")
+		if not next_extent or TagIdentifier.TerminatingDescriptor in descriptors:
+			break
+		extent = next_extent
 
+	return descriptors
 
-def read_udf_file(file_name):
+
+def _has_volume(descriptors):
+	return all([identifier in descriptors for identifier in
+		[TagIdentifier.LogicalVolumeDescriptor, TagIdentifier.PartitionDescriptor, TagIdentifier.TerminatingDescriptor]])
+
+
+# Takes a file name or a file object. CSO, ZSO and gzip'd images are read
+# without unpacking them, see image_file.py. strict checks the CRC of
+# every descriptor as it is read, and raises DescriptorCRCError for any
+# that don't match, where otherwise only the tag checksums are checked.
+def read_udf_file(file_name, strict = False):
 	# Make sure the file exists
-	if not os.path.isfile(file_name):
+	if not hasattr(file_name, 'read') and not os.path.isfile(file_name):
 		raise Exception("No such file '{0}'".format(file_name))
 
-	# Open the file
-	file_size = os.path.getsize(file_name)
-	file = open(file_name, 'rb')
+	# Open the file. The size of a gzip'd image isn't known, so is None.
+	file = open_image(file_name)
+	file_size = image_size(file)
 
 	# Make sure the file is valid UDF
 	if not is_valid_udf(file, file_size):
 		raise Exception("Is not a valid UDF file '{0}'".format(file_name))
 
-	# Make sure the file can fit all the sectors
-	sector_size = get_sector_size(file, file_size)
-	if file_size < 257 * sector_size:
-		raise Exception("File is too small to hold all sectors '{0}'".format(file_name))
-
 	# "5.2 UDF Volume Structure and Mount Procedure" of https://sites.google.com/site/udfintro/
-	# Read the Anchor VD Pointer
-	context = UdfContext(file, sector_size)
-	sector = 256
-	file.seek(sector * sector_size)
-	buffer = file.read(512)
-	tag = DescriptorTag(buffer[0 : 16])
-	if not tag.tag_identifier == TagIdentifier.AnchorVolumeDescriptorPointer:
-		raise Exception("The last sector was supposed to be an Archive Volume Descriptor, but was not.")
-	avdp = AnchorVolumeDescriptorPointer(buffer)
-	
-	# Get the location of the primary volume descriptor
-	pvd_sector = avdp.main_volume_descriptor_sequence_extent.extent_location
-		
-	# Look through all the sectors and find the partition descriptor
-	logical_volume_descriptor = None
-	terminating_descriptor = None
-	for sector in range(pvd_sector, 257):
-		# Move to the sector start
-		file.seek(sector * sector_size)
-
-		# Read the Descriptor Tag
-		buffer = file.read(16)
-		tag = None
-		try:
-			tag = DescriptorTag(buffer)
-		# Skip if not valid
-		except:
-			continue
+	# Find the Anchor VD Pointer, which gives the sector size too
+	sector_size, avdp = find_anchor(file, file_size, strict)
+	context = UdfContext(file, sector_size, strict)
 
-		# Move back to the start of the sector
-		file.seek(sector * sector_size)
-		buffer = file.read(512)
-
-		if tag.tag_identifier == TagIdentifier.PrimaryVolumeDescriptor:
-			desc = PrimaryVolumeDescriptor(buffer)
-		elif tag.tag_identifier == TagIdentifier.AnchorVolumeDescriptorPointer:
-			anchor = AnchorVolumeDescriptorPointer(buffer)
-		elif tag.tag_identifier == TagIdentifier.VolumeDescriptorPointer:
-			pass #VolumeDescriptorPointer(buffer)
-		elif tag.tag_identifier == TagIdentifier.ImplementationUseVolumeDescriptor:
-			pass #ImplementationUseVolumeDescriptor(buffer)
-		elif tag.tag_identifier == TagIdentifier.PartitionDescriptor:
-			partition_descriptor = PartitionDescriptor(buffer)
-			start = partition_descriptor.partition_starting_location * sector_size
-			length = partition_descriptor.partition_length * sector_size
-			physical_partition = PhysicalPartition(file, start, length)
-			context.physical_partitions[partition_descriptor.partition_number] = physical_partition
-		elif tag.tag_identifier == TagIdentifier.LogicalVolumeDescriptor:
-			logical_volume_descriptor = LogicalVolumeDescriptor(buffer)
-		elif tag.tag_identifier == TagIdentifier.UnallocatedSpaceDescriptor:
-			pass #UnallocatedSpaceDescriptor(buffer)
-		elif tag.tag_identifier == TagIdentifier.TerminatingDescriptor:
-			terminating_descriptor = TerminatingDescriptor(buffer)
-		elif tag.tag_identifier == TagIdentifier.LogicalVolumeIntegrityDescriptor:
-			pass #LogicalVolumeIntegrityDescriptor(buffer)
-		elif tag.tag_identifier != 0:
-			raise NotImplementedError("Unexpected Descriptor Tag :{0}".format(tag.tag_identifier))
-
-		if logical_volume_descriptor and partition_descriptor and terminating_descriptor:
-			break
+	# Read the main Volume Descriptor Sequence, or the reserve one if the
+	# main one is missing something, or is damaged
+	error = None
+	try:
+		descriptors = read_volume_descriptors(file, sector_size, avdp.main_volume_descriptor_sequence_extent, strict)
+	except DescriptorCRCError as e:
+		descriptors, error = {}, e
+	if not _has_volume(descriptors):
+		try:
+			reserve = read_volume_descriptors(file, sector_size, avdp.reserve_volume_descriptor_sequence_extent, strict)
+		except DescriptorCRCError as e:
+			reserve, error = {}, error or e
+		if _has_volume(reserve):
+			descriptors = reserve
+		elif error:
+			raise error
 
 	# Make sure we have all the segments we need
-	if not logical_volume_descriptor:
+	if TagIdentifier.LogicalVolumeDescriptor not in descriptors:
 		raise Exception("File is missing a Logical Volume Descriptor sector.")
 
-	if not partition_descriptor:
+	if TagIdentifier.PartitionDescriptor not in descriptors:
 		raise Exception("File is missing a Partition Descriptor sector.")
 
-	if not terminating_descriptor:
+	if TagIdentifier.TerminatingDescriptor not in descriptors:
 		raise Exception("File is missing a Terminating Descriptor sector.")
 
+	for partition_descriptor in descriptors[TagIdentifier.PartitionDescriptor]:
+		start = partition_descriptor.partition_starting_location * sector_size
+		length = partition_descriptor.partition_length * sector_size
+		physical_partition = PhysicalPartition(file, start, length)
+		context.physical_partitions[partition_descriptor.partition_number] = physical_partition
+	logical_volume_descriptor = descriptors[TagIdentifier.LogicalVolumeDescriptor][-1]
+
 	# Get all the logical partitions
 	for i in range(len(logical_volume_descriptor.partition_maps)):
 		context.logical_partitions.append(LogicalPartition.from_descriptor(context, logical_volume_descriptor, i))
@@ -950,6 +1176,8 @@ def read_udf_file(file_name):
 		tag = DescriptorTag(fsd_buffer)
 	except:
 		raise Exception("Failed to get Descriptor Tag from Partition Extent.")
+	if strict:
+		tag.check_crc(fsd_buffer)
 
 	# Get the root file information from the extent
 	file_set_descriptor = FileSetDescriptor(fsd_buffer)
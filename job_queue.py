@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# A job queue kept in SQLite, so post-processing survives restarts.
+#
+# The rip stage enqueues a job as soon as the image is on disk and ejects
+# the disc. Workers claim jobs one at a time, and failed jobs are retried
+# with a growing delay until they run out of attempts.
+#
+# A claimed job is leased to the queue that claimed it, which renews the
+# lease while it runs. Only jobs whose lease ran out, because the process
+# that had them died, are put back in the queue, so several processes can
+# share one queue.
+#
+# Usage:
+#   job_queue.py stats jobs.db
+#   job_queue.py retry jobs.db
+
+import sys, os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import traceback
+
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 30
+POLL_INTERVAL = 1
+LEASE_TIME = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+	id INTEGER PRIMARY KEY,
+	stage TEXT NOT NULL,
+	payload TEXT NOT NULL,
+	state TEXT NOT NULL,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	error TEXT,
+	created REAL NOT NULL,
+	run_after REAL NOT NULL,
+	started REAL,
+	finished REAL,
+	owner TEXT,
+	lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, run_after);
+'''
+
+# Columns added since the first version of the table
+NEW_COLUMNS = [('owner', 'TEXT'), ('lease_until', 'REAL')]
+
+
+class JobState(object): # enum
+	queued = 'queued'
+	running = 'running'
+	done = 'done'
+	failed = 'failed'
+
+
+class Job(object):
+	def __init__(self, id, stage, payload, attempts):
+		self.id = id
+		self.stage = stage
+		self.payload = payload
+		self.attempts = attempts
+
+
+class JobQueue(object):
+	def __init__(self, db_name, max_attempts = MAX_ATTEMPTS, retry_delay = RETRY_DELAY, lease_time = LEASE_TIME):
+		self.max_attempts = max_attempts
+		self.retry_delay = retry_delay
+		self.lease_time = lease_time
+		self.owner = uuid.uuid4().hex
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(db_name, timeout = 30, check_same_thread = False, isolation_level = None)
+		self._db.executescript(SCHEMA)
+		columns = [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]
+		for name, column_type in NEW_COLUMNS:
+			if name not in columns:
+				self._db.execute("ALTER TABLE jobs ADD COLUMN {0} {1}".format(name, column_type))
+
+	def close(self):
+		self._db.close()
+
+	# Jobs whose lease ran out go back in the queue. Those are the ones
+	# whose process died, jobs other live processes are running are left.
+	def recover(self):
+		with self._lock:
+			cur = self._db.execute("UPDATE jobs SET state = ?, owner = NULL WHERE state = ? AND (lease_until IS NULL OR lease_until < ?)",
+				(JobState.queued, JobState.running, time.time()))
+			return cur.rowcount
+
+	# Keep the leases on the jobs this queue is running
+	def renew(self):
+		with self._lock:
+			self._db.execute("UPDATE jobs SET lease_until = ? WHERE state = ? AND owner = ?",
+				(time.time() + self.lease_time, JobState.running, self.owner))
+
+	def _insert(self, stage, payload, now):
+		cur = self._db.execute(
+			"INSERT INTO jobs (stage, payload, state, created, run_after) VALUES (?, ?, ?, ?, ?)",
+			(stage, json.dumps(payload), JobState.queued, now, now))
+		return cur.lastrowid
+
+	def enqueue(self, stage, payload):
+		with self._lock:
+			return self._insert(stage, payload, time.time())
+
+	# Take the oldest runnable job for one of the stages, or None
+	def claim(self, stages):
+		marks = ', '.join(['?'] * len(stages))
+		with self._lock:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				row = self._db.execute(
+					"SELECT id, stage, payload, attempts FROM jobs WHERE state = ? AND run_after <= ? AND stage IN ({0}) ORDER BY id LIMIT 1".format(marks),
+					[JobState.queued, time.time()] + list(stages)).fetchone()
+				if row:
+					now = time.time()
+					self._db.execute("UPDATE jobs SET state = ?, started = ?, attempts = attempts + 1, owner = ?, lease_until = ? WHERE id = ?",
+						(JobState.running, now, self.owner, now + self.lease_time, row[0]))
+				self._db.execute("COMMIT")
+			except:
+				self._db.execute("ROLLBACK")
+				raise
+
+		if not row:
+			return None
+		return Job(row[0], row[1], json.loads(row[2]), row[3] + 1)
+
+	# Mark the job done and queue its follow up jobs, all or none of them
+	def complete(self, job, follow_ups = None):
+		now = time.time()
+		with self._lock:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				for stage, payload in follow_ups or []:
+					self._insert(stage, payload, now)
+				self._db.execute("UPDATE jobs SET state = ?, finished = ?, error = NULL WHERE id = ?",
+					(JobState.done, now, job.id))
+				self._db.execute("COMMIT")
+			except:
+				self._db.execute("ROLLBACK")
+				raise
+
+	def fail(self, job, error):
+		now = time.time()
+		with self._lock:
+			if job.attempts >= self.max_attempts:
+				self._db.execute("UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+					(JobState.failed, now, error, job.id))
+			else:
+				self._db.execute("UPDATE jobs SET state = ?, run_after = ?, error = ? WHERE id = ?",
+					(JobState.queued, now + self.retry_delay * job.attempts, error, job.id))
+
+	# Give failed jobs another go
+	def retry_failed(self):
+		with self._lock:
+			cur = self._db.execute("UPDATE jobs SET state = ?, attempts = 0, run_after = ? WHERE state = ?",
+				(JobState.queued, time.time(), JobState.failed))
+			return cur.rowcount
+
+	# Queue depth and latency per stage. wait is the time from enqueue to
+	# start, and run is the time from start to finish, of finished jobs.
+	def stats(self):
+		retval = {}
+		with self._lock:
+			rows = self._db.execute("SELECT stage, state, COUNT(*) FROM jobs GROUP BY stage, state").fetchall()
+			for stage, state, count in rows:
+				retval.setdefault(stage, {'queued' : 0, 'running' : 0, 'done' : 0, 'failed' : 0})[state] = count
+
+			rows = self._db.execute(
+				"SELECT stage, AVG(started - created), AVG(finished - started), MAX(finished - created) FROM jobs WHERE state = ? GROUP BY stage",
+				(JobState.done, )).fetchall()
+			for stage, wait, run, worst in rows:
+				retval[stage]['avg_wait'] = wait
+				retval[stage]['avg_run'] = run
+				retval[stage]['max_latency'] = worst
+
+		return retval
+
+
+# Threads that drain the queue. handlers maps a stage name to a function
+# taking the job payload, which can return a list of (stage, payload)
+# follow up jobs.
+class QueueWorkers(object):
+	def __init__(self, job_queue, handlers, workers = None):
+		self.job_queue = job_queue
+		self.handlers = handlers
+		self.workers = workers or os.cpu_count() or 1
+		self.stopping = threading.Event()
+		self.threads = []
+
+	def run_one(self):
+		job = self.job_queue.claim(list(self.handlers.keys()))
+		if not job:
+			return False
+
+		try:
+			follow_ups = self.handlers[job.stage](job.payload) or []
+		except Exception as e:
+			traceback.print_exc()
+			self.job_queue.fail(job, str(e))
+			return True
+
+		self.job_queue.complete(job, follow_ups)
+		return True
+
+	def _loop(self):
+		while not self.stopping.is_set():
+			if not self.run_one():
+				self.stopping.wait(POLL_INTERVAL)
+
+	# Keeps our leases, and picks up the jobs of a process that died since
+	# we started, once their leases run out
+	def _renew_loop(self):
+		while not self.stopping.wait(self.job_queue.lease_time / 3.0):
+			self.job_queue.renew()
+			self.job_queue.recover()
+
+	def start(self):
+		self.job_queue.recover()
+		for i in range(self.workers):
+			thread = threading.Thread(target = self._loop, name = 'queue-worker-{0}'.format(i))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+		thread = threading.Thread(target = self._renew_loop, name = 'queue-leases')
+		thread.daemon = True
+		thread.start()
+		self.threads.append(thread)
+
+	def stop(self):
+		self.stopping.set()
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+
+
+def print_stats(stats):
+	for stage in sorted(stats):
+		s = stats[stage]
+		line = "{0}: {1} queued, {2} running, {3} done, {4} failed".format(
+			stage, s['queued'], s['running'], s['done'], s['failed'])
+		if s.get('avg_run') is not None:
+			line += ", avg wait {0:.1f} s, avg run {1:.1f} s, max latency {2:.1f} s".format(
+				s['avg_wait'], s['avg_run'], s['max_latency'])
+		print(line)
+
+
+def main(args):
+	if len(args) != 2 or args[0] not in ['stats', 'retry']:
+		print("usage: job_queue.py stats|retry jobs.db")
+		return 1
+
+	job_queue = JobQueue(args[1])
+	if args[0] == 'stats':
+		print_stats(job_queue.stats())
+	else:
+		print("Requeued {0} failed jobs".format(job_queue.retry_failed()))
+	job_queue.close()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
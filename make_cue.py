@@ -0,0 +1,348 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Makes a cue sheet for a raw BIN from the sectors themselves, for BINs
+# whose toc is lost or that toc2cue can't be run on.
+#
+# Every sector is classified, a batch at a time with NumPy: a data sector
+# starts with the 12 byte sync and says its mode in byte 15 (and, for mode
+# 2, its form in the sub-header), anything else is audio. Runs of sectors
+# of the same kind are the tracks.
+#
+# A "--read-subchan rw_raw" rip has the Q sub-channel of every sector,
+# which says which track and index it is in, so with that the track and
+# index boundaries are exact. Without it they are guessed: an audio track
+# after a data track starts with a 2 second pregap of digital silence, and
+# audio tracks are split where there is at least 2 seconds of it, with
+# INDEX 01 where the silence ends and INDEX 00 2 seconds before that. Runs
+# of under 4 seconds, shorter than any track can be, are taken to belong
+# to the track before.
+#
+# Usage:
+#   make_cue.py game.bin [game.cue]
+#   make_cue.py --benchmark [megabytes]
+
+import sys, os
+import io
+import time
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+from toc_file import RAW_SECTOR_SIZE, SUBCHANNEL_SECTOR_SIZE, FRAMES_PER_SECOND, frames_to_msf
+from sector_check import SYNC, CD_SPEED, iter_batches
+from subchannel import q_channel, q_position, LEAD_OUT
+
+PREGAP_SECTORS = 2 * FRAMES_PER_SECOND
+MIN_TRACK_SECTORS = 4 * FRAMES_PER_SECOND
+DETECT_SECTORS = 16
+
+# What each sector is
+SECTOR_AUDIO = 0
+SECTOR_MODE0 = 1
+SECTOR_MODE1 = 2
+SECTOR_FORM1 = 3
+SECTOR_FORM2 = 4
+
+# The cue mode of the track a sector of each kind is in. Mode 0 sectors,
+# which hold only zeros, go with the track around them.
+TRACK_MODES = ['AUDIO', None, 'MODE1/2352', 'MODE2/2352', 'MODE2/2352']
+_TRACK_TYPES = [0, -1, 1, 2, 2]
+
+
+def _need_numpy():
+	if np is None:
+		raise Exception("Making cue sheets needs the numpy module")
+
+
+# Whether a BIN has 2352 or 2448 byte sectors, from its size, and if both
+# fit, from which one finds sync patterns where sectors should start
+def detect_sector_size(f, size):
+	fits = [sector_size for sector_size in [RAW_SECTOR_SIZE, SUBCHANNEL_SECTOR_SIZE] if size % sector_size == 0]
+	if not fits:
+		raise Exception("{0} bytes is neither 2352 nor 2448 byte sectors".format(size))
+	if len(fits) == 1:
+		return fits[0]
+
+	found = []
+	for sector_size in fits:
+		count = 0
+		for i in range(1, DETECT_SECTORS + 1):
+			f.seek(i * sector_size)
+			if f.read(len(SYNC)) == SYNC:
+				count += 1
+		found.append((count, sector_size == RAW_SECTOR_SIZE, sector_size))
+	f.seek(0)
+	return max(found)[2]
+
+
+# (kind, zero) of each sector of an (n, 2352 or more) array: one of the
+# SECTOR_ values, and whether all 2352 bytes are zero
+def classify(sectors):
+	raw = sectors[:, : RAW_SECTOR_SIZE]
+	sync = (raw[:, : len(SYNC)] == np.frombuffer(SYNC, np.uint8)).all(axis = 1)
+	mode = raw[:, 15]
+	form2 = (raw[:, 18] & 0x20) != 0
+	kind = np.full(len(raw), SECTOR_AUDIO, np.int8)
+	kind[sync & (mode == 0)] = SECTOR_MODE0
+	kind[sync & (mode == 1)] = SECTOR_MODE1
+	kind[sync & (mode == 2)] = SECTOR_FORM1
+	kind[sync & (mode == 2) & form2] = SECTOR_FORM2
+	zero = ~raw.view(np.uint64).any(axis = 1)
+	return kind, zero
+
+
+class BinScan(object):
+	def __init__(self, sector_size, kind, zero, q_track = None, q_index = None):
+		self.sector_size = sector_size
+		self.kind = kind
+		self.zero = zero
+		self.q_track = q_track
+		self.q_index = q_index
+
+	def get_count(self):
+		return len(self.kind)
+	count = property(get_count)
+
+	# How many sectors there are of each kind
+	def kind_counts(self):
+		return np.bincount(self.kind, minlength = len(TRACK_MODES))
+
+
+# Classify every sector of a BIN, and read the Q position of each if it
+# has sub-channel data
+def scan_bin(f, size):
+	_need_numpy()
+	sector_size = detect_sector_size(f, size)
+	count = size // sector_size
+	kind = np.empty(count, np.int8)
+	zero = np.empty(count, bool)
+	q_track = q_index = None
+	if sector_size == SUBCHANNEL_SECTOR_SIZE:
+		q_track = np.empty(count, np.int16)
+		q_index = np.empty(count, np.int16)
+
+	for first, sectors in iter_batches(f, count, sector_size, keep_subchannel = True):
+		last = first + len(sectors)
+		kind[first : last], zero[first : last] = classify(sectors)
+		if q_track is not None:
+			q_track[first : last], q_index[first : last] = q_position(q_channel(sectors))[1 : ]
+	return BinScan(sector_size, kind, zero, q_track, q_index)
+
+
+# [(start, end, value)] of the runs of equal values in an array
+def _runs(values):
+	edges = np.nonzero(values[1 : ] != values[ : -1])[0] + 1
+	starts = np.concatenate(([0], edges))
+	ends = np.concatenate((edges, [len(values)]))
+	return list(zip(starts.tolist(), ends.tolist(), values[starts].tolist()))
+
+
+# The track type (audio, mode 1 or mode 2) of each sector, with mode 0
+# sectors taking the type of the sector before them
+def _track_types(kind):
+	types = np.array(_TRACK_TYPES, np.int8)[kind]
+	known = np.where(types >= 0, np.arange(len(types)), 0)
+	np.maximum.accumulate(known, out = known)
+	types = types[known]
+	# Mode 0 sectors at the very start go with the first track
+	if len(types) and types[0] < 0:
+		first = np.nonzero(types >= 0)[0]
+		types[types < 0] = types[first[0]] if len(first) else _TRACK_TYPES[SECTOR_MODE1]
+	return types
+
+
+def _track_mode(kind, start, end):
+	counts = np.bincount(kind[start : end], minlength = len(TRACK_MODES))
+	counts[SECTOR_MODE0] = 0
+	if not counts.any():
+		return TRACK_MODES[SECTOR_MODE1]
+	return TRACK_MODES[int(counts.argmax())]
+
+
+# Tracks from the Q sub-channel. A position is only believed when the
+# sector after it has the same one, and only if it doesn't go backwards.
+def _layout_from_q(scan):
+	valid = (scan.q_track > 0) & (scan.q_track != LEAD_OUT) & (scan.q_index >= 0)
+	key = scan.q_track.astype(np.int32) * 100 + scan.q_index
+	stable = valid.copy()
+	stable[ : -1] &= key[ : -1] == key[1 : ]
+	if not stable.any():
+		return None
+
+	good = np.where(stable, np.arange(scan.count), -1)
+	np.maximum.accumulate(good, out = good)
+	good[good < 0] = np.nonzero(stable)[0][0]
+	key = key[good]
+
+	tracks = []
+	current = -1
+	for start, end, value in _runs(key):
+		if value < current:
+			continue
+		current = value
+		number, index = divmod(value, 100)
+		if not tracks or tracks[-1][0] != number:
+			tracks.append((number, {}))
+		tracks[-1][1][index] = start
+
+	retval = []
+	for i in range(len(tracks)):
+		indexes = tracks[i][1]
+		if 1 not in indexes:
+			indexes[1] = min(indexes.values())
+		end = min(tracks[i + 1][1].values()) if i + 1 < len(tracks) else scan.count
+		retval.append((_track_mode(scan.kind, indexes[1], end), indexes))
+	return retval
+
+
+# Tracks from the sectors alone: where the kind changes, and for audio,
+# where the digital silence is
+def _layout_from_sectors(scan):
+	runs = []
+	for start, end, value in _runs(_track_types(scan.kind)):
+		if runs and (end - start < MIN_TRACK_SECTORS or runs[-1][2] == value):
+			runs[-1] = (runs[-1][0], end, runs[-1][2])
+		elif len(runs) == 1 and runs[0][1] - runs[0][0] < MIN_TRACK_SECTORS:
+			runs[0] = (runs[0][0], end, value)
+		else:
+			runs.append((start, end, value))
+
+	tracks = []
+	for start, end, value in runs:
+		if value != _TRACK_TYPES[SECTOR_AUDIO]:
+			tracks.append((_track_mode(scan.kind, start, end), {1 : start}))
+			continue
+
+		silences = [(s, e) for s, e, is_zero in _runs(scan.zero[start : end]) if is_zero and e - s >= PREGAP_SECTORS]
+		if tracks and silences and silences[0][0] == 0:
+			tracks.append(('AUDIO', {0 : start, 1 : start + PREGAP_SECTORS}))
+		else:
+			tracks.append(('AUDIO', {1 : start}))
+		for s, e in silences:
+			# Silence at the end of the disc is the end of the last track
+			if start + e >= end or start + e - PREGAP_SECTORS <= tracks[-1][1][1]:
+				continue
+			tracks.append(('AUDIO', {0 : start + e - PREGAP_SECTORS, 1 : start + e}))
+	return tracks
+
+
+# [(cue mode, {index : sector})] of each track on the disc
+def infer_tracks(scan):
+	if scan.q_track is not None:
+		tracks = _layout_from_q(scan)
+		if tracks:
+			return tracks
+	return _layout_from_sectors(scan)
+
+
+def format_cue(bin_name, tracks):
+	lines = ['FILE "{0}" BINARY'.format(bin_name)]
+	for number, (mode, indexes) in enumerate(tracks, 1):
+		lines.append("  TRACK {0:02d} {1}".format(number, mode))
+		for index in sorted(indexes):
+			lines.append("    INDEX {0:02d} {1}".format(index, frames_to_msf(indexes[index])))
+	return '\n'.join(lines) + '\n'
+
+
+# The BIN a cue can point at: itself, or for a BIN with sub-channel data
+# the NAME_ns.bin strip_subchannel.py made from it
+def _cue_data_file(bin_name, sector_size):
+	if sector_size == RAW_SECTOR_SIZE:
+		return bin_name
+	base, ext = os.path.splitext(bin_name)
+	ns_bin = base + '_ns' + ext
+	if not os.path.exists(ns_bin):
+		raise Exception("{0} has sub-channel data, which a cue can't describe. strip_subchannel.py makes a BIN without".format(bin_name))
+	return ns_bin
+
+
+# Write a cue for a BIN. Returns (cue name, tracks).
+def make_cue(bin_name, cue_name = None):
+	with open(bin_name, 'rb') as f:
+		scan = scan_bin(f, os.path.getsize(bin_name))
+	tracks = infer_tracks(scan)
+	data_file = _cue_data_file(bin_name, scan.sector_size)
+	if not cue_name:
+		cue_name = os.path.splitext(data_file)[0] + '.cue'
+
+	# The cue refers to the BIN relative to where the cue is
+	cue_dir = os.path.dirname(os.path.abspath(cue_name))
+	relative = os.path.relpath(os.path.abspath(data_file), cue_dir)
+	with open(cue_name + '.part', 'w') as f:
+		f.write(format_cue(relative, tracks))
+	os.rename(cue_name + '.part', cue_name)
+	return cue_name, tracks
+
+
+# A disc of count sectors: a mode 2 data track, then audio tracks with 2
+# second pregaps of silence, with Q sub-channel data if subchannel is set.
+# Returns (image, expected tracks).
+def _benchmark_disc(count, subchannel):
+	data = count * 2 // 5
+	audio = (count - data) // 3
+	starts = [0, data, data + audio, data + audio * 2]
+	expected = [('MODE2/2352', {1 : 0})] + [('AUDIO', {0 : start, 1 : start + PREGAP_SECTORS}) for start in starts[1 : ]]
+
+	sectors = np.frombuffer(os.urandom(count * RAW_SECTOR_SIZE), np.uint8).reshape(count, RAW_SECTOR_SIZE).copy()
+	sectors[ : data, 0 : 12] = np.frombuffer(SYNC, np.uint8)
+	sectors[ : data, 15] = 2
+	sectors[ : data, 18] = sectors[ : data, 22] = np.where(np.arange(data) % 5 == 4, 0x20, 0x08)
+	for start in starts[1 : ]:
+		sectors[start : start + PREGAP_SECTORS] = 0
+	if not subchannel:
+		return sectors.tobytes(), expected
+
+	q = np.zeros((count, 12), np.uint8)
+	q[:, 0] = 0x01
+	q[ : data, 0] |= 0x40
+	for number, start in enumerate(starts, 1):
+		q[start :, 1] = (number // 10) << 4 | number % 10
+		q[start :, 2] = 1 if number == 1 else 0
+		if number > 1:
+			q[start + PREGAP_SECTORS :, 2] = 1
+	sub = np.unpackbits(q, axis = 1) << 6
+	return np.hstack((sectors, sub)).tobytes(), expected
+
+
+def benchmark(megabytes = 64):
+	_need_numpy()
+	for subchannel in [False, True]:
+		sector_size = SUBCHANNEL_SECTOR_SIZE if subchannel else RAW_SECTOR_SIZE
+		count = megabytes * 1024 * 1024 // sector_size
+		image, expected = _benchmark_disc(count, subchannel)
+
+		start = time.time()
+		scan = scan_bin(io.BytesIO(image), len(image))
+		tracks = infer_tracks(scan)
+		elapsed = time.time() - start
+		if scan.sector_size != sector_size or tracks != expected:
+			raise Exception("Found {0} byte sectors {1}, expected {2} {3}".format(scan.sector_size, tracks, sector_size, expected))
+
+		size = len(image) / 1048576.0
+		print("{0} byte sectors{1}: {2} sectors ({3:.1f} MB) in {4:.2f} s, {5:.1f} MB/s, {6:.0f}x CD speed".format(
+			sector_size, ' (tracks from Q)' if subchannel else '', count, size, elapsed, size / elapsed,
+			count * RAW_SECTOR_SIZE / elapsed / CD_SPEED))
+
+
+def main(args):
+	if args and args[0] == '--benchmark':
+		benchmark(*[int(a) for a in args[1 : ]])
+		return 0
+
+	if len(args) not in [1, 2]:
+		print("usage: make_cue.py game.bin [game.cue] | --benchmark [megabytes]")
+		return 1
+
+	cue_name, tracks = make_cue(*args)
+	for number, (mode, indexes) in enumerate(tracks, 1):
+		print("Track {0:02d} {1}: {2}".format(number, mode,
+			', '.join(["INDEX {0:02d} {1}".format(index, frames_to_msf(indexes[index])) for index in sorted(indexes)])))
+	print("Wrote {0}".format(cue_name))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Streams audio tracks from a reader into the encoders through bounded
+# queues, so nothing is ever written to a temp dir.
+#
+# A drive can only read one thing at a time, so for a drive one reader
+# thread walks the tracks in order and pushes chunks into a small queue per
+# track.
+# The encode pool pulls from those queues. When the encoders fall behind
+# the reader blocks on a full queue, and when the drive falls behind the
+# encoders block on an empty one. Tracks from a BIN can be read anywhere
+# at once, so each encode job reads its own track instead, and the time it
+# spends reading and handing chunks to lame is counted the same way. The
+# waits per thread show which side is the bottleneck.
+
+import time
+import queue
+import threading
+import subprocess
+
+from encode_pool import EncodeJob, EncodePool
+
+QUEUE_CHUNKS = 16
+READ_SIZE = 1024 * 64
+PUT_TIMEOUT = 0.5
+
+
+class StageStats(object):
+	def __init__(self, name):
+		self.name = name
+		self.bytes = 0
+		self.busy = 0.0
+		self.blocked = 0.0
+		self._threads = set()
+		self._lock = threading.Lock()
+
+	def add(self, size = 0, busy = 0.0, blocked = 0.0):
+		with self._lock:
+			self.bytes += size
+			self.busy += busy
+			self.blocked += blocked
+			self._threads.add(threading.current_thread().ident)
+
+	# How many threads did the work, and how long each was blocked on
+	# average
+	def get_threads(self):
+		return len(self._threads)
+	threads = property(get_threads)
+
+	def get_blocked_per_thread(self):
+		return self.blocked / max(self.threads, 1)
+	blocked_per_thread = property(get_blocked_per_thread)
+
+	def get_rate(self):
+		if self.busy <= 0:
+			return 0.0
+		return self.bytes / 1048576.0 / self.busy
+	rate = property(get_rate)
+
+	def report(self):
+		return "{0}: {1:.1f} MB, {2:.1f} s busy ({3:.1f} MB/s), {4:.1f} s blocked, {5:.1f} s per thread".format(
+			self.name, self.bytes / 1048576.0, self.busy, self.rate, self.blocked, self.blocked_per_thread)
+
+
+class PipelineAbandoned(Exception):
+	pass
+
+
+# A bounded queue of chunks for one track
+class ChunkQueue(object):
+	def __init__(self, max_chunks = QUEUE_CHUNKS):
+		self._queue = queue.Queue(max_chunks)
+		self.abandoned = False
+
+	def put(self, item):
+		while True:
+			if self.abandoned:
+				raise PipelineAbandoned()
+			try:
+				self._queue.put(item, timeout = PUT_TIMEOUT)
+				return
+			except queue.Full:
+				pass
+
+	def get(self):
+		return self._queue.get()
+
+
+class _End(object):
+	def __init__(self, error = None):
+		self.error = error
+
+
+# Feed every source, in order, into its queue
+def _read_all(sources, queues, stats):
+	for source, chunks in zip(sources, queues):
+		try:
+			it = iter(source())
+			while True:
+				start = time.time()
+				chunk = next(it, None)
+				read_done = time.time()
+				if chunk is None:
+					break
+
+				chunks.put(chunk)
+				stats.add(len(chunk), read_done - start, time.time() - read_done)
+			chunks.put(_End())
+		except PipelineAbandoned:
+			pass
+		except Exception as e:
+			try:
+				chunks.put(_End(e))
+			except PipelineAbandoned:
+				pass
+
+
+# The stream an encode job reads from. Time spent waiting on the queue is
+# time the encoder was starved, and the time between chunks is the time
+# spent handing them to the encoder. The wait for the first chunk is the
+# reader still being on earlier tracks, not this one being slow, so it
+# isn't counted.
+def _drain(chunks, stats):
+	def stream():
+		finished = False
+		started = False
+		try:
+			while True:
+				start = time.time()
+				chunk = chunks.get()
+				got = time.time()
+				if started:
+					stats.add(blocked = got - start)
+				started = True
+
+				if isinstance(chunk, _End):
+					finished = True
+					if chunk.error:
+						raise chunk.error
+					return
+
+				yield chunk
+				stats.add(len(chunk), time.time() - got)
+		finally:
+			if not finished:
+				chunks.abandoned = True
+	return stream
+
+
+# The stream of an encode job that reads its own track. Reading a chunk is
+# the encoder waiting on the reader, and handing it to lame is the reader
+# waiting on the encoder.
+def _direct(source, read_stats, encode_stats):
+	def stream():
+		it = iter(source())
+		while True:
+			start = time.time()
+			chunk = next(it, None)
+			read_done = time.time()
+			if chunk is None:
+				return
+			read_stats.add(len(chunk), read_done - start)
+			encode_stats.add(blocked = read_done - start)
+
+			yield chunk
+			handed = time.time() - read_done
+			read_stats.add(blocked = handed)
+			encode_stats.add(len(chunk), handed)
+	return stream
+
+
+# Encode tracks while reading them. tracks is a list of
+# (short_name, out_name, source) where source() yields the WAV stream.
+# shared_reader reads them all from one thread, in order, for a drive.
+# Otherwise each encode job reads its own track, so they all go at once.
+def encode_streamed(tracks, workers = None, queue_chunks = QUEUE_CHUNKS, executor = None, shared_reader = True):
+	read_stats = StageStats('read')
+	encode_stats = StageStats('encode')
+
+	if not shared_reader:
+		jobs = [EncodeJob(short_name, out_name, stream = _direct(source, read_stats, encode_stats))
+			for short_name, out_name, source in tracks]
+		try:
+			EncodePool(workers, executor).encode_all(jobs)
+		finally:
+			_report(read_stats, encode_stats)
+		return read_stats, encode_stats
+
+	queues = [ChunkQueue(queue_chunks) for t in tracks]
+	jobs = []
+	for (short_name, out_name, source), chunks in zip(tracks, queues):
+		jobs.append(EncodeJob(short_name, out_name, stream = _drain(chunks, encode_stats)))
+
+	reader = threading.Thread(target = _read_all, args = ([t[2] for t in tracks], queues, read_stats))
+	reader.daemon = True
+	reader.start()
+	try:
+		EncodePool(workers, executor).encode_all(jobs)
+	finally:
+		for chunks in queues:
+			chunks.abandoned = True
+		reader.join()
+		_report(read_stats, encode_stats)
+
+	return read_stats, encode_stats
+
+
+# Which side waited on the other more, per thread, as the encoders can
+# be many and the reader one
+def _report(read_stats, encode_stats):
+	print(read_stats.report())
+	print(encode_stats.report())
+	if read_stats.blocked_per_thread > encode_stats.blocked_per_thread:
+		print("The encoders are the bottleneck")
+	else:
+		print("The reader is the bottleneck")
+
+
+# Read a track off the drive with cdparanoia, as a WAV stream on stdout
+def cdparanoia_source(drive, track_number):
+	def source():
+		proc = subprocess.Popen(['cdparanoia', '-q', '-d', drive, '-w', str(track_number), '-'], stdout = subprocess.PIPE)
+		try:
+			while True:
+				chunk = proc.stdout.read(READ_SIZE)
+				if not chunk:
+					break
+				yield chunk
+		finally:
+			proc.stdout.close()
+			if proc.wait() != 0:
+				raise Exception("cdparanoia failed on track {0}".format(track_number))
+	return source
@@ -2,47 +2,55 @@
 
 DRIVE=/dev/sr0
 RIP_PATH=/psx
-TEMP_STOR=/tmp/wav
 
-mkdir -p ${TEMP_STOR}
+# --force rips discs that are already in the library
+FORCE=
+if [ "${1}" == "--force" ]; then
+    FORCE=1
+fi
 
-while sleep 15
+while true
 do
-    udevadm info --query=property ${DRIVE} | grep ID_CDROM_MEDIA=1
-    while [ $? -ne 0 ]
-    do
-	sleep 15
-	echo -n "."
-	udevadm info --query=property ${DRIVE} | grep ID_CDROM_MEDIA=1
-    done
-    sleep 15
+    # Blocks until a readable disc is in the drive, then sets ${DISC[...]}
+    eval "$(./drive_monitor.py --wait ${DRIVE})"
 
-    DISCDATA=$(udevadm info --query=property ${DRIVE})
+    # A few sectors are enough to tell a disc we already have
+    if [ -z "${FORCE}" ] && ./fingerprint.py --check ${RIP_PATH} ${DRIVE}; then
+	./drive_monitor.py --eject ${DRIVE}
+	continue
+    fi
 
-    APP_ID=$(echo ${DISCDATA} | xargs -n1 echo | grep ^ID_FS_APPLICATION_ID= | cut -d = -f2)
-    ID_FS_TYPE=$(echo ${DISCDATA} | xargs -n1 echo | grep ^ID_FS_TYPE= | cut -d = -f2)
+    APP_ID=${DISC[ID_FS_APPLICATION_ID]}
+    ID_FS_TYPE=${DISC[ID_FS_TYPE]}
 
     if [ "${APP_ID}" == "PLAYSTATION" ]; then
 	echo "Type is CD, creating bin/cue"
-	./rip_bincue.bash ${DRIVE} ${RIP_PATH} ${TEMP_STOR} ${APP_ID}_2
+	./rip_bincue.bash ${DRIVE} ${RIP_PATH} ${APP_ID}_2
     elif [ "${ID_FS_TYPE}" == "udf" ]; then
 	echo "Type is UDF, assuming PS2 DVD"
 	mkdir -p ${RIP_PATH}/PLAYSTATION_2
-	ddrescue -b 2048 ${DRIVE} ${RIP_PATH}/ps2_temp_iso.iso
+	# Partial reads are kept by fingerprint, and carried on next time
+	FP=$(./fingerprint.py ${DRIVE})
+	if ! ./rescue.py ${DRIVE} ${RIP_PATH}/.ps_ripper/rescue/${FP} ${RIP_PATH}/ps2_temp_iso.iso; then
+	    echo "Could not read all of the disc, put it back in to carry on"
+	    ./drive_monitor.py --eject ${DRIVE}
+	    continue
+	fi
 	# now do something cool with python
 	DISCNAME=$(./get_ps2_name.py ${RIP_PATH}/ps2_temp_iso.iso)
 	# move the file to PLAYSTATION_2
-	if [ -f "${RIP_PATH}/PLAYSTATION_2/${DISCNAME}.iso" ]; then
+	ISO_NAME="${RIP_PATH}/PLAYSTATION_2/${DISCNAME}.iso"
+	if [ -f "${ISO_NAME}" ]; then
 	    echo "File already exists, making copy"
 	    DS=$(date +%s)
-	    mv ${RIP_PATH}/ps2_temp_iso.iso "${RIP_PATH}/PLAYSTATION_2/${DISCNAME}_${DS}.iso"
-	else
-	    mv ${RIP_PATH}/ps2_temp_iso.iso "${RIP_PATH}/PLAYSTATION_2/${DISCNAME}.iso"
+	    ISO_NAME="${RIP_PATH}/PLAYSTATION_2/${DISCNAME}_${DS}.iso"
 	fi
+	mv ${RIP_PATH}/ps2_temp_iso.iso "${ISO_NAME}"
+	./sparse.py --report "${ISO_NAME}"
+	./fingerprint.py --add ${RIP_PATH} ${DRIVE} "${ISO_NAME}"
 	echo "Finished ${DISCNAME}"
     fi
 
-    sleep 5
-    eject ${DRIVE}
-    sleep 5
+    # Returns once the drive reports the disc is gone
+    ./drive_monitor.py --eject ${DRIVE}
 done
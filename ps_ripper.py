@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Rips from several drives at once.
+#
+# Each drive gets its own thread, which waits for a disc, reads it into the
+# drive's own work dir, queues the rest of the work and ejects it straight
+# away. Everything after the read (toc2cue, lame, identification, moving
+# into the library) runs off a job queue kept in RIP_PATH/.ps_ripper/jobs.db
+# by workers shared by all the drives, so it survives restarts. Writes to
+# the output volume are limited to a few at a time.
+#
+# Usage:
+#   ps_ripper.py [--system psx|ps2] [--workers N] [--io-slots N] [--force] [--compress cso|zso] rip_path drive [drive ...]
+#   job_queue.py stats rip_path/.ps_ripper/jobs.db
+
+import sys, os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from drive_monitor import DriveMonitor, open_backend
+from rip_disc import Ripper, DriveReader, IoLimit, STATE_DIR
+from job_queue import JobQueue, QueueWorkers
+from redump import RedumpIndex, INDEX_NAME
+from fingerprint import DiscLibrary, LIBRARY_NAME
+from rescue import UnreadableSectors
+
+IO_SLOTS = 2
+
+
+class DriveSlot(object):
+	def __init__(self, drive, backend, reader, work_dir):
+		self.drive = drive
+		self.backend = backend
+		self.reader = reader
+		self.work_dir = work_dir
+		self.monitor = DriveMonitor(backend)
+		self.discs = 0
+		self.errors = 0
+
+
+# What to do with a disc, going by its udev properties
+def disc_kind(properties, system):
+	if properties.get('ID_FS_APPLICATION_ID') == 'PLAYSTATION':
+		return 'cd'
+	if system == 'ps2' and properties.get('ID_FS_TYPE') == 'udf':
+		return 'dvd'
+	return None
+
+
+class Scheduler(object):
+	# drives is a list of (drive, backend, reader)
+	def __init__(self, rip_path, drives, system = 'ps2', workers = None, io_slots = IO_SLOTS, force = False, compress = None):
+		self.rip_path = rip_path
+		self.system = system
+		self.force = force
+		cpus = workers or os.cpu_count() or 1
+		state_dir = os.path.join(rip_path, STATE_DIR)
+		if not os.path.isdir(state_dir):
+			os.makedirs(state_dir)
+
+		# Rips are checked against redump once the DATs have been compiled
+		# into RIP_PATH/.ps_ripper/redump.db
+		redump_name = os.path.join(state_dir, INDEX_NAME)
+		self.redump = os.path.exists(redump_name) and RedumpIndex(redump_name) or None
+
+		self.encoders = ThreadPoolExecutor(max_workers = cpus)
+		self.compressors = ThreadPoolExecutor(max_workers = cpus)
+		self.job_queue = JobQueue(os.path.join(state_dir, 'jobs.db'))
+		self.library = DiscLibrary(os.path.join(state_dir, LIBRARY_NAME))
+		self.ripper = Ripper(rip_path, self.encoders, IoLimit(io_slots), self.redump, self.library, force, compress, cpus, self.compressors)
+
+		# At least one worker per drive, so the queue keeps up with the drives
+		handlers = {
+			'cd' : self.ripper.finish_cd,
+			'audio' : self.ripper.encode_audio,
+			'dvd' : self.ripper.finish_dvd,
+		}
+		self.workers = QueueWorkers(self.job_queue, handlers, max(cpus, len(drives)))
+
+		self.slots = []
+		for drive, backend, reader in drives:
+			work_dir = os.path.join(state_dir, 'work', os.path.basename(drive))
+			if not os.path.isdir(work_dir):
+				os.makedirs(work_dir)
+			self.slots.append(DriveSlot(drive, backend, reader, work_dir))
+
+		self.stopping = threading.Event()
+
+	# Read the disc, and return the job that finishes it off
+	def rip(self, slot, properties):
+		kind = disc_kind(properties, self.system)
+		if not kind:
+			return None
+
+		# A few sectors are enough to tell a disc we already have, so it can
+		# be ejected before spending minutes reading all of it. A disc that
+		# can't even be fingerprinted is ripped anyway.
+		try:
+			fingerprint = slot.reader.fingerprint(slot.drive)
+		except (IOError, OSError) as e:
+			print("{0}: Could not fingerprint the disc ({1}), ripping it anyway".format(slot.drive, e))
+			fingerprint = None
+		known = fingerprint and self.library.lookup(fingerprint)
+		if known and not self.force:
+			print("{0}: Already ripped to {1}".format(slot.drive, known))
+			return None
+
+		app_id = 'PLAYSTATION' if self.system == 'psx' else 'PLAYSTATION_2'
+		if kind == 'cd':
+			print("{0}: Type is CD, creating bin/cue".format(slot.drive))
+			return self.ripper.read_cd(slot.drive, slot.reader, slot.work_dir, properties, app_id, fingerprint)
+		print("{0}: Type is UDF, assuming PS2 DVD".format(slot.drive))
+		return self.ripper.read_dvd(slot.drive, slot.reader, slot.work_dir, properties, fingerprint)
+
+	def drive_loop(self, slot):
+		while not self.stopping.is_set():
+			# One wait per disc, which returns None once we are stopping
+			properties = slot.monitor.wait_for_disc(stop = self.stopping)
+			if properties is None:
+				continue
+
+			try:
+				job = self.rip(slot, properties)
+				if job:
+					self.job_queue.enqueue(*job)
+				slot.discs += 1
+			except UnreadableSectors as e:
+				# What was read is kept, the next go only reads what is left
+				slot.errors += 1
+				print("{0}: {1}, put it back in to carry on".format(slot.drive, e))
+			except Exception:
+				slot.errors += 1
+				traceback.print_exc()
+
+			slot.monitor.eject()
+
+	def start(self):
+		self.workers.start()
+		self.threads = []
+		for slot in self.slots:
+			thread = threading.Thread(target = self.drive_loop, args = (slot, ), name = slot.drive)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def stop(self):
+		self.stopping.set()
+		for thread in self.threads:
+			thread.join()
+		self.workers.stop()
+		self.encoders.shutdown()
+		self.compressors.shutdown()
+		self.job_queue.close()
+		self.library.close()
+		if self.redump:
+			self.redump.close()
+		for slot in self.slots:
+			slot.backend.close()
+
+	def run(self):
+		self.start()
+		try:
+			while any([t.is_alive() for t in self.threads]):
+				for thread in self.threads:
+					thread.join(1)
+		except KeyboardInterrupt:
+			pass
+		self.stop()
+
+
+def main(args):
+	options = {'--system' : 'ps2', '--workers' : None, '--io-slots' : IO_SLOTS, '--compress' : None}
+	force = False
+	while args and (args[0] in options or args[0] == '--force'):
+		if args[0] == '--force':
+			force = True
+			args = args[1 : ]
+			continue
+		options[args[0]] = args[1]
+		args = args[2 : ]
+
+	if len(args) < 2 or options['--system'] not in ['psx', 'ps2'] or options['--compress'] not in [None, 'cso', 'zso']:
+		print("usage: ps_ripper.py [--system psx|ps2] [--workers N] [--io-slots N] [--force] [--compress cso|zso] rip_path drive [drive ...]")
+		return 1
+
+	rip_path, drive_names = args[0], args[1 : ]
+	reader = DriveReader()
+	drives = [(drive, open_backend(drive), reader) for drive in drive_names]
+
+	workers = options['--workers'] and int(options['--workers'])
+	scheduler = Scheduler(rip_path, drives, options['--system'], workers, int(options['--io-slots']), force, options['--compress'])
+	scheduler.run()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -2,32 +2,30 @@
 
 DRIVE=/dev/sr0
 RIP_PATH=/psx
-TEMP_STOR=/tmp/wav
 
-mkdir -p ${TEMP_STOR}
+# --force rips discs that are already in the library
+FORCE=
+if [ "${1}" == "--force" ]; then
+    FORCE=1
+fi
 
-while sleep 15
+while true
 do
-    udevadm info --query=property ${DRIVE} | grep ID_CDROM_MEDIA=1
-    while [ $? -ne 0 ]
-    do
-	sleep 15
-	echo -n "."
-	udevadm info --query=property ${DRIVE} | grep ID_CDROM_MEDIA=1
-    done
-    sleep 15
+    # Blocks until a readable disc is in the drive, then sets ${DISC[...]}
+    eval "$(./drive_monitor.py --wait ${DRIVE})"
 
-    DISCDATA=$(udevadm info --query=property ${DRIVE})
+    # A few sectors are enough to tell a disc we already have
+    if [ -z "${FORCE}" ] && ./fingerprint.py --check ${RIP_PATH} ${DRIVE}; then
+	./drive_monitor.py --eject ${DRIVE}
+	continue
+    fi
 
-    APP_ID=$(echo ${DISCDATA} | xargs -n1 echo | grep ^ID_FS_APPLICATION_ID= | cut -d = -f2)
+    APP_ID=${DISC[ID_FS_APPLICATION_ID]}
     if [ "${APP_ID}" == "PLAYSTATION" ]; then
 	echo "Type is CD, creating bin/cue"
-	./rip_bincue.bash ${DRIVE} ${RIP_PATH} ${TEMP_STOR} ${APP_ID}
-	sleep 5
-	eject ${DRIVE}
-	sleep 5
-    else
-	eject ${DRIVE}
+	./rip_bincue.bash ${DRIVE} ${RIP_PATH} ${APP_ID}
     fi
 
+    # Returns once the drive reports the disc is gone
+    ./drive_monitor.py --eject ${DRIVE}
 done
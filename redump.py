@@ -0,0 +1,327 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Checks rips against the redump DAT files.
+#
+# A DAT is an XML file with a <game> for every disc, and a <rom> with the
+# size, CRC32, MD5 and SHA-1 of each of its track files. Rather than scan
+# tens of thousands of them for every image, the DATs are compiled once
+# into an SQLite index keyed on the hashes. Images are checked with the
+# digests already in their manifest (see hashing.py), and are only hashed
+# when there aren't any.
+#
+# A CD is checked a track at a time, as redump has a file per track. A
+# one track disc uses the digests of its BIN as they are.
+#
+# Usage:
+#   redump.py compile index.db dat.xml [dat.xml ...]
+#   redump.py verify index.db image.iso|game_ns.toc|game.cue [...]
+#   redump.py verify-all index.db rip_path
+
+import sys, os
+import time
+import sqlite3
+import threading
+import xml.etree.ElementTree as ElementTree
+
+from toc_file import RAW_SECTOR_SIZE, parse_disc
+from extract_audio import BinFiles, iter_pcm
+from hashing import MultiHasher, hash_file, hash_stream, manifest_name, read_manifest, update_manifest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'identify_playstation2_games'))
+from image_file import open_image
+
+INDEX_NAME = 'redump.db'
+DISC_EXTS = ['.toc', '.cue']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dats (
+	id INTEGER PRIMARY KEY,
+	file TEXT NOT NULL UNIQUE,
+	name TEXT,
+	size INTEGER NOT NULL,
+	mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS roms (
+	dat INTEGER NOT NULL,
+	game TEXT NOT NULL,
+	rom TEXT NOT NULL,
+	size INTEGER,
+	crc32 TEXT,
+	md5 TEXT,
+	sha1 TEXT
+);
+CREATE INDEX IF NOT EXISTS roms_sha1 ON roms (sha1);
+CREATE INDEX IF NOT EXISTS roms_md5 ON roms (md5);
+CREATE INDEX IF NOT EXISTS roms_crc32 ON roms (crc32, size);
+CREATE INDEX IF NOT EXISTS roms_game ON roms (dat, game);
+'''
+
+
+class VerifyStatus(object): # enum
+	verified = 'verified'
+	partial = 'partial'
+	unknown = 'unknown'
+
+
+def _hash_or_none(value):
+	return value.lower() if value else None
+
+
+# Yield (dat name, game, rom, size, crc32, md5, sha1) for every rom in a
+# DAT, without holding the whole tree in memory
+def iter_dat(dat_name):
+	dat_title = None
+	for event, elem in ElementTree.iterparse(dat_name, events = ('end', )):
+		if elem.tag == 'header':
+			name = elem.find('name')
+			dat_title = name.text if name is not None else None
+			elem.clear()
+		elif elem.tag == 'game':
+			game = elem.get('name')
+			for rom in elem.findall('rom'):
+				size = rom.get('size')
+				yield (dat_title, game, rom.get('name'), size and int(size),
+					_hash_or_none(rom.get('crc')), _hash_or_none(rom.get('md5')), _hash_or_none(rom.get('sha1')))
+			elem.clear()
+
+
+class RedumpIndex(object):
+	def __init__(self, db_name):
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(db_name, timeout = 30, check_same_thread = False, isolation_level = None)
+		self._db.executescript(SCHEMA)
+
+	def close(self):
+		self._db.close()
+
+	# Load a DAT into the index, replacing what it had from the same file.
+	# Returns the number of roms, or None if the DAT hasn't changed.
+	def compile_dat(self, dat_name):
+		dat_file = os.path.abspath(dat_name)
+		stat = os.stat(dat_file)
+		with self._lock:
+			row = self._db.execute("SELECT id, size, mtime FROM dats WHERE file = ?", (dat_file, )).fetchone()
+		if row and row[1] == stat.st_size and row[2] == stat.st_mtime:
+			return None
+
+		# The roms go straight from the parser into SQLite, the DAT's name
+		# is filled in once its header has gone past
+		count = [0]
+		dat_title = [None]
+
+		def rows(dat_id):
+			for rom in iter_dat(dat_file):
+				dat_title[0] = rom[0]
+				count[0] += 1
+				yield (dat_id, ) + rom[1 : ]
+
+		with self._lock:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				if row:
+					self._db.execute("DELETE FROM roms WHERE dat = ?", (row[0], ))
+					self._db.execute("DELETE FROM dats WHERE id = ?", (row[0], ))
+				dat_id = self._db.execute("INSERT INTO dats (file, size, mtime) VALUES (?, ?, ?)",
+					(dat_file, stat.st_size, stat.st_mtime)).lastrowid
+				self._db.executemany("INSERT INTO roms (dat, game, rom, size, crc32, md5, sha1) VALUES (?, ?, ?, ?, ?, ?, ?)",
+					rows(dat_id))
+				self._db.execute("UPDATE dats SET name = ? WHERE id = ?", (dat_title[0], dat_id))
+				self._db.execute("COMMIT")
+			except:
+				self._db.execute("ROLLBACK")
+				raise
+		return count[0]
+
+	# The roms matching some digests, as a list of (dat id, dat name, game,
+	# rom). SHA-1 is tried first, then MD5, then CRC32 and size together.
+	def lookup(self, digests):
+		keys = [
+			("roms.sha1 = ?", [digests.get('sha1')]),
+			("roms.md5 = ?", [digests.get('md5')]),
+			("roms.crc32 = ? AND roms.size = ?", [digests.get('crc32'), digests.get('size')]),
+		]
+		with self._lock:
+			for where, values in keys:
+				if None in values:
+					continue
+				rows = self._db.execute(
+					"SELECT dats.id, dats.name, roms.game, roms.rom FROM roms JOIN dats ON dats.id = roms.dat WHERE " + where,
+					values).fetchall()
+				if rows:
+					return rows
+		return []
+
+	# How many track files a game has, leaving out its cue sheet
+	def track_count(self, dat_id, game):
+		with self._lock:
+			return self._db.execute("SELECT COUNT(*) FROM roms WHERE dat = ? AND game = ? AND rom NOT LIKE '%.cue'",
+				(dat_id, game)).fetchone()[0]
+
+
+# Digests of each track of a toc or cue, as redump has them: a file per
+# track, from its pregap to the next track, in little endian
+def hash_tracks(disc_name):
+	disc = parse_disc(disc_name)
+	# A one track disc in a plain BIN is the same as the BIN
+	if len(disc.tracks) == 1 and len(disc.tracks[0].segments) == 1:
+		segment = disc.tracks[0].segments[0]
+		if segment.file_offset == 0 and segment.sector_size == RAW_SECTOR_SIZE and not segment.big_endian and \
+				segment.length * RAW_SECTOR_SIZE == os.path.getsize(segment.data_file):
+			return [file_digests(segment.data_file)]
+
+	bin_files = BinFiles()
+	retval = []
+	try:
+		for track in disc.tracks:
+			hasher = MultiHasher()
+			for chunk in iter_pcm(disc, track.start, track.end, bin_files):
+				hasher.update(chunk)
+			retval.append(hasher.digests())
+	finally:
+		bin_files.close()
+	return retval
+
+
+# The digests of a file from its manifest, hashing it only if they aren't
+# there yet
+def file_digests(file_name):
+	manifest_file = manifest_name(file_name)
+	base_name = os.path.basename(file_name)
+	digests = read_manifest(manifest_file)['files'].get(base_name)
+	if digests and digests.get('size') == os.path.getsize(file_name):
+		return digests
+	# A compressed image has the digests of what it holds
+	if os.path.splitext(file_name)[1].lower() in ['.cso', '.zso']:
+		if not digests:
+			with open_image(file_name) as f:
+				digests = hash_stream(f)
+			update_manifest(manifest_file, {base_name : digests})
+		return digests
+
+	digests = hash_file(file_name)
+	update_manifest(manifest_file, {base_name : digests})
+	return digests
+
+
+def _image_digests(image_name):
+	if os.path.splitext(image_name)[1].lower() not in DISC_EXTS:
+		return [file_digests(image_name)]
+
+	# Track digests are kept in the manifest too, under the toc or cue name
+	manifest_file = manifest_name(image_name)
+	base_name = os.path.basename(image_name)
+	tracks = read_manifest(manifest_file).get('tracks', {})
+	if base_name not in tracks:
+		tracks[base_name] = hash_tracks(image_name)
+		update_manifest(manifest_file, tracks = tracks)
+	return tracks[base_name]
+
+
+# Look up the digests of each track of a disc. Returns {'status', 'title',
+# 'dat', 'tracks'}, where tracks has the matching rom name of each track,
+# or None.
+def verify_digests(index, track_digests):
+	matches = [index.lookup(digests) for digests in track_digests]
+
+	# Every track has to belong to the same game, and the game must not
+	# have any tracks left over
+	games = None
+	for rows in matches:
+		found = set([(row[0], row[1], row[2]) for row in rows])
+		games = found if games is None else games & found
+
+	result = {'status' : VerifyStatus.unknown, 'title' : None, 'dat' : None, 'tracks' : [None] * len(matches)}
+	for dat_id, dat_title, game in sorted(games or []):
+		if index.track_count(dat_id, game) == len(matches):
+			result['status'] = VerifyStatus.verified
+			result['title'], result['dat'] = game, dat_title
+			result['tracks'] = [[row[3] for row in rows if row[0] == dat_id and row[2] == game][0] for rows in matches]
+			break
+	else:
+		if any(matches):
+			result['status'] = VerifyStatus.partial
+			for i in range(len(matches)):
+				if matches[i]:
+					result['tracks'][i] = matches[i][0][3]
+			first = [rows for rows in matches if rows][0][0]
+			result['title'], result['dat'] = first[2], first[1]
+
+	result['checked'] = time.time()
+	return result
+
+
+# Check an image (an iso, or the toc or cue of a CD), and store the result
+# in its manifest
+def verify_image(index, image_name):
+	result = verify_digests(index, _image_digests(image_name))
+	update_manifest(manifest_name(image_name), redump = result)
+	return result
+
+
+# What get_playstation2_game_info says about an image, with the redump
+# result next to it under 'redump'. A verified redump title fills in the
+# title when the image can't be identified by its serial.
+def get_game_info(index, image_name, identify = None):
+	info = {}
+	if identify:
+		try:
+			info = dict(identify(image_name))
+		except Exception as e:
+			info = {'error' : str(e)}
+
+	info['redump'] = verify_image(index, image_name)
+	if info['redump']['status'] == VerifyStatus.verified and not info.get('title'):
+		info['title'] = info['redump']['title']
+	return info
+
+
+# Every image in a library: isos, and the _ns toc of each CD rip
+def find_images(rip_path):
+	for root, dirs, files in os.walk(rip_path):
+		dirs[:] = sorted([d for d in dirs if not d.startswith('.')])
+		for name in sorted(files):
+			if os.path.splitext(name)[1].lower() in ['.iso', '.cso', '.zso'] or name.endswith('_ns.toc'):
+				yield os.path.join(root, name)
+
+
+def verify_all(index, rip_path):
+	counts = {}
+	for image_name in find_images(rip_path):
+		try:
+			result = verify_image(index, image_name)
+		except Exception as e:
+			print("{0}: {1}".format(image_name, e))
+			counts['error'] = counts.get('error', 0) + 1
+			continue
+		print("{0}: {1} {2}".format(image_name, result['status'], result['title'] or ''))
+		counts[result['status']] = counts.get(result['status'], 0) + 1
+	return counts
+
+
+def main(args):
+	if len(args) < 3 or args[0] not in ['compile', 'verify', 'verify-all']:
+		print("usage: redump.py compile index.db dat.xml [...] | verify index.db image [...] | verify-all index.db rip_path")
+		return 1
+
+	index = RedumpIndex(args[1])
+	if args[0] == 'compile':
+		for dat_name in args[2 : ]:
+			count = index.compile_dat(dat_name)
+			if count is None:
+				print("{0}: unchanged".format(dat_name))
+			else:
+				print("{0}: {1} roms".format(dat_name, count))
+	elif args[0] == 'verify':
+		for image_name in args[2 : ]:
+			result = verify_image(index, image_name)
+			print("{0}: {1} {2}".format(image_name, result['status'], result['title'] or ''))
+	else:
+		counts = verify_all(index, args[2])
+		print(', '.join(["{0} {1}".format(count, status) for status, count in sorted(counts.items())]))
+	index.close()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
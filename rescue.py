@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Reads a DVD so that an interrupted or failed read can pick up where it
+# left off.
+#
+# Each disc gets a dir of its own under RIP_PATH/.ps_ripper/rescue, named
+# after its fingerprint (see fingerprint.py), holding the partial image and
+# a ddrescue mapfile. A clean disc is copied straight through, hashing on
+# the way, and the mapfile is kept up to date as it goes. Once the disc has
+# read errors ddrescue takes over from the mapfile, first copying all it
+# can while skipping the bad areas, then going back to scrape them. If
+# sectors are still bad after that, the dir is kept, so the next time the
+# disc goes in only those are read again.
+#
+# Usage:
+#   rescue.py drive rescue_dir image.iso
+#   rescue.py --report mapfile
+
+import sys, os
+import subprocess
+
+from hashing import HashTee, hash_file
+from sparse import SparseWriter
+
+SECTOR_SIZE = 2048
+CHUNK_SIZE = 1024 * 1024 * 4
+SYNC_CHUNKS = 16
+IMAGE_NAME = 'image.iso'
+MAP_NAME = 'image.map'
+BAD_NAME = 'bad_sectors.txt'
+
+# The ddrescue passes, quickest first. The first copies what reads easily
+# and skips past bad areas, the second trims and scrapes them, giving up
+# after 10 minutes without a good read.
+PASSES = [
+	['--no-trim', '--no-scrape'],
+	['--retry-passes=1', '--timeout=10m'],
+]
+
+FINISHED = '+'
+STATUS_NAMES = {
+	'?' : 'non-tried',
+	'*' : 'non-trimmed',
+	'/' : 'non-scraped',
+	'-' : 'bad-sector',
+	'+' : 'finished',
+}
+
+
+# Raised when sectors are still unreadable after the last pass
+class UnreadableSectors(Exception):
+	def __init__(self, drive, ranges):
+		Exception.__init__(self, "{0} has {1} unreadable sectors in {2} ranges".format(
+			drive, sum([count for lba, count, status in ranges]), len(ranges)))
+		self.ranges = ranges
+
+
+# The blocks of a ddrescue mapfile, as (pos, size, status) in bytes
+def read_mapfile(map_name):
+	blocks = []
+	status_line = True
+	with open(map_name, 'r') as f:
+		for line in f:
+			line = line.split('#')[0].strip()
+			if not line:
+				continue
+			# The first line is where ddrescue was up to
+			if status_line:
+				status_line = False
+				continue
+			pos, size, status = line.split()[0 : 3]
+			blocks.append((int(pos, 0), int(size, 0), status))
+	return blocks
+
+
+def write_mapfile(map_name, blocks, current_pos = 0):
+	tmp_name = map_name + '.part'
+	with open(tmp_name, 'w') as f:
+		f.write("# Mapfile. Created by ps_ripper rescue.py\n")
+		f.write("# current_pos  current_status  current_pass\n")
+		f.write("0x{0:08X}     ?               1\n".format(current_pos))
+		f.write("#      pos        size  status\n")
+		for pos, size, status in blocks:
+			f.write("0x{0:08X}  0x{1:08X}  {2}\n".format(pos, size, status))
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(tmp_name, map_name)
+
+
+# The sectors that aren't finished, as (first lba, count, status)
+def bad_ranges(blocks):
+	retval = []
+	for pos, size, status in blocks:
+		if status == FINISHED:
+			continue
+		first = pos // SECTOR_SIZE
+		last = (pos + size + SECTOR_SIZE - 1) // SECTOR_SIZE
+		if retval and retval[-1][0] + retval[-1][1] == first and retval[-1][2] == status:
+			retval[-1] = (retval[-1][0], last - retval[-1][0], status)
+		else:
+			retval.append((first, last - first, status))
+	return retval
+
+
+def format_ranges(ranges):
+	lines = []
+	for lba, count, status in ranges:
+		lines.append("{0}-{1} ({2} sectors, {3})".format(lba, lba + count - 1, count, STATUS_NAMES.get(status, status)))
+	return lines
+
+
+def _device_size(f):
+	size = f.seek(0, os.SEEK_END)
+	f.seek(0)
+	return size
+
+
+# Copy the drive while it reads cleanly, keeping the mapfile up to date so
+# ddrescue can carry on from the first error, or after a crash. Returns
+# the digests, or None if it stopped at an error. Everything read is also
+# written to sink if there is one, see cso.CsoOutput, which is abandoned
+# if the copy stops. Zero blocks are left as holes in the image.
+def copy_with_map(drive, image_name, map_name, sink = None):
+	with open(drive, 'rb') as src, open(image_name, 'wb') as dst:
+		size = _device_size(src)
+		image = SparseWriter(dst)
+		tee = HashTee(image)
+		if sink:
+			sink.open(size)
+		done = 0
+		chunks = 0
+		write_mapfile(map_name, [(0, size, '?')])
+		try:
+			while True:
+				chunk = src.read(CHUNK_SIZE)
+				if not chunk:
+					break
+				tee.write(chunk)
+				if sink:
+					sink.write(chunk)
+				done += len(chunk)
+				chunks += 1
+				if chunks % SYNC_CHUNKS == 0:
+					dst.flush()
+					os.fsync(dst.fileno())
+					write_mapfile(map_name, [(0, done, FINISHED), (done, size - done, '?')], done)
+		except (IOError, OSError) as e:
+			print("{0}: {1} at sector {2}, handing over to ddrescue".format(drive, e, done // SECTOR_SIZE))
+			image.close()
+			os.fsync(dst.fileno())
+			write_mapfile(map_name, [(0, done, FINISHED), (done, size - done, '?')], done)
+			tee.digests()
+			if sink:
+				sink.abandon()
+			return None
+		image.close()
+
+	print("{0}: Wrote {1:.1f} MB of a {2:.1f} MB image, the rest is zeros left as holes".format(
+		drive, image.written / 1048576.0, image.pos / 1048576.0))
+	if sink:
+		sink.close()
+	return tee.digests()
+
+
+def run_passes(drive, image_name, map_name, passes = PASSES):
+	for options in passes:
+		blocks = read_mapfile(map_name)
+		if not bad_ranges(blocks):
+			break
+		cmd = ['ddrescue', '--sparse', '-b', str(SECTOR_SIZE)] + options + [drive, image_name, map_name]
+		if subprocess.call(cmd) != 0:
+			raise Exception("ddrescue failed to read {0}".format(drive))
+	return read_mapfile(map_name)
+
+
+# Read drive into image_name, resuming from what is in rescue_dir. Returns
+# the digests of the image, and raises UnreadableSectors if some sectors
+# couldn't be read, leaving rescue_dir for the next try. sink only gets the
+# image if it reads in one go.
+def rescue(drive, image_name, rescue_dir, sink = None):
+	if not os.path.isdir(rescue_dir):
+		os.makedirs(rescue_dir)
+	partial = os.path.join(rescue_dir, IMAGE_NAME)
+	map_name = os.path.join(rescue_dir, MAP_NAME)
+
+	digests = None
+	if os.path.exists(map_name) and os.path.exists(partial):
+		ranges = bad_ranges(read_mapfile(map_name))
+		print("{0}: Resuming, {1} sectors left to read".format(drive, sum([r[1] for r in ranges])))
+	else:
+		digests = copy_with_map(drive, partial, map_name, sink)
+
+	if digests is None:
+		blocks = run_passes(drive, partial, map_name)
+		ranges = bad_ranges(blocks)
+		if ranges:
+			with open(os.path.join(rescue_dir, BAD_NAME), 'w') as f:
+				f.write('\n'.join(format_ranges(ranges)) + '\n')
+			for line in format_ranges(ranges):
+				print("{0}: bad {1}".format(drive, line))
+			raise UnreadableSectors(drive, ranges)
+		# A sparse image that ends in zeros can come up short
+		size = blocks[-1][0] + blocks[-1][1]
+		if os.path.getsize(partial) < size:
+			os.truncate(partial, size)
+		digests = hash_file(partial)
+
+	os.rename(partial, image_name)
+	for name in [MAP_NAME, BAD_NAME]:
+		if os.path.exists(os.path.join(rescue_dir, name)):
+			os.remove(os.path.join(rescue_dir, name))
+	os.rmdir(rescue_dir)
+	return digests
+
+
+def main(args):
+	if len(args) == 2 and args[0] == '--report':
+		ranges = bad_ranges(read_mapfile(args[1]))
+		for line in format_ranges(ranges):
+			print(line)
+		print("{0} sectors left in {1} ranges".format(sum([r[1] for r in ranges]), len(ranges)))
+		return 0
+
+	if len(args) != 3:
+		print("usage: rescue.py drive rescue_dir image.iso | --report mapfile")
+		return 1
+
+	try:
+		rescue(args[0], args[2], args[1])
+	except UnreadableSectors as e:
+		print(e)
+		return 2
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -2,12 +2,12 @@
 
 DRIVE=${1}
 RIP_PATH=${2}
-TEMP_STOR=${3}
-APP_ID=${4}
+APP_ID=${3}
 
-DISCDATA=$(udevadm info --query=property ${DRIVE})
+# Sets ${DISC[...]} from the udev properties of the drive
+eval "$(./drive_monitor.py --properties ${DRIVE})"
 
-FS_UUID=$(echo ${DISCDATA} | xargs -n1 echo | grep ^ID_FS_UUID= | cut -d = -f2)
+FS_UUID=${DISC[ID_FS_UUID]}
 if [ -z "${FS_UUID}" ]; then
     echo "No UUID Found!"
     FS_UUID=$(date +%s)
@@ -15,17 +15,17 @@ fi
 
 # Now grab fun tags if possible
 
-PUB_ID=$(echo ${DISCDATA} | xargs -n1 echo | grep ^ID_FS_PUBLISHER_ID= | cut -d = -f2)
+PUB_ID=${DISC[ID_FS_PUBLISHER_ID]}
 if [ -z "${PUB_ID}" ]; then
     PUB_ID="Unk_Publisher"
 fi
 
-FS_LABEL=$(echo ${DISCDATA} | xargs -n1 echo | grep ^ID_FS_LABEL= | cut -d = -f2)
+FS_LABEL=${DISC[ID_FS_LABEL]}
 if [ -z "${FS_LABEL}" ]; then
     FS_LABEL="${FS_UUID}"
 fi
 
-AUDIO_COUNT=$(echo ${DISCDATA} | xargs -n1 echo | grep ^ID_CDROM_MEDIA_TRACK_COUNT_AUDIO= | cut -d = -f2)
+AUDIO_COUNT=${DISC[ID_CDROM_MEDIA_TRACK_COUNT_AUDIO]}
 
 FULL_PATH="${RIP_PATH}/${APP_ID}/${PUB_ID}/${FS_LABEL}"
 mkdir -p ${FULL_PATH}
@@ -33,30 +33,26 @@ touch ${FULL_PATH}/${FS_UUID}
 
 echo "Found ${PUB_ID} ${FS_LABEL}"
 
-# Grab both with subchannel data and without
-if [ ! -f "${FULL_PATH}/${FS_LABEL}_ns.bin" ]; then
-    cdrdao read-cd --read-raw --datafile ${FULL_PATH}/${FS_LABEL}_ns.bin --device ${DRIVE} --driver generic-mmc-raw ${FULL_PATH}/${FS_LABEL}_ns.toc
-fi
-
+# Read once with subchannel data, then strip it to get the copy without
 if [ ! -f "${FULL_PATH}/${FS_LABEL}.bin" ]; then
     cdrdao read-cd --read-raw --read-subchan rw_raw --datafile ${FULL_PATH}/${FS_LABEL}.bin --device ${DRIVE} --driver generic-mmc-raw ${FULL_PATH}/${FS_LABEL}.toc
 fi
 
+if [ ! -f "${FULL_PATH}/${FS_LABEL}_ns.bin" ]; then
+    ./strip_subchannel.py ${FULL_PATH}/${FS_LABEL}.toc ${FULL_PATH}/${FS_LABEL}_ns.toc
+fi
+
+# Keep the LibCrypt sectors, if there are any, in a .sbi next to the _ns.cue
+./subchannel.py ${FULL_PATH}/${FS_LABEL}.toc
+
 toc2cue ${FULL_PATH}/${FS_LABEL}_ns.toc ${FULL_PATH}/${FS_LABEL}_ns.cue
 toc2cue ${FULL_PATH}/${FS_LABEL}.toc ${FULL_PATH}/${FS_LABEL}.cue
 
+# The audio tracks are already in the BIN, so encode them from there
 if [ -n "${AUDIO_COUNT}" ]; then
-    MYCWD=${pwd}
-    cd ${TEMP_STOR}
-    rm -f *
-    cdparanoia -Bwd ${DRIVE}
-    for WAV in $(ls -1 *.wav)
-    do
-	SHORT=$(basename ${WAV} .cdda.wav)
-	lame -k -h -m j -v -V 4 ${WAV} ${FULL_PATH}/${SHORT}.mp3
-	rm -f ${WAV}
-    done
-    cd ${MYCWD}
+    ./extract_audio.py ${FULL_PATH}/${FS_LABEL}_ns.toc ${FULL_PATH}
 fi
 
+./fingerprint.py --add ${RIP_PATH} ${DRIVE} ${FULL_PATH}/${FS_LABEL}_ns.toc
+
 echo "Finished ${PUB_ID} ${FS_LABEL}"
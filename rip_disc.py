@@ -0,0 +1,346 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Rips one disc. This does what rip_bincue.bash and the DVD half of
+# ps2_ripper.bash do, for ps_ripper.py to run on several drives at once.
+#
+# Ripping is split in two. The read_* stages need the disc: they read it
+# into a work dir that belongs to the drive, then move the image into a
+# staging dir of its own so the drive is free for the next disc. The
+# finish_* stages run later off the job queue, and move the finished files
+# into the library.
+
+import sys, os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from toc_file import get_data_files, resolve_data_file, FILE_LINE
+from strip_subchannel import strip_toc
+from extract_audio import extract_audio
+from hashing import copy_hashed, follow_file, hash_file, update_manifest, MANIFEST_EXT
+from redump import verify_image, verify_digests, VerifyStatus
+from fingerprint import fingerprint_device, fingerprint_image
+from rescue import rescue
+from cso import CsoOutput, compress_image, output_name
+from sparse import SparseWriter, move_image, format_usage
+from sector_check import check_disc, format_results, HAVE_NUMPY
+from subchannel import make_sbi
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'identify_playstation2_games'))
+
+DVD_TEMP_NAME = 'ps2_temp_iso.iso'
+DVD_OUT_NAME = 'out_name'
+STATE_DIR = '.ps_ripper'
+
+
+# Limits how many drives write to the output volume at the same time
+class IoLimit(object):
+	def __init__(self, slots):
+		self._slots = threading.BoundedSemaphore(slots)
+
+	def __enter__(self):
+		self._slots.acquire()
+		return self
+
+	def __exit__(self, *args):
+		self._slots.release()
+
+
+# Reads real discs with cdrdao and ddrescue. Both return the digests of
+# what they wrote, hashed while the disc was read.
+class DriveReader(object):
+	def fingerprint(self, drive):
+		return fingerprint_device(drive)
+
+	def read_cd(self, drive, work_dir, name):
+		# Run in the work dir so the toc refers to the BIN by a relative
+		# name, and still works once both are moved into the library
+		cmd = ['cdrdao', 'read-cd', '--read-raw', '--read-subchan', 'rw_raw',
+			'--datafile', name + '.bin', '--device', drive, '--driver', 'generic-mmc-raw', name + '.toc']
+		proc = subprocess.Popen(cmd, cwd = work_dir)
+		digests = follow_file(os.path.join(work_dir, name + '.bin'), lambda: proc.poll() is not None)
+		if proc.wait() != 0:
+			raise Exception("cdrdao failed to read {0}".format(drive))
+		return {name + '.bin' : digests}
+
+	# A clean disc reads straight through and is hashed on the way. A disc
+	# with read errors goes to ddrescue, see rescue.py, and carries on from
+	# rescue_dir if it was read before. A clean read is also written to sink.
+	def read_dvd(self, drive, image_name, rescue_dir, sink = None):
+		return {os.path.basename(image_name) : rescue(drive, image_name, rescue_dir, sink)}
+
+
+# Stands in for DriveReader with drive_monitor.SimulatedDrive. The image
+# given to SimulatedDrive.insert is copied instead of read: a .toc and its
+# BIN for CDs, or an .iso for DVDs.
+class FakeReader(object):
+	def __init__(self, backends, delay = 0):
+		self.backends = backends
+		self.delay = delay
+
+	def fingerprint(self, drive):
+		return fingerprint_image(self.backends[drive].image)
+
+	def read_cd(self, drive, work_dir, name):
+		time.sleep(self.delay)
+		src_toc = self.backends[drive].image
+		with open(src_toc, 'r') as f:
+			toc_text = f.read()
+
+		data_files = get_data_files(toc_text)
+		for data_file in data_files:
+			with open(resolve_data_file(src_toc, data_file), 'rb') as src, open(os.path.join(work_dir, name + '.bin'), 'wb') as dst:
+				digests = copy_hashed(src, dst)
+
+		lines = []
+		for line in toc_text.splitlines():
+			m = FILE_LINE.match(line)
+			if m:
+				line = '{0}"{1}"{2}'.format(m.group(1), name + '.bin', m.group(3))
+			lines.append(line)
+
+		with open(os.path.join(work_dir, name + '.toc'), 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		return {name + '.bin' : digests}
+
+	def read_dvd(self, drive, image_name, rescue_dir, sink = None):
+		time.sleep(self.delay)
+		src_name = self.backends[drive].image
+		with open(src_name, 'rb') as src, open(image_name, 'wb') as dst:
+			with SparseWriter(dst) as image:
+				digests = copy_hashed(src, image)
+
+		if sink:
+			sink.open(os.path.getsize(src_name))
+			with open(src_name, 'rb') as src:
+				for chunk in iter(lambda: src.read(1024 * 1024), b''):
+					sink.write(chunk)
+			sink.close()
+		return {os.path.basename(image_name) : digests}
+
+
+# The names rip_bincue.bash gives a CD, from its udev properties
+def cd_names(properties):
+	fs_uuid = properties.get('ID_FS_UUID')
+	if not fs_uuid:
+		print("No UUID Found!")
+		fs_uuid = str(int(time.time()))
+
+	pub_id = properties.get('ID_FS_PUBLISHER_ID') or 'Unk_Publisher'
+	fs_label = properties.get('ID_FS_LABEL') or fs_uuid
+	return fs_uuid, pub_id, fs_label
+
+
+def get_ps2_name(file_name):
+	from identify_playstation2_games import get_playstation2_game_info
+	return get_playstation2_game_info(file_name)['title']
+
+
+class Ripper(object):
+	# encoders is shared by every drive for lame, with encode_workers
+	# workers, and io_limit caps writers to the output volume. Finished rips
+	# are checked against redump if there is a redump.RedumpIndex, and added
+	# to the fingerprint.DiscLibrary if there is one. force rips discs that
+	# are already in the library. compress is 'cso' or 'zso' to store DVDs
+	# compressed, by the compressors executor, or a pool of their own.
+	def __init__(self, rip_path, encoders, io_limit, redump = None, library = None, force = False, compress = None, encode_workers = None, compressors = None):
+		self.rip_path = rip_path
+		self.encoders = encoders
+		self.encode_workers = encode_workers
+		self.compressors = compressors
+		self.io_limit = io_limit
+		self.redump = redump
+		self.library = library
+		self.force = force
+		self.compress = compress
+		self.staging_dir = os.path.join(rip_path, STATE_DIR, 'staged')
+		if not os.path.isdir(self.staging_dir):
+			os.makedirs(self.staging_dir)
+		self._output_lock = threading.Lock()
+
+	# Move a finished read out of the drive's work dir
+	def _stage(self, work_dir, names):
+		staged = tempfile.mkdtemp(prefix = 'job', dir = self.staging_dir)
+		for name in names:
+			os.rename(os.path.join(work_dir, name), os.path.join(staged, name))
+		return staged
+
+	# Returns the follow up job as (stage, payload), or None if there is
+	# nothing to do
+	def read_cd(self, drive, reader, work_dir, properties, app_id, fingerprint = None):
+		fs_uuid, pub_id, fs_label = cd_names(properties)
+		full_path = os.path.join(self.rip_path, app_id, pub_id, fs_label)
+		print("Found {0} {1}".format(pub_id, fs_label))
+
+		with self._output_lock:
+			if os.path.exists(os.path.join(full_path, fs_label + '.bin')) and not self.force:
+				print("{0} is already ripped".format(fs_label))
+				return None
+			if not os.path.isdir(full_path):
+				os.makedirs(full_path)
+			open(os.path.join(full_path, fs_uuid), 'a').close()
+
+		with self.io_limit:
+			hashes = reader.read_cd(drive, work_dir, fs_label)
+
+		staged = self._stage(work_dir, [fs_label + '.bin', fs_label + '.toc'])
+		return 'cd', {
+			'dir' : staged,
+			'full_path' : full_path,
+			'label' : fs_label,
+			'publisher' : pub_id,
+			'audio' : bool(properties.get('ID_CDROM_MEDIA_TRACK_COUNT_AUDIO')),
+			'hashes' : hashes,
+			'fingerprint' : fingerprint,
+		}
+
+	def read_dvd(self, drive, reader, work_dir, properties, fingerprint = None):
+		# Partial reads are kept by fingerprint, so they can be carried on
+		# with whichever drive the disc goes in next
+		image_name = os.path.join(work_dir, DVD_TEMP_NAME)
+		rescue_dir = os.path.join(self.rip_path, STATE_DIR, 'rescue', fingerprint or os.path.basename(drive))
+
+		# The compressed image is written as the disc is read
+		sink = None
+		if self.compress:
+			sink = CsoOutput(output_name(image_name, self.compress), self.compress, self.compressors)
+		with self.io_limit:
+			hashes = reader.read_dvd(drive, image_name, rescue_dir, sink)
+
+		names = [DVD_TEMP_NAME]
+		if sink and sink.done:
+			names.append(os.path.basename(sink.file_name))
+		staged = self._stage(work_dir, names)
+		return 'dvd', {
+			'dir' : staged,
+			'uuid' : cd_names(properties)[0],
+			'digests' : hashes[DVD_TEMP_NAME],
+			'fingerprint' : fingerprint,
+		}
+
+	def _add_to_library(self, job, path, kind):
+		if self.library and job.get('fingerprint'):
+			self.library.add(job['fingerprint'], path, kind)
+
+	# These run off the job queue, and have to cope with being retried
+	# after failing half way
+	def finish_cd(self, job):
+		staged, full_path, fs_label = job['dir'], job['full_path'], job['label']
+		toc_name = os.path.join(staged, fs_label + '.toc')
+		ns_toc_name = os.path.join(staged, fs_label + '_ns.toc')
+
+		if os.path.exists(toc_name):
+			hashes = dict(job.get('hashes') or {})
+			if not os.path.exists(ns_toc_name):
+				with self.io_limit:
+					strip_toc(toc_name, ns_toc_name, hashes)
+			else:
+				# Retried after the strip, so the new BIN wasn't hashed
+				ns_bin = fs_label + '_ns.bin'
+				if os.path.exists(os.path.join(staged, ns_bin)):
+					hashes[ns_bin] = hash_file(os.path.join(staged, ns_bin))
+
+			for name in [toc_name, ns_toc_name]:
+				subprocess.check_call(['toc2cue', name, os.path.splitext(name)[0] + '.cue'])
+
+			# Sectors that came off the drive wrong, by their EDC
+			sections = {}
+			if HAVE_NUMPY:
+				sections['sectors'] = check_disc(ns_toc_name)
+				for line in format_results([r for r in sections['sectors'] if r['bad']]):
+					print("{0}: {1}".format(fs_label, line))
+				# LibCrypt sectors, so the sub-channel BIN needn't be kept
+				result = make_sbi(toc_name)
+				if result['sbi']:
+					print("{0}: {1} LibCrypt sectors, wrote {2}".format(fs_label, len(result['libcrypt']), result['sbi']))
+			update_manifest(os.path.join(staged, fs_label + MANIFEST_EXT), hashes, **sections)
+
+		# Move everything into the library, relative names in the toc keep working
+		with self.io_limit:
+			for name in sorted(os.listdir(staged)):
+				shutil.move(os.path.join(staged, name), os.path.join(full_path, name))
+		os.rmdir(staged)
+
+		self._add_to_library(job, os.path.join(full_path, fs_label + '_ns.toc'), 'cd')
+		print("Finished {0} {1}".format(job['publisher'], fs_label))
+		if self.redump:
+			result = verify_image(self.redump, os.path.join(full_path, fs_label + '_ns.toc'))
+			print("{0}: redump {1} {2}".format(fs_label, result['status'], result['title'] or ''))
+		if job['audio']:
+			return [('audio', {'toc' : os.path.join(full_path, fs_label + '_ns.toc'), 'dir' : full_path})]
+		return []
+
+	def encode_audio(self, job):
+		extract_audio(job['toc'], job['dir'], self.encode_workers, executor = self.encoders)
+
+	def finish_dvd(self, job):
+		out_dir = os.path.join(self.rip_path, 'PLAYSTATION_2')
+		if not os.path.isdir(out_dir):
+			os.makedirs(out_dir)
+
+		image_name = os.path.join(job['dir'], DVD_TEMP_NAME)
+		cso_name = self.compress and output_name(image_name, self.compress)
+
+		# Where the image goes is kept in the job dir before it is moved, so
+		# a retry after the move goes straight on to the manifest
+		marker_name = os.path.join(job['dir'], DVD_OUT_NAME)
+		out_name = None
+		if os.path.exists(marker_name):
+			with open(marker_name, 'r') as f:
+				out_name = f.read()
+
+		digests = job.get('digests') or hash_file(image_name)
+		redump = None
+		if self.redump:
+			redump = verify_digests(self.redump, [digests])
+			print("{0}: redump {1} {2}".format(job['uuid'], redump['status'], redump['title'] or ''))
+
+		if out_name:
+			disc_name = os.path.splitext(os.path.basename(out_name))[0]
+		else:
+			try:
+				disc_name = get_ps2_name(image_name)
+			except Exception as e:
+				print("Could not identify {0}: {1}".format(image_name, e))
+				disc_name = job['uuid']
+				if redump and redump['status'] == VerifyStatus.verified:
+					disc_name = redump['title']
+
+			# A disc that didn't read in one go still has to be compressed
+			if self.compress and not os.path.exists(cso_name):
+				compress_image(image_name, cso_name, self.compress, executor = self.compressors)
+
+		# The lock is only held to pick the name. An empty file keeps it
+		# taken until the image is moved over it.
+		if not out_name:
+			with self._output_lock:
+				ext = '.' + self.compress if self.compress else '.iso'
+				out_name = os.path.join(out_dir, disc_name + ext)
+				if os.path.exists(out_name):
+					print("File already exists, making copy")
+					out_name = os.path.join(out_dir, '{0}_{1}{2}'.format(disc_name, int(time.time()), ext))
+				open(out_name, 'a').close()
+				with open(marker_name + '.part', 'w') as f:
+					f.write(out_name)
+				os.rename(marker_name + '.part', marker_name)
+
+		with self.io_limit:
+			if self.compress:
+				if os.path.exists(cso_name):
+					shutil.move(cso_name, out_name)
+				if os.path.exists(image_name):
+					os.remove(image_name)
+			elif os.path.exists(image_name):
+				move_image(image_name, out_name)
+		sections = {'redump' : redump} if redump else {}
+		update_manifest(os.path.splitext(out_name)[0] + MANIFEST_EXT, {os.path.basename(out_name) : digests}, **sections)
+		self._add_to_library(job, out_name, 'dvd')
+		os.remove(marker_name)
+		os.rmdir(job['dir'])
+		print("Finished {0}".format(disc_name))
+		if not self.compress:
+			print(format_usage(out_name))
+		return []
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Re-hashes the library to catch images that have rotted on disk.
+#
+# Every image in the catalog (see catalog.py) has the files in its manifest
+# read back and hashed, and the digests compared with the ones recorded
+# when it was ripped. Reads are large and sequential, a few images at a
+# time, and kept under a bandwidth cap and at a low I/O priority so a scrub
+# can run next to ps_ripper.py without slowing the rips down.
+#
+# A scrub is one pass over the catalog. Results go in catalog.db as they
+# come in, so a scrub that is stopped carries on with what it hadn't
+# checked yet, until the pass is finished.
+#
+# Usage:
+#   scrub.py [--limit MB/s] [--workers N] [--ionice idle|low|normal] [--restart] rip_path
+#   scrub.py --report rip_path
+
+import sys, os
+import time
+import ctypes
+import sqlite3
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from catalog import open_catalog, CATALOG_NAME
+from hashing import MultiHasher, manifest_name, read_manifest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'identify_playstation2_games'))
+from image_file import open_image
+
+READ_SIZE = 1024 * 1024 * 8
+SCRUB_WORKERS = 2
+LIMIT_MB = 50
+DIGEST_KEYS = ['size', 'crc32', 'md5', 'sha1']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scrub_passes (
+	id INTEGER PRIMARY KEY,
+	started REAL NOT NULL,
+	finished REAL
+);
+CREATE TABLE IF NOT EXISTS scrub_results (
+	path TEXT PRIMARY KEY,
+	pass INTEGER NOT NULL,
+	checked REAL NOT NULL,
+	status TEXT NOT NULL,
+	detail TEXT
+);
+CREATE INDEX IF NOT EXISTS scrub_results_status ON scrub_results (status);
+'''
+
+# linux/ioprio.h
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {
+	'normal' : (2, 4),
+	'low' : (2, 7),
+	'idle' : (3, 0),
+}
+SYS_IOPRIO_SET = {
+	'x86_64' : 251,
+	'i386' : 289,
+	'i686' : 289,
+	'aarch64' : 30,
+	'armv7l' : 314,
+}
+
+
+class ScrubStatus(object): # enum
+	ok = 'ok'
+	mismatch = 'mismatch'
+	missing = 'missing'
+	no_manifest = 'no-manifest'
+	error = 'error'
+
+
+# Set the I/O priority of the calling thread. Linux only, returns False
+# if it couldn't be set.
+def set_io_priority(name):
+	number = SYS_IOPRIO_SET.get(platform.machine())
+	if not number or name not in IOPRIO_CLASSES:
+		return False
+	io_class, level = IOPRIO_CLASSES[name]
+	libc = ctypes.CDLL(None, use_errno = True)
+	return libc.syscall(number, IOPRIO_WHO_PROCESS, 0, (io_class << IOPRIO_CLASS_SHIFT) | level) == 0
+
+
+# A token bucket shared by all the readers, so together they stay under
+# bytes_per_second
+class RateLimiter(object):
+	def __init__(self, bytes_per_second):
+		self.bytes_per_second = bytes_per_second
+		self._lock = threading.Lock()
+		self._next = time.time()
+
+	def wait(self, count):
+		if not self.bytes_per_second:
+			return
+		with self._lock:
+			now = time.time()
+			start = max(self._next, now)
+			self._next = start + count / float(self.bytes_per_second)
+		if start > now:
+			time.sleep(start - now)
+
+
+# Hash a file with large sequential reads. Compressed images are hashed by
+# what they hold, as that is what their manifest has.
+def hash_limited(file_name, limiter):
+	hasher = MultiHasher()
+	with open_image(file_name) as f:
+		while True:
+			chunk = f.read(READ_SIZE)
+			if not chunk:
+				break
+			hasher.update(chunk)
+			limiter.wait(len(chunk))
+	return hasher.digests()
+
+
+# Check every file in an image's manifest. Returns (status, detail).
+def scrub_image(image_name, limiter):
+	if not os.path.exists(image_name):
+		return ScrubStatus.missing, None
+	files = read_manifest(manifest_name(image_name)).get('files')
+	if not files:
+		return ScrubStatus.no_manifest, None
+
+	bad = []
+	dir_name = os.path.dirname(image_name)
+	for name, expected in sorted(files.items()):
+		file_name = os.path.join(dir_name, name)
+		if not os.path.exists(file_name):
+			# A CSO's manifest can still list the iso it was made from
+			continue
+		digests = hash_limited(file_name, limiter)
+		wrong = [key for key in DIGEST_KEYS if key in expected and expected[key] != digests[key]]
+		if wrong:
+			bad.append("{0}: {1} was {2}, now {3}".format(name, wrong[-1], expected[wrong[-1]], digests[wrong[-1]]))
+
+	if bad:
+		return ScrubStatus.mismatch, '; '.join(bad)
+	return ScrubStatus.ok, None
+
+
+class Scrubber(object):
+	def __init__(self, rip_path):
+		self.rip_path = rip_path
+		# The results go next to the images table in catalog.db
+		open_catalog(rip_path).close()
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(os.path.join(rip_path, '.ps_ripper', CATALOG_NAME),
+			timeout = 30, check_same_thread = False, isolation_level = None)
+		self._db.executescript(SCHEMA)
+
+	def close(self):
+		self._db.close()
+
+	# The pass that is under way, or a new one
+	def current_pass(self, restart = False):
+		with self._lock:
+			row = self._db.execute("SELECT id FROM scrub_passes WHERE finished IS NULL ORDER BY id DESC").fetchone()
+			if row and restart:
+				self._db.execute("UPDATE scrub_passes SET finished = ? WHERE id = ?", (time.time(), row[0]))
+				row = None
+			if row:
+				return row[0]
+			return self._db.execute("INSERT INTO scrub_passes (started) VALUES (?)", (time.time(), )).lastrowid
+
+	# The images of the pass that haven't been checked yet
+	def todo(self, pass_id):
+		with self._lock:
+			rows = self._db.execute('''SELECT path FROM images WHERE path NOT IN
+				(SELECT path FROM scrub_results WHERE pass = ?) ORDER BY path''', (pass_id, )).fetchall()
+		return [row[0] for row in rows]
+
+	def record(self, pass_id, path, status, detail):
+		with self._lock:
+			self._db.execute("INSERT OR REPLACE INTO scrub_results (path, pass, checked, status, detail) VALUES (?, ?, ?, ?, ?)",
+				(path, pass_id, time.time(), status, detail))
+
+	def finish(self, pass_id):
+		with self._lock:
+			self._db.execute("UPDATE scrub_passes SET finished = ? WHERE id = ?", (time.time(), pass_id))
+
+	# Everything that didn't come back ok the last time it was checked
+	def problems(self):
+		with self._lock:
+			return self._db.execute("SELECT path, status, detail, checked FROM scrub_results WHERE status != ? ORDER BY path",
+				(ScrubStatus.ok, )).fetchall()
+
+	# Run the pass, or carry on with it. Returns the counts by status.
+	def run(self, limit_mb = LIMIT_MB, workers = SCRUB_WORKERS, ionice = 'idle', restart = False):
+		pass_id = self.current_pass(restart)
+		paths = self.todo(pass_id)
+		limiter = RateLimiter(limit_mb * 1024 * 1024)
+		counts = {}
+
+		def init_worker():
+			if ionice and not set_io_priority(ionice):
+				print("Can't set the I/O priority to {0}".format(ionice))
+
+		def check(path):
+			try:
+				return scrub_image(path, limiter)
+			except Exception as e:
+				return ScrubStatus.error, str(e)
+
+		print("Scrub pass {0}: {1} images to check".format(pass_id, len(paths)))
+		with ThreadPoolExecutor(max_workers = workers, initializer = init_worker) as executor:
+			futures = dict([(executor.submit(check, path), path) for path in paths])
+			for future in as_completed(futures):
+				path = futures[future]
+				status, detail = future.result()
+				self.record(pass_id, path, status, detail)
+				counts[status] = counts.get(status, 0) + 1
+				if status != ScrubStatus.ok:
+					print("{0}: {1} {2}".format(path, status, detail or ''))
+
+		self.finish(pass_id)
+		return counts
+
+
+def main(args):
+	if len(args) == 2 and args[0] == '--report':
+		scrubber = Scrubber(args[1])
+		problems = scrubber.problems()
+		for path, status, detail, checked in problems:
+			print("{0}\t{1}\t{2}\t{3}".format(time.strftime('%Y-%m-%d', time.localtime(checked)), status, path, detail or ''))
+		scrubber.close()
+		return 1 if problems else 0
+
+	options = {'--limit' : LIMIT_MB, '--workers' : SCRUB_WORKERS, '--ionice' : 'idle'}
+	restart = False
+	while args and (args[0] in options or args[0] == '--restart'):
+		if args[0] == '--restart':
+			restart = True
+			args = args[1 : ]
+			continue
+		options[args[0]] = args[1]
+		args = args[2 : ]
+
+	if len(args) != 1 or options['--ionice'] not in IOPRIO_CLASSES:
+		print("usage: scrub.py [--limit MB/s] [--workers N] [--ionice idle|low|normal] [--restart] rip_path | --report rip_path")
+		return 2
+
+	scrubber = Scrubber(args[0])
+	start = time.time()
+	counts = scrubber.run(float(options['--limit']), int(options['--workers']), options['--ionice'], restart)
+	scrubber.close()
+	if not counts:
+		print("Nothing to check, catalog.py scan {0} finds the images".format(args[0]))
+	else:
+		print(', '.join(["{0} {1}".format(count, status) for status, count in sorted(counts.items())]) +
+			" in {0:.1f} s".format(time.time() - start))
+	return 1 if set(counts) - set([ScrubStatus.ok]) else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,323 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Checks the EDC (and optionally the ECC) of every data sector in a raw
+# BIN, to catch sectors that came off the drive wrong before a game trips
+# over them.
+#
+# "cdrdao --read-raw" keeps the whole 2352 byte sector, with the error
+# detection and correction codes the drive would otherwise have checked.
+# Sectors are read a batch at a time into a NumPy array and every sector in
+# the batch is checked at once:
+#
+#   EDC is a CRC-32 with no init or final XOR, so it is linear: the CRC of
+#   a sector is the XOR of what each of its bytes adds on its own, which
+#   depends only on the byte and how far it is from the end. That is a
+#   table lookup per byte for the whole batch, then an XOR reduce.
+#
+#   ECC is the P and Q Reed-Solomon parity of ECMA-130 annex A, computed
+#   for the batch a column at a time, with the sectors side by side.
+#
+# Mode 1 and mode 2 form 1 sectors have both, mode 2 form 2 sectors only
+# have an EDC, which may be zero when the disc didn't set one.
+#
+# Usage:
+#   sector_check.py [--ecc] game.toc|game.cue
+#   sector_check.py --benchmark [megabytes]
+
+import sys, os
+import io
+import time
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+HAVE_NUMPY = np is not None
+
+from toc_file import RAW_SECTOR_SIZE, parse_disc
+
+BATCH_SECTORS = 1024
+SYNC = b'\x00' + b'\xff' * 10 + b'\x00'
+EDC_POLY = 0xD8018001
+CD_SPEED = 75 * RAW_SECTOR_SIZE
+
+# Where the EDC covers and where it is stored, by sector type
+MODE1_EDC = (0, 0x810)
+FORM1_EDC = (0x10, 0x818)
+FORM2_EDC = (0x10, 0x92C)
+ECC_START = 0xC
+ECC_P = 0x81C
+ECC_Q = 0x8C8
+
+# The ways a sector can be bad
+SYNC_ERROR = 'sync'
+MODE_ERROR = 'mode'
+EDC_ERROR = 'edc'
+ECC_ERROR = 'ecc'
+
+_tables = {}
+
+
+def _need_numpy():
+	if np is None:
+		raise Exception("Checking sectors needs the numpy module")
+
+
+# What a byte adds to the EDC, by how many bytes from the end of the data
+# it is. Row 0 is the usual byte-at-a-time CRC table.
+def _edc_tables():
+	if 'edc' not in _tables:
+		table = np.zeros(256, np.uint32)
+		for i in range(256):
+			edc = i
+			for bit in range(8):
+				edc = (edc >> 1) ^ (EDC_POLY if edc & 1 else 0)
+			table[i] = edc
+
+		length = FORM2_EDC[1] - FORM2_EDC[0]
+		tables = np.zeros((length, 256), np.uint32)
+		tables[0] = table
+		for distance in range(1, length):
+			prev = tables[distance - 1]
+			tables[distance] = (prev >> 8) ^ table[prev & 0xFF]
+		_tables['edc'] = tables
+	return _tables['edc']
+
+
+# The EDC of bytes start to end of each sector
+def compute_edc(sectors, start, end):
+	length = end - start
+	tables = _edc_tables()[length - 1 :: -1]
+	values = tables[np.arange(length), sectors[:, start : end]]
+	return np.bitwise_xor.reduce(values, axis = 1)
+
+
+def stored_edc(sectors, offset):
+	return np.ascontiguousarray(sectors[:, offset : offset + 4]).view('<u4')[:, 0]
+
+
+# The index into the data each ECC column reads at each step, as in
+# ecc_computeblock of ECMA-130
+def _ecc_index(major_count, minor_count, major_mult, minor_inc):
+	size = major_count * minor_count
+	index = np.zeros((major_count, minor_count), np.intp)
+	for major in range(major_count):
+		i = (major >> 1) * major_mult + (major & 1)
+		for minor in range(minor_count):
+			index[major, minor] = i
+			i += minor_inc
+			if i >= size:
+				i -= size
+	return index
+
+
+def _ecc_tables():
+	if 'ecc' not in _tables:
+		f_lut = np.zeros(256, np.uint8)
+		b_lut = np.zeros(256, np.uint8)
+		for i in range(256):
+			j = ((i << 1) ^ (0x11D if i & 0x80 else 0)) & 0xFF
+			f_lut[i] = j
+			b_lut[i ^ j] = i
+		_tables['ecc'] = (f_lut, b_lut, _ecc_index(86, 24, 2, 86), _ecc_index(52, 43, 86, 88))
+	return _tables['ecc']
+
+
+def _ecc_block(data, index, f_lut, b_lut):
+	a = np.zeros((len(data), index.shape[0]), np.uint8)
+	b = np.zeros((len(data), index.shape[0]), np.uint8)
+	for minor in range(index.shape[1]):
+		column = data[:, index[:, minor]]
+		a ^= column
+		b ^= column
+		a = f_lut[a]
+	a = b_lut[f_lut[a] ^ b]
+	return np.concatenate([a, a ^ b], axis = 1)
+
+
+# The P and Q parity of each sector, as the 276 bytes from ECC_P on. Mode
+# 2 sectors count their header as zeros.
+def compute_ecc(sectors, zero_header = False):
+	f_lut, b_lut, p_index, q_index = _ecc_tables()
+	data = np.array(sectors[:, ECC_START : ECC_Q])
+	if zero_header:
+		data[:, 0 : 4] = 0
+	p = _ecc_block(data[:, : ECC_P - ECC_START], p_index, f_lut, b_lut)
+	data[:, ECC_P - ECC_START : ] = p
+	q = _ecc_block(data, q_index, f_lut, b_lut)
+	return np.concatenate([p, q], axis = 1)
+
+
+# Check a batch of raw sectors, an (n, 2352) uint8 array. Returns an array
+# with the error of each sector, or None.
+def check_sectors(sectors, ecc = False):
+	errors = np.full(len(sectors), None, object)
+	sync_ok = (sectors[:, 0 : 12] == np.frombuffer(SYNC, np.uint8)).all(axis = 1)
+	mode = sectors[:, 15]
+	form2 = (sectors[:, 18] & 0x20) != 0
+
+	kinds = [
+		(mode == 1, MODE1_EDC, False),
+		((mode == 2) & ~form2, FORM1_EDC, True),
+		((mode == 2) & form2, FORM2_EDC, None),
+	]
+	for selected, (start, end), zero_header in kinds:
+		selected &= sync_ok
+		if not selected.any():
+			continue
+		batch = sectors[selected]
+		bad = compute_edc(batch, start, end) != stored_edc(batch, end)
+		if zero_header is None:
+			# Form 2 sectors don't have to have an EDC
+			bad &= stored_edc(batch, end) != 0
+		kind = np.where(bad, EDC_ERROR, None).astype(object)
+		if ecc and zero_header is not None:
+			ecc_bad = (compute_ecc(batch, zero_header) != batch[:, ECC_P : ]).any(axis = 1)
+			kind = np.where(ecc_bad & ~bad, ECC_ERROR, kind)
+		errors[selected] = kind
+
+	# Mode 0 sectors are all zeros, with nothing to check
+	errors[sync_ok & (mode > 2)] = MODE_ERROR
+	errors[~sync_ok] = SYNC_ERROR
+	return errors
+
+
+# Read a data file a batch of sectors at a time, as (first sector, array).
+# Only the first 2352 bytes of each sector are kept, so a BIN with
+# sub-channel data works too, unless keep_subchannel is set. The array is
+# only good until the next batch is read.
+def iter_batches(f, count, sector_size = RAW_SECTOR_SIZE, batch_sectors = BATCH_SECTORS, keep_subchannel = False):
+	buffer = bytearray(batch_sectors * sector_size)
+	width = sector_size if keep_subchannel else RAW_SECTOR_SIZE
+	done = 0
+	while done < count:
+		n = min(batch_sectors, count - done)
+		size = f.readinto(memoryview(buffer)[ : n * sector_size])
+		n = size // sector_size
+		if not n:
+			break
+		yield done, np.frombuffer(buffer, np.uint8, n * sector_size).reshape(n, sector_size)[:, : width]
+		done += n
+
+
+# [(first lba, count, error)] from a list of (lba, error)
+def _ranges(bad):
+	retval = []
+	for lba, error in bad:
+		if retval and retval[-1][0] + retval[-1][1] == lba and retval[-1][2] == error:
+			retval[-1] = (retval[-1][0], retval[-1][1] + 1, error)
+		else:
+			retval.append((lba, 1, error))
+	return retval
+
+
+# Check every data track of a disc. Returns a list with a dict for each
+# track: number, mode, sectors checked, and bad, the bad ranges as
+# (first lba, count, error).
+def check_disc(disc_name, ecc = False):
+	_need_numpy()
+	disc = parse_disc(disc_name)
+	results = []
+	for track in disc.tracks:
+		if track.is_audio:
+			continue
+		result = {'number' : track.number, 'mode' : track.mode, 'sectors' : 0, 'bad' : []}
+		bad = []
+		for segment in track.segments:
+			# Cooked sectors have already lost their EDC
+			if segment.data_file is None or segment.sector_size < RAW_SECTOR_SIZE:
+				continue
+			with open(segment.data_file, 'rb') as f:
+				f.seek(segment.file_offset)
+				for first, sectors in iter_batches(f, segment.length, segment.sector_size):
+					errors = check_sectors(sectors, ecc)
+					for i in np.nonzero(errors != None)[0]:
+						bad.append((segment.start + first + int(i), errors[i]))
+					result['sectors'] += len(sectors)
+		result['bad'] = _ranges(bad)
+		results.append(result)
+	return results
+
+
+def format_results(results):
+	lines = []
+	for result in results:
+		count = sum([r[1] for r in result['bad']])
+		lines.append("Track {0:02d} {1}: {2} sectors, {3} bad".format(result['number'], result['mode'], result['sectors'], count))
+		for lba, length, error in result['bad']:
+			lines.append("  {0}-{1} ({2} sectors, {3})".format(lba, lba + length - 1, length, error))
+	return lines
+
+
+# Valid sectors to check: mode 1, mode 2 form 1 and form 2, in turn
+def _benchmark_sectors(count):
+	sectors = np.frombuffer(os.urandom(count * RAW_SECTOR_SIZE), np.uint8).reshape(count, RAW_SECTOR_SIZE).copy()
+	sectors[:, 0 : 12] = np.frombuffer(SYNC, np.uint8)
+	sectors[:, 15] = np.where(np.arange(count) % 3 == 0, 1, 2)
+	submode = np.where(np.arange(count) % 3 == 2, 0x20, 0x08).astype(np.uint8)
+	sectors[:, 18] = sectors[:, 22] = submode
+	sectors[:, 16] = sectors[:, 20] = 0
+	sectors[:, 17] = sectors[:, 21] = 0
+	sectors[:, 19] = sectors[:, 23] = 0
+
+	for mode, form2, (start, end), zero_header in [(1, False, MODE1_EDC, False), (2, False, FORM1_EDC, True), (2, True, FORM2_EDC, None)]:
+		selected = (sectors[:, 15] == mode) & (((sectors[:, 18] & 0x20) != 0) == form2)
+		batch = sectors[selected]
+		if mode == 1:
+			batch[:, 0x814 : 0x81C] = 0
+		batch[:, end : end + 4] = compute_edc(batch, start, end).astype('<u4').view(np.uint8).reshape(-1, 4)
+		if zero_header is not None:
+			batch[:, ECC_P : ] = compute_ecc(batch, zero_header)
+		sectors[selected] = batch
+	return sectors
+
+
+def benchmark(megabytes = 64):
+	_need_numpy()
+	count = megabytes * 1024 * 1024 // RAW_SECTOR_SIZE
+	sectors = _benchmark_sectors(count)
+
+	# A few broken sectors, which have to be found
+	broken = [10, 11, count // 2, count - 1]
+	for i in broken:
+		sectors[i, 100] ^= 0xFF
+	image = sectors.tobytes()
+
+	size = len(image) / 1048576.0
+	for ecc in [False, True]:
+		start = time.time()
+		found = []
+		for first, batch in iter_batches(io.BytesIO(image), count):
+			errors = check_sectors(batch, ecc)
+			found += [first + int(i) for i in np.nonzero(errors != None)[0]]
+		elapsed = time.time() - start
+		if found != broken:
+			raise Exception("Found bad sectors {0}, expected {1}".format(found, broken))
+		print("{0}: {1} sectors ({2:.1f} MB) in {3:.2f} s, {4:.1f} MB/s, {5:.0f}x CD speed".format(
+			'EDC + ECC' if ecc else 'EDC', count, size, elapsed, size / elapsed, len(image) / elapsed / CD_SPEED))
+
+
+def main(args):
+	if args and args[0] == '--benchmark':
+		benchmark(*[int(a) for a in args[1 : ]])
+		return 0
+
+	ecc = False
+	if args and args[0] == '--ecc':
+		ecc = True
+		args = args[1 : ]
+
+	if len(args) != 1:
+		print("usage: sector_check.py [--ecc] game.toc|game.cue | --benchmark [megabytes]")
+		return 1
+
+	results = check_disc(args[0], ecc)
+	for line in format_results(results):
+		print(line)
+	return 1 if any([result['bad'] for result in results]) else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Keeps the runs of zeros in disc images out of the file system.
+#
+# PS2 DVDs are padded out with hundreds of MB of zeroed sectors. As an
+# image is written, each block is compared against a block of zeros (a
+# memcmp, that stops at the first byte that isn't zero) and zero blocks are
+# seeked over instead of written, which leaves a hole in the file. Images
+# that were written in full, by ddrescue or before this, can have their
+# zero blocks turned into holes afterwards with fallocate.
+#
+# Holes read back as zeros, so the image and its hashes don't change, only
+# the space it takes on disk.
+#
+# Usage:
+#   sparse.py image.iso [image.iso ...]    punch holes and report the savings
+#   sparse.py --report image.iso [...]
+
+import sys, os
+import errno
+import ctypes
+import ctypes.util
+
+BLOCK_SIZE = 4096
+CHUNK_SIZE = 1024 * 1024 * 4
+
+# linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_fallocate = None
+
+
+# [(start, end)] of the whole zero blocks in data, as offsets into it
+def zero_runs(data, block_size = BLOCK_SIZE, zero_block = None):
+	zero_block = zero_block or bytes(block_size)
+	runs = []
+	for i in range(0, len(data) - block_size + 1, block_size):
+		if data.startswith(zero_block, i):
+			if runs and runs[-1][1] == i:
+				runs[-1] = (runs[-1][0], i + block_size)
+			else:
+				runs.append((i, i + block_size))
+	return runs
+
+
+# A file object that seeks over zero blocks instead of writing them. f has
+# to be seekable, and close() has to be called so a run of zeros at the end
+# still gives the file its full size. f itself is left open.
+class SparseWriter(object):
+	def __init__(self, f, block_size = BLOCK_SIZE):
+		self.f = f
+		self.block_size = block_size
+		self.pos = 0
+		self.written = 0
+		self._zero_block = bytes(block_size)
+
+	def write(self, data):
+		view = memoryview(data)
+		done = 0
+		for start, end in zero_runs(data, self.block_size, self._zero_block):
+			if start > done:
+				self.f.write(view[done : start])
+				self.written += start - done
+			self.f.seek(end - start, os.SEEK_CUR)
+			done = end
+		if done < len(data):
+			self.f.write(view[done : ])
+			self.written += len(data) - done
+		self.pos += len(data)
+		return len(data)
+
+	def writelines(self, lines):
+		self.write(b''.join(lines))
+
+	def flush(self):
+		self.f.flush()
+
+	def fileno(self):
+		return self.f.fileno()
+
+	def close(self):
+		self.f.truncate(self.pos)
+		self.f.flush()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+
+def _get_fallocate():
+	global _fallocate
+	if not _fallocate:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+		_fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+		_fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+		_fallocate.restype = ctypes.c_int
+	return _fallocate
+
+
+def punch_hole(fd, offset, length):
+	if _get_fallocate()(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+		e = ctypes.get_errno()
+		raise OSError(e, os.strerror(e))
+
+
+# Turn the zero blocks of a finished image into holes. Returns the number
+# of bytes of zeros found. Raises OSError with EOPNOTSUPP if the file
+# system can't do it.
+def punch_holes(file_name, block_size = BLOCK_SIZE):
+	zero_block = bytes(block_size)
+	punched = 0
+	run_start, run_end = None, None
+	with open(file_name, 'r+b') as f:
+		fd = f.fileno()
+		pos = 0
+		while True:
+			chunk = f.read(CHUNK_SIZE)
+			if not chunk:
+				break
+			# Runs carry on across chunks, so there is one call per run
+			for start, end in zero_runs(chunk, block_size, zero_block):
+				if run_end == pos + start:
+					run_end = pos + end
+					continue
+				if run_start is not None:
+					punch_hole(fd, run_start, run_end - run_start)
+					punched += run_end - run_start
+				run_start, run_end = pos + start, pos + end
+			pos += len(chunk)
+		if run_start is not None:
+			punch_hole(fd, run_start, run_end - run_start)
+			punched += run_end - run_start
+	return punched
+
+
+# (logical size, bytes it takes on disk)
+def disk_usage(file_name):
+	st = os.stat(file_name)
+	return st.st_size, st.st_blocks * 512
+
+
+def format_usage(file_name):
+	size, used = disk_usage(file_name)
+	return "{0}: {1:.1f} MB on disk for a {2:.1f} MB image, {3:.1f} MB in holes".format(
+		file_name, used / 1048576.0, size / 1048576.0, max(size - used, 0) / 1048576.0)
+
+
+# Move an image, keeping its holes when it has to be copied to another
+# file system
+def move_image(src_name, dst_name):
+	try:
+		os.rename(src_name, dst_name)
+		return
+	except OSError as e:
+		if e.errno != errno.EXDEV:
+			raise
+
+	tmp_name = dst_name + '.part'
+	with open(src_name, 'rb') as src, open(tmp_name, 'wb') as dst:
+		with SparseWriter(dst) as writer:
+			while True:
+				chunk = src.read(CHUNK_SIZE)
+				if not chunk:
+					break
+				writer.write(chunk)
+	os.rename(tmp_name, dst_name)
+	os.remove(src_name)
+
+
+def main(args):
+	report_only = False
+	if args and args[0] == '--report':
+		report_only = True
+		args = args[1 : ]
+
+	if not args:
+		print("usage: sparse.py [--report] image [image ...]")
+		return 1
+
+	for file_name in args:
+		if not report_only:
+			try:
+				punch_holes(file_name)
+			except OSError as e:
+				print("{0}: Can't punch holes: {1}".format(file_name, e))
+				return 2
+		print(format_usage(file_name))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
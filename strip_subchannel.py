@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Makes the plain 2352 byte/sector BIN and toc from a rip that was read with
+# "--read-subchan rw_raw", so the disc only has to be read once.
+#
+# Usage:
+#   strip_subchannel.py game.toc game_ns.toc
+#   strip_subchannel.py --benchmark [megabytes]
+
+import sys, os
+import io
+import time
+
+from toc_file import RAW_SECTOR_SIZE, SUBCHANNEL_SECTOR_SIZE
+from toc_file import get_data_files, strip_subchannel_toc, resolve_data_file
+from hashing import HashTee
+
+SECTORS_PER_CHUNK = 1024
+
+
+# Copy src to dst, dropping the 96 bytes of sub-channel after every sector
+def strip_stream(src, dst, sectors_per_chunk = SECTORS_PER_CHUNK):
+	chunk = bytearray(sectors_per_chunk * SUBCHANNEL_SECTOR_SIZE)
+	view = memoryview(chunk)
+	total = 0
+
+	while True:
+		size = src.readinto(chunk)
+		if not size:
+			break
+
+		# Keep reading until the chunk ends on a sector boundary
+		while size % SUBCHANNEL_SECTOR_SIZE:
+			more = src.readinto(view[size : ])
+			if not more:
+				raise Exception("Image ends in the middle of a sector")
+			size += more
+
+		dst.writelines([view[i : i + RAW_SECTOR_SIZE] for i in range(0, size, SUBCHANNEL_SECTOR_SIZE)])
+		total += size // SUBCHANNEL_SECTOR_SIZE
+
+	return total
+
+
+# Returns the number of sectors, and the digests of the new BIN if hashed
+def strip_file(src_name, dst_name, hashed = False):
+	# Write to a temp name so an interrupted run never leaves a short BIN
+	# that looks finished to rip_bincue.bash
+	tmp_name = dst_name + '.part'
+	digests = None
+	with open(src_name, 'rb') as src, open(tmp_name, 'wb') as dst:
+		if hashed:
+			tee = HashTee(dst)
+			sectors = strip_stream(src, tee)
+			digests = tee.digests()
+		else:
+			sectors = strip_stream(src, dst)
+	os.rename(tmp_name, dst_name)
+	return sectors, digests
+
+
+# If hashes is a dict, the digests of each new BIN are put in it
+def strip_toc(src_toc, dst_toc, hashes = None):
+	with open(src_toc, 'r') as f:
+		toc_text = f.read()
+
+	# Name the new data files after the new toc, keeping any track suffix
+	src_base = os.path.splitext(os.path.basename(src_toc))[0]
+	dst_base = os.path.splitext(os.path.basename(dst_toc))[0]
+	data_files = {}
+	for data_file in get_data_files(toc_text):
+		name = os.path.basename(data_file)
+		if name.startswith(src_base):
+			name = dst_base + name[len(src_base) : ]
+		else:
+			name = dst_base + '_' + name
+		if os.path.isabs(data_file):
+			new_file = os.path.join(os.path.dirname(os.path.abspath(dst_toc)), name)
+		else:
+			new_file = name
+		data_files[data_file] = new_file
+
+	sectors = 0
+	for data_file, new_file in data_files.items():
+		new_name = resolve_data_file(dst_toc, new_file)
+		count, digests = strip_file(resolve_data_file(src_toc, data_file), new_name, hashes is not None)
+		sectors += count
+		if hashes is not None:
+			hashes[os.path.basename(new_name)] = digests
+
+	with open(dst_toc, 'w') as f:
+		f.write(strip_subchannel_toc(toc_text, data_files))
+
+	return sectors
+
+
+def benchmark(megabytes = 256):
+	sectors = megabytes * 1024 * 1024 // RAW_SECTOR_SIZE
+	sector = bytes(range(256)) * 9 + bytes(RAW_SECTOR_SIZE - 256 * 9) + b'\xff' * 96
+	image = sector * sectors
+
+	start = time.time()
+	out = io.BytesIO()
+	count = strip_stream(io.BytesIO(image), out)
+	elapsed = time.time() - start
+
+	if count != sectors or out.getvalue() != sector[ : RAW_SECTOR_SIZE] * sectors:
+		raise Exception("Benchmark output did not match")
+
+	print("Stripped {0} sectors ({1:.1f} MB) in {2:.3f} s, {3:.1f} MB/s".format(
+		count, len(image) / 1048576.0, elapsed, len(image) / 1048576.0 / elapsed))
+
+
+def main(args):
+	if args and args[0] == '--benchmark':
+		benchmark(*[int(a) for a in args[1 : ]])
+		return 0
+
+	if len(args) != 2:
+		print("usage: strip_subchannel.py src.toc dst.toc | --benchmark [megabytes]")
+		return 1
+
+	sectors = strip_toc(args[0], args[1])
+	print("Wrote {0} sectors to {1}".format(sectors, args[1]))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,340 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Reads the Q sub-channel out of a "--read-subchan rw_raw" rip.
+#
+# Each sector of such a BIN is followed by 96 bytes of raw sub-channel,
+# one bit of each of the eight channels P to W in every byte. Q is bit 6,
+# so its 96 bits, 12 bytes, are bit 6 of each byte in turn. They are picked
+# out for a whole batch of sectors at once with NumPy.
+#
+# The last two Q bytes are a CRC-16 of the first ten. LibCrypt protected
+# PS1 discs have sectors whose Q was mastered wrong on purpose, with a bad
+# CRC, and the game checks that they read back that way. Those sectors are
+# all an emulator needs of the sub-channel, and they go in a .sbi file:
+# "SBI\0", then for each sector its MSF in BCD, a 1, and its 10 Q bytes.
+# Ten or so bytes a sector instead of a second copy of the whole BIN with
+# 96 more bytes on every sector.
+#
+# The sub-channel is read raw, without error correction, so any disc has a
+# few sectors whose Q came off the drive wrong. Only bad Q that looks like
+# LibCrypt goes in the .sbi: a Q that is still a plausible position, in a
+# sector between 03:00:00 and 09:59:74, with another such sector 5 sectors
+# before or after it, as LibCrypt stores each bit of its key twice. The
+# rest are read errors, and are only listed in the manifest.
+#
+# The CRC (CCITT, no init, inverted) is linear like the EDC in
+# sector_check.py, so it is checked for a batch at once the same way, with
+# a table per byte position.
+#
+# Usage:
+#   subchannel.py game.toc|game.bin [game_ns.sbi]
+#   subchannel.py --report rip_path
+#   subchannel.py --benchmark [megabytes]
+
+import sys, os
+import io
+import time
+import binascii
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+from toc_file import RAW_SECTOR_SIZE, SUBCHANNEL_SIZE, SUBCHANNEL_SECTOR_SIZE, get_data_files, resolve_data_file, parse_disc
+from hashing import manifest_name, read_manifest, update_manifest
+from sector_check import iter_batches
+
+Q_BIT = 6
+Q_SIZE = 12
+Q_DATA_SIZE = 10
+LEAD_OUT = 0xAA
+SBI_MAGIC = b'SBI\x00'
+SBI_Q_ENTRY = 1
+SBI_ENTRY_SIZE = 4 + Q_DATA_SIZE
+PREGAP_SECTORS = 150
+LIBCRYPT_FIRST = 3 * 60 * 75 - PREGAP_SECTORS
+LIBCRYPT_END = 10 * 60 * 75 - PREGAP_SECTORS
+LIBCRYPT_PAIR_DISTANCE = 5
+
+_tables = {}
+
+
+def _need_numpy():
+	if np is None:
+		raise Exception("Reading sub-channel data needs the numpy module")
+
+
+# The 12 Q bytes of each sector, from an (n, 2448) or (n, 96) array
+def q_channel(sectors):
+	sub = sectors[:, -SUBCHANNEL_SIZE : ]
+	return np.packbits((sub >> Q_BIT) & 1, axis = 1)
+
+
+def from_bcd(values):
+	values = values.astype(np.int32)
+	return (values >> 4) * 10 + (values & 0x0F)
+
+
+def is_bcd(values):
+	return ((values & 0x0F) < 10) & ((values >> 4) < 10)
+
+
+# (adr, track, index) of each sector from its Q bytes. Track and index are
+# -1 where the Q data isn't a mode 1 (position) Q or isn't BCD. The lead
+# out is track 0xAA.
+def q_position(q):
+	adr = q[:, 0] & 0x0F
+	valid = (adr == 1) & (is_bcd(q[:, 1]) | (q[:, 1] == LEAD_OUT)) & is_bcd(q[:, 2])
+	track = np.where(q[:, 1] == LEAD_OUT, LEAD_OUT, from_bcd(q[:, 1]))
+	track = np.where(valid, track, -1)
+	index = np.where(valid, from_bcd(q[:, 2]), -1)
+	return adr, track, index
+
+
+# What a byte adds to the CRC, by how many bytes from the end it is
+def _crc_tables():
+	if 'crc' not in _tables:
+		tables = np.zeros((Q_DATA_SIZE, 256), np.uint16)
+		for distance in range(Q_DATA_SIZE):
+			for byte in range(256):
+				tables[distance, byte] = binascii.crc_hqx(bytes([byte]) + bytes(distance), 0)
+		_tables['crc'] = tables[::-1].copy()
+	return _tables['crc']
+
+
+# The CRC each sector's Q should have
+def q_crc(q):
+	tables = _crc_tables()
+	parts = tables[np.arange(Q_DATA_SIZE), q[:, : Q_DATA_SIZE]]
+	return np.bitwise_xor.reduce(parts, axis = 1) ^ 0xFFFF
+
+
+# Whether the CRC in each sector's Q is wrong
+def bad_q(q):
+	stored = (q[:, Q_DATA_SIZE].astype(np.uint16) << 8) | q[:, Q_DATA_SIZE + 1]
+	return q_crc(q) != stored
+
+
+def to_bcd(value):
+	return (value // 10) << 4 | value % 10
+
+
+# The absolute MSF of a sector as BCD bytes
+def bcd_msf(lba):
+	minutes, frames = divmod(lba + PREGAP_SECTORS, 60 * 75)
+	seconds, frames = divmod(frames, 75)
+	return bytes([to_bcd(minutes), to_bcd(seconds), to_bcd(frames)])
+
+
+# [(first lba, file name, offset, count)] of the sub-channel data of a
+# toc, or of a BIN on its own
+def _subchannel_segments(disc_name):
+	if os.path.splitext(disc_name)[1].lower() == '.bin':
+		return [(0, disc_name, 0, os.path.getsize(disc_name) // SUBCHANNEL_SECTOR_SIZE)]
+	segments = []
+	for track in parse_disc(disc_name).tracks:
+		for segment in track.segments:
+			if segment.data_file and segment.sector_size == RAW_SECTOR_SIZE + SUBCHANNEL_SIZE:
+				segments.append((segment.start, segment.data_file, segment.file_offset, segment.length))
+	if not segments:
+		raise Exception("{0} has no sub-channel data".format(disc_name))
+	return segments
+
+
+# [(lba, 10 Q bytes)] of every sector whose Q CRC is bad, and the number of
+# sectors read
+def find_bad_q(disc_name):
+	_need_numpy()
+	bad = []
+	count = 0
+	for start, file_name, offset, length in _subchannel_segments(disc_name):
+		with open(file_name, 'rb') as f:
+			f.seek(offset)
+			for first, sectors in iter_batches(f, length, SUBCHANNEL_SECTOR_SIZE, keep_subchannel = True):
+				q = q_channel(sectors)
+				for i in np.nonzero(bad_q(q))[0]:
+					bad.append((start + first + int(i), q[i, : Q_DATA_SIZE].tobytes()))
+				count += len(sectors)
+	return bad, count
+
+
+def _is_bcd_byte(value):
+	return (value & 0x0F) < 10 and (value >> 4) < 10
+
+
+# Whether 10 Q bytes still look like a position: ADR 1, BCD throughout, and
+# the zero byte zero. LibCrypt only changes the MSF's.
+def _plausible_q(q):
+	return (q[0] & 0x0F) == 1 and q[6] == 0 and all([_is_bcd_byte(b) for b in q[1 : Q_DATA_SIZE]])
+
+
+# Split the sectors with bad Q into the LibCrypt ones, [(lba, 10 Q bytes)],
+# and read errors, [lba]
+def split_bad_q(bad):
+	candidates = set([lba for lba, q in bad if LIBCRYPT_FIRST <= lba < LIBCRYPT_END and _plausible_q(q)])
+	libcrypt = []
+	errors = []
+	for lba, q in bad:
+		if lba in candidates and (lba - LIBCRYPT_PAIR_DISTANCE in candidates or lba + LIBCRYPT_PAIR_DISTANCE in candidates):
+			libcrypt.append((lba, q))
+		else:
+			errors.append(lba)
+	return libcrypt, errors
+
+
+def format_sbi(bad):
+	return SBI_MAGIC + b''.join([bcd_msf(lba) + bytes([SBI_Q_ENTRY]) + q for lba, q in bad])
+
+
+def write_sbi(sbi_name, bad):
+	with open(sbi_name + '.part', 'wb') as f:
+		f.write(format_sbi(bad))
+	os.rename(sbi_name + '.part', sbi_name)
+
+
+# NAME_ns.sbi, next to the NAME_ns.cue emulators are given
+def sbi_name_for(disc_name):
+	base = os.path.splitext(disc_name)[0]
+	if not base.endswith('_ns'):
+		base += '_ns'
+	return base + '.sbi'
+
+
+# Find the LibCrypt sectors in a sub-channel rip, write the .sbi if there
+# are any, and record what was found in the manifest, read errors too.
+# Returns the manifest's 'subchannel' section.
+def make_sbi(disc_name, sbi_name = None):
+	bad, count = find_bad_q(disc_name)
+	libcrypt, errors = split_bad_q(bad)
+	sbi_name = sbi_name or sbi_name_for(disc_name)
+	if libcrypt:
+		write_sbi(sbi_name, libcrypt)
+	elif os.path.exists(sbi_name):
+		# From before read errors were told apart
+		os.remove(sbi_name)
+	result = {
+		'sectors' : count,
+		'libcrypt' : [lba for lba, q in libcrypt],
+		'q_errors' : errors,
+		'sbi' : os.path.basename(sbi_name) if libcrypt else None,
+	}
+	update_manifest(manifest_name(disc_name), subchannel = result)
+	return result
+
+
+# The sub-channel rip NAME.toc of each NAME_ns.toc in the library
+def subchannel_rips(rip_path):
+	from redump import find_images
+	for image_name in find_images(rip_path):
+		if image_name.endswith('_ns.toc') and os.path.exists(image_name[ : -7] + '.toc'):
+			yield image_name[ : -7] + '.toc'
+
+
+def _data_size(toc_name):
+	with open(toc_name, 'r') as f:
+		data_files = get_data_files(f.read())
+	return sum([os.path.getsize(resolve_data_file(toc_name, name)) for name in set(data_files)
+		if os.path.exists(resolve_data_file(toc_name, name))])
+
+
+# How much the library would save if every sub-channel BIN were replaced by
+# its .sbi. Discs that haven't been looked at yet, or were looked at before
+# read errors were told apart from LibCrypt, are scanned, and their results
+# kept in their manifests. Returns [(toc, BIN bytes, sbi bytes, LibCrypt
+# sectors, Q read errors)].
+def library_report(rip_path):
+	retval = []
+	for toc_name in subchannel_rips(rip_path):
+		result = read_manifest(manifest_name(toc_name)).get('subchannel')
+		if not result or 'libcrypt' not in result:
+			try:
+				result = make_sbi(toc_name)
+			except Exception as e:
+				print("{0}: {1}".format(toc_name, e))
+				continue
+		libcrypt_count = len(result['libcrypt'])
+		sbi_size = len(SBI_MAGIC) + libcrypt_count * SBI_ENTRY_SIZE if libcrypt_count else 0
+		retval.append((toc_name, _data_size(toc_name), sbi_size, libcrypt_count, len(result['q_errors'])))
+	return retval
+
+
+def _mb(size):
+	return "{0:.1f} MB".format(size / 1048576.0)
+
+
+def format_report(report):
+	lines = []
+	for toc_name, bin_size, sbi_size, libcrypt_count, error_count in report:
+		status = "{0} LibCrypt sectors".format(libcrypt_count) if libcrypt_count else "no protection"
+		if error_count:
+			status += ", {0} Q read errors".format(error_count)
+		lines.append("{0}: {1}, {2} -> {3} bytes".format(toc_name, status, _mb(bin_size), sbi_size))
+	protected = [r for r in report if r[3]]
+	lines.append("{0} sub-channel rips, {1} with LibCrypt".format(len(report), len(protected)))
+	lines.append("Dropping the sub-channel BINs of the discs without protection saves {0}".format(
+		_mb(sum([r[1] for r in report if not r[3]]))))
+	lines.append("Replacing them all with .sbi files saves {0}".format(_mb(sum([r[1] - r[2] for r in report]))))
+	return lines
+
+
+# Sectors of Q alone, with good CRCs, bar a few that are broken on purpose
+def _benchmark_q(count, broken):
+	q = np.frombuffer(os.urandom(count * Q_SIZE), np.uint8).reshape(count, Q_SIZE).copy()
+	q[:, 0] = 0x41
+	crc = np.array([binascii.crc_hqx(row.tobytes(), 0) ^ 0xFFFF for row in q[:, : Q_DATA_SIZE]], np.uint16)
+	q[:, Q_DATA_SIZE] = crc >> 8
+	q[:, Q_DATA_SIZE + 1] = crc & 0xFF
+	q[broken, Q_DATA_SIZE + 1] ^= 0x80
+	return q
+
+
+def benchmark(megabytes = 64):
+	_need_numpy()
+	count = megabytes * 1024 * 1024 // SUBCHANNEL_SECTOR_SIZE
+	broken = [5, 6, count // 3, count - 1]
+	q = _benchmark_q(count, broken)
+	sectors = np.zeros((count, SUBCHANNEL_SECTOR_SIZE), np.uint8)
+	sectors[:, RAW_SECTOR_SIZE : ] = np.unpackbits(q, axis = 1) << Q_BIT
+	image = sectors.tobytes()
+
+	start = time.time()
+	found = []
+	for first, batch in iter_batches(io.BytesIO(image), count, SUBCHANNEL_SECTOR_SIZE, keep_subchannel = True):
+		found += [first + int(i) for i in np.nonzero(bad_q(q_channel(batch)))[0]]
+	elapsed = time.time() - start
+	if found != broken:
+		raise Exception("Found bad Q in sectors {0}, expected {1}".format(found, broken))
+
+	size = len(image) / 1048576.0
+	print("Batched: {0} sectors ({1:.1f} MB) in {2:.2f} s, {3:.1f} MB/s".format(count, size, elapsed, size / elapsed))
+	print("sbi for {0} bad sectors: {1} bytes".format(len(broken), len(SBI_MAGIC) + len(broken) * SBI_ENTRY_SIZE))
+
+
+def main(args):
+	if args and args[0] == '--benchmark':
+		benchmark(*[int(a) for a in args[1 : ]])
+		return 0
+
+	if len(args) == 2 and args[0] == '--report':
+		for line in format_report(library_report(args[1])):
+			print(line)
+		return 0
+
+	if len(args) not in [1, 2]:
+		print("usage: subchannel.py game.toc|game.bin [game_ns.sbi] | --report rip_path | --benchmark [megabytes]")
+		return 1
+
+	result = make_sbi(*args)
+	if result['sbi']:
+		print("{0} LibCrypt sectors, wrote {1}".format(len(result['libcrypt']), result['sbi']))
+	else:
+		print("No LibCrypt sectors in {0} sectors".format(result['sectors']))
+	if result['q_errors']:
+		print("{0} sectors with Q read errors, left out".format(len(result['q_errors'])))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
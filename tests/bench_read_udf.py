@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Times read_udf on made up UDF data from udf_image.
+#
+#   --strict walks every file in an image, without and with strict mode, to
+#   see what checking the descriptor CRCs costs. Without an image, one of 20
+#   directories of 200 files each is made up.
+#
+#   --names parses a directory of FIDs, half with 8 bit names and half with
+#   16 bit ones, and times decoding their names against decoding them a
+#   character at a time, as to_dchars used to.
+#
+# Usage:
+#   bench_read_udf.py --strict [image.iso [rounds]]
+#   bench_read_udf.py --names [count]
+
+import os, sys
+import io
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'identify_playstation2_games'))
+from read_udf import FileIdentifierDescriptor, read_udf_file, to_dchars, to_uint8
+from udf_image import make_fid, make_image
+
+
+# to_dchars as it was, a character at a time
+def _slow_dchars(buffer, offset, count):
+	if count == 0:
+		return b""
+
+	alg = to_uint8(buffer, offset)
+	result = []
+	pos = 1
+	while pos < count:
+		ch = 0
+		if alg == 16:
+			ch = (to_uint8(buffer, offset + pos) << 8)
+			pos += 1
+		if pos < count:
+			ch |= to_uint8(buffer, offset + pos)
+			pos += 1
+		result.append(chr(ch).encode('utf-8'))
+	return b''.join(result)
+
+
+def benchmark_strict(file_name = None, rounds = 5):
+	if file_name is None:
+		tree = {}
+		for i in range(20):
+			tree[u"DIR{0:02d}".format(i)] = dict([(u"FILE_{0:03d}_{1:04d}.BIN".format(i, j), b"x" * (j + 1)) for j in range(200)])
+		image = make_image(tree)
+
+	times = {}
+	for strict in [False, True, False, True] * rounds:
+		start = time.time()
+		root = read_udf_file(io.BytesIO(image) if file_name is None else file_name, strict)
+		count = sum([1 for entry in root.walk()])
+		root.context.file.close()
+		elapsed = time.time() - start
+		times[strict] = min(times.get(strict, elapsed), elapsed)
+
+	print("{0} files and directories walked in {1:.1f} ms".format(count, times[False] * 1000))
+	print("Strict mode: {0:.1f} ms, {1:+.1f}%".format(times[True] * 1000, (times[True] / times[False] - 1) * 100))
+
+
+def benchmark_names(count = 10000):
+	names = [(u"SLUS_{0:03d}.{1:02d};1".format(i // 100, i % 100), 8) if i % 2 else
+		(u"\u30c7\u30fc\u30bf_{0:05d}.BIN".format(i), 16) for i in range(count)]
+	buffer = b''.join([make_fid(name, alg, 0) for name, alg in names])
+
+	start = time.time()
+	spans = []
+	pos = 0
+	while pos < len(buffer):
+		fid = FileIdentifierDescriptor(buffer, pos)
+		spans.append((pos + 38, fid.length_of_file_identifier))
+		pos += fid.rounded_size
+	parse = time.time() - start
+
+	times = {}
+	for decode in [to_dchars, _slow_dchars]:
+		start = time.time()
+		for offset, length in spans:
+			decode(buffer, offset, length)
+		times[decode] = time.time() - start
+
+	print("{0} FIDs parsed in {1:.1f} ms".format(count, parse * 1000))
+	print("Names decoded in {0:.1f} ms, a character at a time took {1:.1f} ms".format(
+		times[to_dchars] * 1000, times[_slow_dchars] * 1000))
+
+
+def main(args):
+	if args and args[0] == '--strict':
+		benchmark_strict(*(args[1 : 2] + [int(a) for a in args[2 : ]]))
+		return 0
+	if args and args[0] == '--names':
+		benchmark_names(*[int(a) for a in args[1 : ]])
+		return 0
+
+	print("usage: bench_read_udf.py --strict [image.iso [rounds]] | --names [count]")
+	return 1
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,78 @@
+# AccurateRip v1/v2 and CRC32 of tracks fed in chunks that split samples
+
+import os, sys
+import random
+import struct
+import zlib
+
+import pytest
+np = pytest.importorskip('numpy')
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from accuraterip import TrackChecksum, checksum_stream, SKIP_FIRST, SKIP_LAST
+from toc_file import SAMPLES_PER_SECTOR
+
+
+def _pcm(words):
+	return struct.pack('<{0}I'.format(len(words)), *words)
+
+
+def _digests(data, first = False, last = False, chunk_sizes = None):
+	checksum = TrackChecksum(len(data) // 4, first, last)
+	pos = 0
+	sizes = chunk_sizes or [len(data)]
+	while pos < len(data):
+		size = sizes[0]
+		sizes = sizes[1 : ] + sizes[ : 1]
+		checksum.update(data[pos : pos + size])
+		pos += size
+	return checksum.digests()
+
+
+# The sums as AccurateRip defines them, on Python ints
+def _expected(words, first, last):
+	start = SKIP_FIRST if first else 0
+	end = len(words) - SKIP_LAST if last else len(words)
+	products = [words[i] * (i + 1) for i in range(start, end)]
+	v1 = sum(products) & 0xFFFFFFFF
+	v2 = sum([(p & 0xFFFFFFFF) + (p >> 32) for p in products]) & 0xFFFFFFFF
+	return '{0:08x}'.format(v1), '{0:08x}'.format(v2)
+
+
+def test_known_values():
+	digests = _digests(_pcm([1, 2, 3]))
+	assert digests['samples'] == 3
+	assert digests['accuraterip_v1'] == '{0:08x}'.format(1 * 1 + 2 * 2 + 3 * 3)
+	assert digests['accuraterip_v2'] == digests['accuraterip_v1']
+	assert digests['crc32'] == '{0:08x}'.format(zlib.crc32(_pcm([1, 2, 3])) & 0xFFFFFFFF)
+
+	# 0xFFFFFFFF * 2 overflows 32 bits, v2 adds the carry back in
+	digests = _digests(_pcm([0, 0xFFFFFFFF]))
+	assert digests['accuraterip_v1'] == 'fffffffe'
+	assert digests['accuraterip_v2'] == 'ffffffff'
+
+
+def test_first_and_last_tracks_skip_their_ends():
+	words = [1] * (11 * SAMPLES_PER_SECTOR)
+	digests = _digests(_pcm(words), first = True, last = True)
+	total = sum(range(SKIP_FIRST + 1, len(words) - SKIP_LAST + 1))
+	assert digests['accuraterip_v1'] == '{0:08x}'.format(total)
+
+
+def test_split_chunks_match_one_chunk():
+	rand = random.Random(0)
+	words = [rand.getrandbits(32) for i in range(12 * SAMPLES_PER_SECTOR + 3)]
+	data = _pcm(words)
+	for first, last in [(False, False), (True, False), (False, True), (True, True)]:
+		whole = _digests(data, first, last)
+		assert (whole['accuraterip_v1'], whole['accuraterip_v2']) == _expected(words, first, last)
+		for sizes in [[1], [3, 5, 7], [4093], [65537]]:
+			assert _digests(data, first, last, sizes) == whole
+
+
+def test_checksum_stream_skips_a_split_header():
+	data = _pcm(list(range(1, 1000)))
+	stream = [b'RIFF' * 5, b'RIFF' * 6 + data[ : 10], data[10 : 2001], data[2001 : ]]
+	checksum = TrackChecksum(len(data) // 4)
+	assert list(checksum_stream(iter(stream), checksum, 44)) == stream
+	assert checksum.digests() == _digests(data)
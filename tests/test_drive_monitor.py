@@ -0,0 +1,100 @@
+# Walks DriveMonitor through its states on a SimulatedDrive
+
+import os, sys
+import time
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from drive_monitor import DriveMonitor, DriveState, SimulatedDrive, has_media, is_audio_only, is_readable
+
+DISC = {'ID_FS_TYPE' : 'udf', 'ID_FS_UUID' : 'DISC0'}
+
+
+# Remembers the monitor's state each time it asks if the disc is readable
+class RecordingDrive(SimulatedDrive):
+	def __init__(self, *args, **kwargs):
+		SimulatedDrive.__init__(self, *args, **kwargs)
+		self.monitor = None
+		self.states = []
+
+	def readable(self, properties = None):
+		self.states.append(self.monitor.state)
+		return SimulatedDrive.readable(self, properties)
+
+
+def _insert_later(drive, delay = 0.1):
+	timer = threading.Timer(delay, drive.insert, args = (DISC, ))
+	timer.start()
+	return timer
+
+
+def test_insert_spins_up_then_is_ready():
+	drive = RecordingDrive(spin_up_checks = 3)
+	monitor = DriveMonitor(drive, readable_interval = 0.01)
+	drive.monitor = monitor
+	_insert_later(drive)
+
+	properties = monitor.wait_for_disc(timeout = 5)
+	assert properties['ID_FS_UUID'] == 'DISC0'
+	assert monitor.state == DriveState.ready
+	# Three checks while it spins up, then the one that finds it readable
+	assert drive.states == [DriveState.spinning_up] * 4
+
+
+def test_wait_times_out_on_an_empty_drive():
+	monitor = DriveMonitor(SimulatedDrive())
+	start = time.time()
+	assert monitor.wait_for_disc(timeout = 0.2) is None
+	assert time.time() - start < 1
+	assert monitor.state == DriveState.empty
+
+
+def test_wait_times_out_while_spinning_up():
+	drive = SimulatedDrive(spin_up_checks = 1000)
+	drive.insert(DISC)
+	monitor = DriveMonitor(drive, readable_interval = 0.01)
+	assert monitor.wait_for_disc(timeout = 0.2) is None
+	assert monitor.state == DriveState.spinning_up
+
+
+def test_wait_returns_when_stopped():
+	stop = threading.Event()
+	threading.Timer(0.1, stop.set).start()
+	start = time.time()
+	assert DriveMonitor(SimulatedDrive()).wait_for_disc(stop = stop) is None
+	assert time.time() - start < 2
+
+
+def test_eject_empties_the_drive():
+	drive = SimulatedDrive()
+	drive.insert(DISC)
+	monitor = DriveMonitor(drive, readable_interval = 0.01)
+	assert monitor.wait_for_disc(timeout = 5)
+
+	monitor.eject(timeout = 1)
+	assert drive.ejects == 1
+	assert monitor.state == DriveState.empty
+	assert monitor.properties == {}
+	assert not has_media(drive.properties())
+
+	# And the next disc is waited for from scratch
+	_insert_later(drive)
+	assert monitor.wait_for_disc(timeout = 5)['ID_FS_UUID'] == 'DISC0'
+
+
+def test_audio_only_cds_are_not_probed_by_sector():
+	assert is_audio_only({'ID_CDROM_MEDIA_TRACK_COUNT_AUDIO' : '12'})
+	assert not is_audio_only({'ID_CDROM_MEDIA_TRACK_COUNT_AUDIO' : '12', 'ID_CDROM_MEDIA_TRACK_COUNT_DATA' : '1'})
+	assert not is_audio_only({'ID_CDROM_MEDIA_TRACK_COUNT_DATA' : '1'})
+
+
+def test_is_readable_reads_sector_16(tmp_path):
+	image = str(tmp_path / 'disc.iso')
+	with open(image, 'wb') as f:
+		f.write(b'\0' * 16 * 2048)
+	assert not is_readable(image)
+	with open(image, 'ab') as f:
+		f.write(b'\1' * 2048)
+	assert is_readable(image)
+	# A file is no drive to ask for its status
+	assert not is_readable(image, audio_only = True)
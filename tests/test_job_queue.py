@@ -0,0 +1,73 @@
+# Follow up jobs and leases in the SQLite job queue
+
+import os, sys
+import sqlite3
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from job_queue import JobQueue, JobState, QueueWorkers
+
+
+def _states(db_name):
+	db = sqlite3.connect(db_name)
+	try:
+		return db.execute("SELECT stage, state FROM jobs ORDER BY id").fetchall()
+	finally:
+		db.close()
+
+
+def test_follow_ups_are_queued_with_the_completion(tmp_path):
+	db_name = str(tmp_path / 'jobs.db')
+	job_queue = JobQueue(db_name)
+	job_queue.enqueue('cd', {'dir' : 'a'})
+	workers = QueueWorkers(job_queue, {'cd' : lambda payload: [('audio', {'toc' : 'a.toc'})]})
+	assert workers.run_one()
+	assert _states(db_name) == [('cd', JobState.done), ('audio', JobState.queued)]
+	job_queue.close()
+
+
+def test_a_follow_up_that_fails_to_queue_leaves_the_job_running(tmp_path):
+	db_name = str(tmp_path / 'jobs.db')
+	job_queue = JobQueue(db_name)
+	job_queue.enqueue('cd', {})
+	job = job_queue.claim(['cd'])
+	# The second payload can't be stored, so neither is queued
+	with pytest.raises(TypeError):
+		job_queue.complete(job, [('audio', {}), ('audio', {'bad' : object()})])
+	assert _states(db_name) == [('cd', JobState.running)]
+	job_queue.close()
+
+
+def test_recover_leaves_jobs_other_queues_are_running(tmp_path):
+	db_name = str(tmp_path / 'jobs.db')
+	mine = JobQueue(db_name)
+	theirs = JobQueue(db_name, lease_time = -1)
+	mine.enqueue('cd', {})
+	mine.enqueue('cd', {})
+	assert mine.claim(['cd'])
+	assert theirs.claim(['cd'])
+
+	# Only the job whose lease ran out goes back
+	assert mine.recover() == 1
+	assert [state for stage, state in _states(db_name)] == [JobState.running, JobState.queued]
+
+	mine.renew()
+	assert theirs.recover() == 0
+	mine.close()
+	theirs.close()
+
+
+def test_old_tables_get_the_lease_columns(tmp_path):
+	db_name = str(tmp_path / 'jobs.db')
+	db = sqlite3.connect(db_name)
+	db.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY, stage TEXT NOT NULL, payload TEXT NOT NULL, state TEXT NOT NULL, "
+		"attempts INTEGER NOT NULL DEFAULT 0, error TEXT, created REAL NOT NULL, run_after REAL NOT NULL, started REAL, finished REAL)")
+	db.execute("INSERT INTO jobs (stage, payload, state, created, run_after) VALUES ('cd', '{}', 'running', 0, 0)")
+	db.commit()
+	db.close()
+
+	# A job left running by the old version has no lease, so is recovered
+	job_queue = JobQueue(db_name)
+	assert job_queue.recover() == 1
+	assert job_queue.claim(['cd'])
+	job_queue.close()
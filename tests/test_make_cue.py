@@ -0,0 +1,113 @@
+# Cue layouts make_cue works out from the sectors of a BIN, with and
+# without Q sub-channel data
+
+import os, sys
+import io
+
+import pytest
+np = pytest.importorskip('numpy')
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import make_cue
+from sector_check import SYNC
+from toc_file import RAW_SECTOR_SIZE
+
+DATA = 400
+AUDIO = 500
+PREGAP = make_cue.PREGAP_SECTORS
+STARTS = [0, DATA, DATA + AUDIO]
+COUNT = DATA + 2 * AUDIO
+EXPECTED = [
+	('MODE2/2352', {1 : 0}),
+	('AUDIO', {0 : DATA, 1 : DATA + PREGAP}),
+	('AUDIO', {0 : DATA + AUDIO, 1 : DATA + AUDIO + PREGAP}),
+]
+
+
+def _bcd(value):
+	return (value // 10) << 4 | value % 10
+
+
+# A mode 2 data track, then two audio tracks whose pregaps are silent,
+# unless silent_pregaps is False
+def _sectors(silent_pregaps = True):
+	rand = np.random.RandomState(0)
+	sectors = rand.randint(1, 256, (COUNT, RAW_SECTOR_SIZE)).astype(np.uint8)
+	sectors[ : DATA, 0 : 12] = np.frombuffer(SYNC, np.uint8)
+	sectors[ : DATA, 15] = 2
+	sectors[ : DATA, 18] = sectors[ : DATA, 22] = 0x08
+	if silent_pregaps:
+		for start in STARTS[1 : ]:
+			sectors[start : start + PREGAP] = 0
+	return sectors
+
+
+# The Q track and index of every sector, interleaved as rw_raw has it
+def _with_q(sectors, glitches = ()):
+	q = np.zeros((COUNT, 12), np.uint8)
+	q[:, 0] = 0x01
+	q[ : DATA, 0] |= 0x40
+	for number, start in enumerate(STARTS, 1):
+		q[start :, 1] = _bcd(number)
+		q[start :, 2] = 1 if number == 1 else 0
+		if number > 1:
+			q[start + PREGAP :, 2] = 1
+	for i in glitches:
+		q[i, 1 : 3] = 0x5A
+	return np.hstack((sectors, np.unpackbits(q, axis = 1) << 6))
+
+
+def _tracks(sectors):
+	image = sectors.tobytes()
+	return make_cue.infer_tracks(make_cue.scan_bin(io.BytesIO(image), len(image)))
+
+
+def test_layout_without_q_from_silence():
+	assert _tracks(_sectors()) == EXPECTED
+
+
+def test_layout_without_q_or_silence_has_no_pregaps():
+	assert _tracks(_sectors(silent_pregaps = False)) == [('MODE2/2352', {1 : 0}), ('AUDIO', {1 : DATA})]
+
+
+def test_layout_from_q():
+	# Q has the pregaps even where they aren't silent, and a sector whose
+	# Q was misread doesn't start a track
+	sectors = _with_q(_sectors(silent_pregaps = False), glitches = [DATA + 10, DATA + AUDIO + 200])
+	assert _tracks(sectors) == EXPECTED
+
+
+def test_cue_for_a_bin(tmp_path):
+	bin_name = str(tmp_path / 'game.bin')
+	with open(bin_name, 'wb') as f:
+		f.write(_sectors().tobytes())
+	cue_name, tracks = make_cue.make_cue(bin_name)
+	assert cue_name == str(tmp_path / 'game.cue')
+	with open(cue_name) as f:
+		assert f.read() == '\n'.join([
+			'FILE "game.bin" BINARY',
+			'  TRACK 01 MODE2/2352',
+			'    INDEX 01 00:00:00',
+			'  TRACK 02 AUDIO',
+			'    INDEX 00 00:05:25',
+			'    INDEX 01 00:07:25',
+			'  TRACK 03 AUDIO',
+			'    INDEX 00 00:12:00',
+			'    INDEX 01 00:14:00',
+		]) + '\n'
+
+
+def test_cue_for_a_subchannel_bin_points_at_the_ns_bin(tmp_path):
+	bin_name = str(tmp_path / 'game.bin')
+	with open(bin_name, 'wb') as f:
+		f.write(_with_q(_sectors()).tobytes())
+	with pytest.raises(Exception):
+		make_cue.make_cue(bin_name)
+
+	with open(str(tmp_path / 'game_ns.bin'), 'wb') as f:
+		f.write(_sectors().tobytes())
+	cue_name, tracks = make_cue.make_cue(bin_name)
+	assert cue_name == str(tmp_path / 'game_ns.cue')
+	assert tracks == EXPECTED
+	with open(cue_name) as f:
+		assert f.readline() == 'FILE "game_ns.bin" BINARY\n'
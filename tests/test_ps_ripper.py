@@ -0,0 +1,65 @@
+# Runs the multi-drive scheduler on simulated drives, with FakeReader
+# copying images in place of the discs
+
+import os, sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from drive_monitor import SimulatedDrive
+from rip_disc import FakeReader
+from ps_ripper import Scheduler
+
+DRIVES = ['/dev/sim0', '/dev/sim1']
+
+
+# Counts the udevadm queries the monitor makes
+class CountingDrive(SimulatedDrive):
+	def __init__(self, *args, **kwargs):
+		SimulatedDrive.__init__(self, *args, **kwargs)
+		self.queries = 0
+
+	def properties(self):
+		self.queries += 1
+		return SimulatedDrive.properties(self)
+
+
+def _wait_for(check, timeout = 30):
+	deadline = time.time() + timeout
+	while not check():
+		assert time.time() < deadline
+		time.sleep(0.05)
+
+
+def test_scheduler_rips_on_every_drive(tmp_path):
+	rip_path = str(tmp_path / 'rips')
+	os.makedirs(rip_path)
+	backends = dict([(drive, CountingDrive(drive, spin_up_checks = 2)) for drive in DRIVES])
+	reader = FakeReader(backends)
+	scheduler = Scheduler(rip_path, [(drive, backends[drive], reader) for drive in DRIVES], 'ps2', workers = 2)
+	scheduler.start()
+	try:
+		# Waiting on an empty drive doesn't poll udevadm
+		time.sleep(2.5)
+		assert [backends[drive].queries for drive in DRIVES] == [1, 1]
+
+		images = {}
+		for i, drive in enumerate(DRIVES):
+			data = os.urandom(64 * 2048)
+			image = str(tmp_path / 'disc{0}.iso'.format(i))
+			with open(image, 'wb') as f:
+				f.write(data)
+			images['DISC{0}'.format(i)] = data
+			backends[drive].insert({'ID_FS_TYPE' : 'udf', 'ID_FS_UUID' : 'DISC{0}'.format(i)}, image)
+
+		out_dir = os.path.join(rip_path, 'PLAYSTATION_2')
+		_wait_for(lambda: all([os.path.exists(os.path.join(out_dir, name + '.iso')) for name in images]))
+		_wait_for(lambda: all([backends[drive].ejects == 1 for drive in DRIVES]))
+	finally:
+		start = time.time()
+		scheduler.stop()
+	assert time.time() - start < 5
+
+	for name, data in images.items():
+		with open(os.path.join(out_dir, name + '.iso'), 'rb') as f:
+			assert f.read() == data
+	assert [(slot.discs, slot.errors) for slot in scheduler.slots] == [(1, 0), (1, 0)]
@@ -0,0 +1,111 @@
+# Counts the reads and seeks it takes read_udf to mount a UDF image, on
+# images made up by udf_image.make_image, and checks file identifiers decode
+
+import os, sys
+import io
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'identify_playstation2_games'))
+import read_udf
+from udf_image import make_image, make_fid, MAIN_VDS
+
+SECTOR_SIZE = 2048
+TREE = {
+	u"SYSTEM.CNF" : b"BOOT2 = cdrom0:\\SLUS_203.12;1\r\nVER = 1.00\r\n",
+	u"SLUS_203.12" : b"\x7fELF" + b"\0" * 1000,
+	u"MODULES" : {u"IOPRP.IMG" : b"IOPRP" * 100},
+}
+
+
+# A file object over bytes that counts the calls made on it
+class CountingFile(io.RawIOBase):
+	def __init__(self, data):
+		self._f = io.BytesIO(data)
+		self.reads = 0
+		self.seeks = 0
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def seek(self, offset, whence = io.SEEK_SET):
+		self.seeks += 1
+		return self._f.seek(offset, whence)
+
+	def tell(self):
+		return self._f.tell()
+
+	def readinto(self, buffer):
+		self.reads += 1
+		return self._f.readinto(buffer)
+
+	def read(self, size = -1):
+		self.reads += 1
+		return self._f.read(size)
+
+
+def _zero_sectors(image, first, count):
+	image = bytearray(image)
+	image[first * SECTOR_SIZE : (first + count) * SECTOR_SIZE] = b"\0" * (count * SECTOR_SIZE)
+	return bytes(image)
+
+
+def _mount(image):
+	f = CountingFile(image)
+	root = read_udf.read_udf_file(f)
+	names = sorted([entry.file_identifier for entry in root.all_entries])
+	return f, root, names
+
+
+def test_mount_reads_each_structure_once():
+	f, root, names = _mount(make_image(TREE))
+	assert names == [b"MODULES", b"SLUS_203.12", b"SYSTEM.CNF"]
+	# The VRS, the anchor, the VDS, the FSD, the root File Entry and the
+	# root directory, one read each. Two more seeks find the image size.
+	assert f.reads == 6
+	assert f.seeks == 8
+
+	with root.open("MODULES/IOPRP.IMG") as g:
+		assert g.read() == TREE[u"MODULES"][u"IOPRP.IMG"]
+
+
+def test_mount_without_an_anchor_at_256():
+	image = _zero_sectors(make_image(TREE), read_udf.ANCHOR_SECTOR, 1)
+	f, root, names = _mount(image)
+	assert names == [b"MODULES", b"SLUS_203.12", b"SYSTEM.CNF"]
+	# Sector 256 is tried at the sector sizes the image is big enough for,
+	# then the last sector has the anchor
+	sizes = [size for size in read_udf.ANCHOR_SECTOR_SIZES if len(image) >= (read_udf.ANCHOR_SECTOR + 1) * size]
+	assert f.reads == 6 + len(sizes)
+	assert f.seeks == 8 + len(sizes)
+
+
+def test_mount_with_the_main_vds_zeroed():
+	image = _zero_sectors(make_image(TREE), MAIN_VDS, 4)
+	f, root, names = _mount(image)
+	assert names == [b"MODULES", b"SLUS_203.12", b"SYSTEM.CNF"]
+	# The reserve sequence is read in one more read
+	assert f.reads == 7
+	assert f.seeks == 9
+
+
+def test_to_dchars_8_bit_names():
+	buffer = b"\xff\x08SLUS_203.12;1"
+	assert read_udf.to_dchars(buffer, 1, len(buffer) - 1) == b"SLUS_203.12;1"
+	assert read_udf.to_dchars(b"\x08caf\xe9", 0, 5) == u"caf\xe9".encode('utf-8')
+	assert read_udf.to_dchars(b"", 0, 0) == b""
+
+
+def test_to_dchars_16_bit_names():
+	name = u"\u30c7\u30fc\u30bf_00001.BIN"
+	buffer = b"\x10" + name.encode('utf-16-be')
+	assert read_udf.to_dchars(buffer, 0, len(buffer)) == name.encode('utf-8')
+
+	fid = read_udf.FileIdentifierDescriptor(make_fid(name, 16, 0), 0)
+	assert fid.file_identifier == name.encode('utf-8')
+
+
+def test_to_dchars_16_bit_odd_byte_count():
+	# The odd last byte is the high half of a character
+	assert read_udf.to_dchars(b"\x10\x00A\x30", 0, 4) == u"A\u3000".encode('utf-8')
@@ -0,0 +1,132 @@
+# Checks the batched EDC/ECC of sector_check against sectors whose codes
+# come from a byte at a time version of ECMA-130, and the EDC against the
+# CRC-32/CD-ROM-EDC check value
+
+import os, sys
+import io
+import random
+
+import pytest
+np = pytest.importorskip('numpy')
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sector_check
+from sector_check import SYNC, EDC_POLY, EDC_ERROR, ECC_ERROR, SYNC_ERROR, MODE_ERROR
+
+F_LUT = [((i << 1) ^ (0x11D if i & 0x80 else 0)) & 0xFF for i in range(256)]
+B_LUT = [0] * 256
+for i in range(256):
+	B_LUT[i ^ F_LUT[i]] = i
+
+
+def _edc(data):
+	edc = 0
+	for byte in bytearray(data):
+		edc ^= byte
+		for bit in range(8):
+			edc = (edc >> 1) ^ (EDC_POLY if edc & 1 else 0)
+	return edc
+
+
+# ecc_computeblock of ECMA-130 annex A
+def _ecc_block(data, major_count, minor_count, major_mult, minor_inc):
+	size = major_count * minor_count
+	out = bytearray(major_count * 2)
+	for major in range(major_count):
+		index = (major >> 1) * major_mult + (major & 1)
+		ecc_a = ecc_b = 0
+		for minor in range(minor_count):
+			ecc_a ^= data[index]
+			ecc_b ^= data[index]
+			ecc_a = F_LUT[ecc_a]
+			index += minor_inc
+			if index >= size:
+				index -= size
+		ecc_a = B_LUT[F_LUT[ecc_a] ^ ecc_b]
+		out[major] = ecc_a
+		out[major + major_count] = ecc_a ^ ecc_b
+	return out
+
+
+def _add_ecc(sector, zero_header):
+	header = sector[12 : 16]
+	if zero_header:
+		sector[12 : 16] = b'\0' * 4
+	sector[0x81C : 0x8C8] = _ecc_block(sector[0xC : 0x81C], 86, 24, 2, 86)
+	sector[0x8C8 : 0x930] = _ecc_block(sector[0xC : 0x8C8], 52, 43, 86, 88)
+	sector[12 : 16] = header
+
+
+def _sector(mode, form2 = False, seed = 0):
+	rand = random.Random(seed)
+	sector = bytearray(2352)
+	sector[0 : 12] = SYNC
+	sector[12 : 16] = bytearray([0x00, 0x02, 0x16, mode])
+	if mode == 1:
+		sector[16 : 0x810] = bytearray([rand.randrange(256) for i in range(2048)])
+		sector[0x810 : 0x814] = bytearray(_edc(sector[0 : 0x810]).to_bytes(4, 'little'))
+		_add_ecc(sector, False)
+	elif not form2:
+		sector[16 : 24] = b'\x00\x00\x08\x00' * 2
+		sector[24 : 0x818] = bytearray([rand.randrange(256) for i in range(2048)])
+		sector[0x818 : 0x81C] = bytearray(_edc(sector[16 : 0x818]).to_bytes(4, 'little'))
+		_add_ecc(sector, True)
+	else:
+		sector[16 : 24] = b'\x00\x00\x20\x00' * 2
+		sector[24 : 0x92C] = bytearray([rand.randrange(256) for i in range(2324)])
+		sector[0x92C : 0x930] = bytearray(_edc(sector[16 : 0x92C]).to_bytes(4, 'little'))
+	return sector
+
+
+def _check(sectors, ecc = True):
+	array = np.frombuffer(b''.join([bytes(s) for s in sectors]), np.uint8).reshape(len(sectors), 2352)
+	return list(sector_check.check_sectors(array, ecc))
+
+
+def test_edc_check_value():
+	data = np.frombuffer(b'123456789', np.uint8).reshape(1, 9)
+	assert int(sector_check.compute_edc(data, 0, 9)[0]) == 0x6EC2EDC4
+	assert _edc(b'123456789') == 0x6EC2EDC4
+
+
+def test_ecc_matches_ecma_130():
+	for zero_header, sector in [(False, _sector(1)), (True, _sector(2, seed = 1))]:
+		array = np.frombuffer(bytes(sector), np.uint8).reshape(1, 2352)
+		assert sector_check.compute_ecc(array, zero_header)[0].tobytes() == bytes(sector[0x81C : ])
+
+
+def test_good_sectors_pass():
+	sectors = [_sector(1), _sector(2, seed = 1), _sector(2, True, seed = 2)]
+	assert _check(sectors) == [None, None, None]
+	assert _check(sectors, ecc = False) == [None, None, None]
+
+
+def test_form2_sectors_need_no_edc():
+	sector = _sector(2, True)
+	sector[0x92C : 0x930] = b'\0' * 4
+	assert _check([sector]) == [None]
+
+
+def test_damage_is_found():
+	data = _sector(1)
+	data[100] ^= 0x01
+	parity = _sector(2, seed = 1)
+	parity[0x900] ^= 0x80
+	sync = _sector(1)
+	sync[3] = 0
+	mode = _sector(1)
+	mode[15] = 3
+	assert _check([data, parity, sync, mode]) == [EDC_ERROR, ECC_ERROR, SYNC_ERROR, MODE_ERROR]
+	# Bad parity is only found when ECC is checked
+	assert _check([parity], ecc = False) == [None]
+
+
+def test_bad_sectors_by_lba_across_batches():
+	sectors = [_sector(1, seed = i) for i in range(10)]
+	for i in [2, 3, 9]:
+		sectors[i][200] ^= 0xFF
+	found = []
+	for first, batch in sector_check.iter_batches(io.BytesIO(b''.join([bytes(s) for s in sectors])), 10, batch_sectors = 4):
+		errors = sector_check.check_sectors(batch)
+		found += [first + int(i) for i in np.nonzero(errors != None)[0]]
+	assert sector_check._ranges([(lba, EDC_ERROR) for lba in found]) == [(2, 2, EDC_ERROR), (9, 1, EDC_ERROR)]
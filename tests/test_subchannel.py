@@ -0,0 +1,85 @@
+# The Q sub-channel CRC check, and how sectors with a bad one are split
+# into LibCrypt sectors and read errors
+
+import os, sys
+import binascii
+
+import pytest
+np = pytest.importorskip('numpy')
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import subchannel
+from subchannel import LIBCRYPT_FIRST, LIBCRYPT_END, LIBCRYPT_PAIR_DISTANCE, Q_DATA_SIZE, SBI_MAGIC
+from toc_file import RAW_SECTOR_SIZE
+
+
+# The 12 Q bytes of a data sector at an lba of track 1, with its CRC
+def _q(lba):
+	relative = subchannel.bcd_msf(lba - subchannel.PREGAP_SECTORS)
+	q = bytes([0x41, 0x01, 0x01]) + relative + b'\0' + subchannel.bcd_msf(lba)
+	return q + (binascii.crc_hqx(q, 0) ^ 0xFFFF).to_bytes(2, 'big')
+
+
+# What LibCrypt does: a different MSF, still BCD, and the CRC left alone
+def _libcrypt(lba):
+	q = bytearray(_q(lba))
+	q[5] ^= 0x01
+	return bytes(q)
+
+
+def _subchannel(q):
+	return np.unpackbits(np.frombuffer(q, np.uint8)) << subchannel.Q_BIT
+
+
+def test_bad_q_by_crc():
+	rows = [_q(200), _libcrypt(201), _q(202)]
+	broken = bytearray(_q(203))
+	broken[Q_DATA_SIZE + 1] ^= 0x80
+	rows.append(bytes(broken))
+	q = np.frombuffer(b''.join(rows), np.uint8).reshape(len(rows), 12)
+	assert subchannel.bad_q(q).tolist() == [False, True, False, True]
+
+
+def test_q_is_picked_out_of_the_sub_channel():
+	sectors = np.zeros((2, RAW_SECTOR_SIZE + 96), np.uint8)
+	sectors[0, RAW_SECTOR_SIZE : ] = _subchannel(_q(300))
+	# The other channels' bits don't get in the way
+	sectors[1, RAW_SECTOR_SIZE : ] = _subchannel(_q(301)) | 0xBF
+	assert subchannel.q_channel(sectors).tobytes() == _q(300) + _q(301)
+
+
+def test_find_bad_q_in_a_bin(tmp_path):
+	bin_name = str(tmp_path / 'game.bin')
+	with open(bin_name, 'wb') as f:
+		for lba in range(20):
+			q = _libcrypt(lba) if lba in [4, 9] else _q(lba)
+			f.write(b'\0' * RAW_SECTOR_SIZE + _subchannel(q).tobytes())
+	bad, count = subchannel.find_bad_q(bin_name)
+	assert count == 20
+	assert bad == [(4, _libcrypt(4)[ : Q_DATA_SIZE]), (9, _libcrypt(9)[ : Q_DATA_SIZE])]
+
+
+def test_split_keeps_libcrypt_pairs_and_drops_read_errors():
+	first = LIBCRYPT_FIRST + 100
+	pair = [first, first + LIBCRYPT_PAIR_DISTANCE]
+	# A plausible bad Q with no partner
+	lone = first + 1000
+	# A pair, but outside where LibCrypt puts its sectors
+	early = [LIBCRYPT_FIRST - 20, LIBCRYPT_FIRST - 20 + LIBCRYPT_PAIR_DISTANCE]
+	late = [LIBCRYPT_END, LIBCRYPT_END + LIBCRYPT_PAIR_DISTANCE]
+	# A pair whose Q is garbage, as a misread gives
+	garbage = [first + 2000, first + 2000 + LIBCRYPT_PAIR_DISTANCE]
+
+	bad = [(lba, _libcrypt(lba)[ : Q_DATA_SIZE]) for lba in sorted(pair + [lone] + early + late)]
+	bad += [(lba, b'\xff' * Q_DATA_SIZE) for lba in garbage]
+	bad.sort()
+	libcrypt, errors = subchannel.split_bad_q(bad)
+	assert [lba for lba, q in libcrypt] == pair
+	assert errors == sorted(early + [lone] + garbage + late)
+
+
+def test_sbi_entries():
+	lba = LIBCRYPT_FIRST
+	q = _libcrypt(lba)[ : Q_DATA_SIZE]
+	# 03:00:00 absolute, with the 2 second pregap
+	assert subchannel.format_sbi([(lba, q)]) == SBI_MAGIC + b'\x03\x00\x00\x01' + q
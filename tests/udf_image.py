@@ -0,0 +1,145 @@
+# Makes up UDF images to test and benchmark read_udf with, where there is
+# no real image. See ECMA-167 for the descriptors.
+
+import struct
+import binascii
+
+SECTOR_SIZE = 2048
+HEADER_SIZE = 1024 * 32
+ANCHOR_SECTOR = 256
+MAIN_VDS = 32
+RESERVE_VDS = 48
+
+# Tag identifiers
+PRIMARY_VOLUME_DESCRIPTOR = 1
+ANCHOR_VOLUME_DESCRIPTOR_POINTER = 2
+PARTITION_DESCRIPTOR = 5
+LOGICAL_VOLUME_DESCRIPTOR = 6
+TERMINATING_DESCRIPTOR = 8
+FILE_SET_DESCRIPTOR = 256
+FILE_IDENTIFIER_DESCRIPTOR = 257
+FILE_ENTRY = 261
+
+# File characteristics, file types and allocation types
+DIRECTORY = 0x02
+PARENT = 0x08
+FILE_TYPE_DIRECTORY = 4
+FILE_TYPE_BYTES = 5
+SHORT_DESCRIPTORS = 0
+EMBEDDED = 3
+
+
+def round_up(value, unit):
+	return ((value + (unit - 1)) // unit) * unit
+
+
+# A descriptor with its tag in front, checksum and CRC filled in
+def make_descriptor(tag_identifier, location, body):
+	tag = struct.pack('<HHBBHHHI', tag_identifier, 2, 0, 0, 1, binascii.crc_hqx(body, 0), len(body), location)
+	checksum = sum(bytearray(tag)) & 0xFF
+	return tag[ : 4] + struct.pack('B', checksum) + tag[5 : ] + body
+
+
+# A File Identifier Descriptor for a name, in 8 or 16 bit characters. The
+# parent directory's has no name.
+def make_fid(name, alg, location, icb = 0, characteristics = 0):
+	if characteristics & PARENT:
+		identifier = b""
+	elif alg == 8:
+		identifier = b"\x08" + name.encode('latin-1')
+	else:
+		identifier = b"\x10" + name.encode('utf-16-be')
+	long_ad = struct.pack('<IIH6x', SECTOR_SIZE, icb, 0)
+	body = struct.pack('<HBB', 1, characteristics, len(identifier)) + long_ad + struct.pack('<H', 0) + identifier
+	body += b"\0" * (round_up(16 + len(body), 4) - 16 - len(body))
+	return make_descriptor(FILE_IDENTIFIER_DESCRIPTOR, location, body)
+
+
+# A File Entry whose allocation descriptors, or embedded data, are ads
+def make_file_entry(location, file_type, alloc_type, length, ads):
+	body = bytearray(160)
+	struct.pack_into('<IHHHBB', body, 0, 0, 4, 0, 1, 0, file_type)
+	struct.pack_into('<H', body, 18, alloc_type)
+	struct.pack_into('<IIIH', body, 20, 0xFFFFFFFF, 0xFFFFFFFF, 0x1084, 1)
+	struct.pack_into('<QQ', body, 40, length, (length + SECTOR_SIZE - 1) // SECTOR_SIZE)
+	struct.pack_into('<QII', body, 144, location, 0, len(ads))
+	return make_descriptor(FILE_ENTRY, location, bytes(body) + ads)
+
+
+def make_entity(identifier):
+	return b"\0" + identifier.ljust(23, b"\0") + b"\0" * 8
+
+
+# A UDF image of a tree of {name : bytes or {...}}, with 2048 byte sectors,
+# a main and a reserve Volume Descriptor Sequence, anchors at sector 256
+# and at the end, and the data of each file embedded in its File Entry
+def make_image(tree):
+	blocks = {}
+	next_block = [1]
+
+	def alloc(count = 1):
+		block = next_block[0]
+		next_block[0] += count
+		return block
+
+	def add_directory(tree, block, parent):
+		fids = make_fid(u"", 8, block, parent, PARENT | DIRECTORY)
+		for name in sorted(tree):
+			child = alloc()
+			if isinstance(tree[name], dict):
+				add_directory(tree[name], child, block)
+				fids += make_fid(name, 8, block, child, DIRECTORY)
+			else:
+				data = tree[name]
+				blocks[child] = make_file_entry(child, FILE_TYPE_BYTES, EMBEDDED, len(data), data)
+				fids += make_fid(name, 8, block, child)
+		data_block = alloc((len(fids) + SECTOR_SIZE - 1) // SECTOR_SIZE)
+		blocks[data_block] = fids
+		blocks[block] = make_file_entry(block, FILE_TYPE_DIRECTORY, SHORT_DESCRIPTORS, len(fids),
+			struct.pack('<II', len(fids), data_block))
+
+	root = alloc()
+	add_directory(tree, root, root)
+
+	fsd = bytearray(496)
+	struct.pack_into('<HHIIII', fsd, 12, 3, 3, 1, 1, 0, 0)
+	fsd[384 : 400] = struct.pack('<IIH6x', SECTOR_SIZE, root, 0)
+	fsd[400 : 432] = make_entity(b"*OSTA UDF Compliant")
+	blocks[0] = make_descriptor(FILE_SET_DESCRIPTOR, 0, bytes(fsd))
+
+	partition_start = ANCHOR_SECTOR + 1
+	partition_length = next_block[0] + max([(len(data) - 1) // SECTOR_SIZE for data in blocks.values()])
+	total = partition_start + partition_length + 1
+	image = bytearray(total * SECTOR_SIZE)
+
+	def put(sector, data):
+		image[sector * SECTOR_SIZE : sector * SECTOR_SIZE + len(data)] = data
+
+	for i, identifier in enumerate([b"BEA01", b"NSR02", b"TEA01"]):
+		put(HEADER_SIZE // SECTOR_SIZE + i, b"\0" + identifier + b"\x01")
+
+	for start in [MAIN_VDS, RESERVE_VDS]:
+		pvd = bytearray(496)
+		struct.pack_into('<HHHHII', pvd, 40, 1, 1, 2, 2, 1, 1)
+		put(start, make_descriptor(PRIMARY_VOLUME_DESCRIPTOR, start, bytes(pvd)))
+		pd = bytearray(496)
+		struct.pack_into('<IHH', pd, 0, 2, 1, 0)
+		pd[8 : 40] = make_entity(b"+NSR02")
+		struct.pack_into('<III', pd, 168, 1, partition_start, partition_length)
+		put(start + 1, make_descriptor(PARTITION_DESCRIPTOR, start + 1, bytes(pd)))
+		lvd = bytearray(430)
+		struct.pack_into('<I', lvd, 196, SECTOR_SIZE)
+		lvd[200 : 232] = make_entity(b"*OSTA UDF Compliant")
+		lvd[232 : 248] = struct.pack('<IIH6x', SECTOR_SIZE, 0, 0)
+		struct.pack_into('<II', lvd, 248, 6, 1)
+		struct.pack_into('<BBHH', lvd, 424, 1, 6, 1, 0)
+		put(start + 2, make_descriptor(LOGICAL_VOLUME_DESCRIPTOR, start + 2, bytes(lvd)))
+		put(start + 3, make_descriptor(TERMINATING_DESCRIPTOR, start + 3, b"\0" * 496))
+
+	for sector in [ANCHOR_SECTOR, total - 1]:
+		avdp = struct.pack('<IIII', 4 * SECTOR_SIZE, MAIN_VDS, 4 * SECTOR_SIZE, RESERVE_VDS) + b"\0" * 480
+		put(sector, make_descriptor(ANCHOR_VOLUME_DESCRIPTOR_POINTER, sector, avdp))
+
+	for block, data in blocks.items():
+		put(partition_start + block, data)
+	return bytes(image)
@@ -0,0 +1,343 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Helpers for the .toc files written by "cdrdao read-cd", and the .cue
+# files toc2cue makes from them
+
+import os
+import re
+
+RAW_SECTOR_SIZE = 2352
+SUBCHANNEL_SIZE = 96
+SUBCHANNEL_SECTOR_SIZE = RAW_SECTOR_SIZE + SUBCHANNEL_SIZE
+
+FRAMES_PER_SECOND = 75
+SAMPLES_PER_SECTOR = 588
+
+# Sub-channel modes cdrdao can put after the track mode
+SUBCHANNEL_MODES = ['RW', 'RW_RAW']
+
+# Bytes per sector stored in the data file for each track mode
+TOC_SECTOR_SIZES = {
+	'AUDIO' : 2352,
+	'MODE0' : 2336,
+	'MODE1' : 2048,
+	'MODE1_RAW' : 2352,
+	'MODE2' : 2336,
+	'MODE2_FORM1' : 2048,
+	'MODE2_FORM2' : 2324,
+	'MODE2_FORM_MIX' : 2336,
+	'MODE2_RAW' : 2352,
+}
+
+CUE_SECTOR_SIZES = {
+	'AUDIO' : 2352,
+	'CDG' : 2448,
+	'MODE1/2048' : 2048,
+	'MODE1/2352' : 2352,
+	'MODE2/2048' : 2048,
+	'MODE2/2324' : 2324,
+	'MODE2/2336' : 2336,
+	'MODE2/2352' : 2352,
+	'CDI/2336' : 2336,
+	'CDI/2352' : 2352,
+}
+
+TRACK_LINE = re.compile(r'^(\s*TRACK\s+\S+)\s+(RW_RAW|RW)\b(.*)$')
+FILE_LINE = re.compile(r'^(\s*(?:DATAFILE|FILE|AUDIOFILE)\s+)"([^"]*)"(.*)$')
+OFFSET = re.compile(r'#(\d+)')
+LENGTH_COMMENT = re.compile(r'(//\s*length in bytes:\s*)(\d+)')
+
+
+def _rescale(count, old_sector_size, new_sector_size):
+	if count % old_sector_size != 0:
+		raise Exception("Byte count {0} is not a multiple of the {1} byte sector size".format(count, old_sector_size))
+	return count // old_sector_size * new_sector_size
+
+
+# Get the data files a toc refers to, in the order they first show up
+def get_data_files(toc_text):
+	files = []
+	for line in toc_text.splitlines():
+		m = FILE_LINE.match(line)
+		if m and m.group(2) not in files:
+			files.append(m.group(2))
+	return files
+
+
+# Rewrite a toc from a "--read-subchan rw_raw" rip so it describes the same
+# disc without sub-channel data, like a plain "--read-raw" rip would.
+# data_files maps the old data file names to the new ones.
+def strip_subchannel_toc(toc_text, data_files):
+	lines = []
+	for line in toc_text.splitlines(True):
+		newline = line[len(line.rstrip('\r\n')) : ]
+		line = line[ : len(line) - len(newline)]
+
+		m = TRACK_LINE.match(line)
+		if m:
+			line = m.group(1) + m.group(3)
+
+		m = FILE_LINE.match(line)
+		if m:
+			rest = m.group(3)
+			rest = OFFSET.sub(lambda o: '#{0}'.format(_rescale(int(o.group(1)), SUBCHANNEL_SECTOR_SIZE, RAW_SECTOR_SIZE)), rest)
+			rest = LENGTH_COMMENT.sub(lambda o: o.group(1) + str(_rescale(int(o.group(2)), SUBCHANNEL_SECTOR_SIZE, RAW_SECTOR_SIZE)), rest)
+			line = '{0}"{1}"{2}'.format(m.group(1), data_files.get(m.group(2), m.group(2)), rest)
+
+		lines.append(line + newline)
+
+	return ''.join(lines)
+
+
+# Data file names in a toc are relative to where cdrdao was run, which
+# for our scripts is always an absolute path
+def resolve_data_file(toc_name, data_file):
+	if os.path.isabs(data_file):
+		return data_file
+	return os.path.join(os.path.dirname(toc_name), data_file)
+
+
+def msf_to_frames(msf):
+	minutes, seconds, frames = [int(n) for n in msf.split(':')]
+	return (minutes * 60 + seconds) * FRAMES_PER_SECOND + frames
+
+
+def frames_to_msf(frames):
+	minutes, frames = divmod(frames, 60 * FRAMES_PER_SECOND)
+	seconds, frames = divmod(frames, FRAMES_PER_SECOND)
+	return '{0:02d}:{1:02d}:{2:02d}'.format(minutes, seconds, frames)
+
+
+# A run of sectors on the disc. data_file is None for sectors that are not
+# in any file (SILENCE/ZERO in a toc, PREGAP in a cue).
+class Segment(object):
+	def __init__(self, start, length, data_file, file_offset, sector_size, big_endian = False):
+		self.start = start
+		self.length = length
+		self.data_file = data_file
+		self.file_offset = file_offset
+		self.sector_size = sector_size
+		self.big_endian = big_endian
+
+	def get_end(self):
+		return self.start + self.length
+	end = property(get_end)
+
+
+class Track(object):
+	def __init__(self, number, mode, start):
+		self.number = number
+		self.mode = mode
+		self.sub_channel = None
+		self.start = start
+		self.pregap = 0
+		self.segments = []
+
+	def get_is_audio(self):
+		return self.mode == 'AUDIO'
+	is_audio = property(get_is_audio)
+
+	def get_length(self):
+		return sum([s.length for s in self.segments])
+	length = property(get_length)
+
+	def get_end(self):
+		return self.start + self.length
+	end = property(get_end)
+
+	# Where INDEX 01 is, ie where the track really starts playing
+	def get_index1(self):
+		return self.start + self.pregap
+	index1 = property(get_index1)
+
+	def add_segment(self, length, data_file = None, file_offset = 0, sector_size = RAW_SECTOR_SIZE, big_endian = False):
+		segment = Segment(self.end, length, data_file, file_offset, sector_size, big_endian)
+		self.segments.append(segment)
+		return segment
+
+
+class Disc(object):
+	def __init__(self, tracks, disc_type = None):
+		self.tracks = tracks
+		self.disc_type = disc_type
+
+	def get_audio_tracks(self):
+		return [t for t in self.tracks if t.is_audio]
+	audio_tracks = property(get_audio_tracks)
+
+	# Sector ranges as a CD player (and cdparanoia -B) sees the tracks:
+	# from INDEX 01 to the next track's INDEX 01
+	def play_range(self, track):
+		i = self.tracks.index(track)
+		if i + 1 < len(self.tracks):
+			return track.index1, self.tracks[i + 1].index1
+		return track.index1, track.end
+
+	# The segments covering sectors start to end, clipped to that range
+	def segments_between(self, start, end):
+		retval = []
+		for track in self.tracks:
+			for segment in track.segments:
+				if segment.end <= start or segment.start >= end:
+					continue
+				skip = max(start - segment.start, 0)
+				length = min(segment.end, end) - segment.start - skip
+				offset = segment.file_offset + skip * segment.sector_size
+				retval.append(Segment(segment.start + skip, length, segment.data_file, offset, segment.sector_size, segment.big_endian))
+		return retval
+
+
+def _strip_comment(line):
+	in_quote = False
+	for i in range(len(line)):
+		if line[i] == '"':
+			in_quote = not in_quote
+		elif not in_quote and line[i : i + 2] == '//':
+			return line[ : i]
+	return line
+
+
+def _to_sectors(value, sector_size, is_audio):
+	if ':' in value:
+		return msf_to_frames(value)
+	# Plain numbers are samples for audio, and bytes for data
+	if is_audio:
+		return int(value) // SAMPLES_PER_SECTOR
+	return int(value) // sector_size
+
+
+def parse_toc(toc_name):
+	with open(toc_name, 'r') as f:
+		lines = f.read().splitlines()
+
+	tracks = []
+	disc_type = None
+	track = None
+	file_ends = {}
+	depth = 0
+
+	for line in lines:
+		line = _strip_comment(line).strip()
+		if not line:
+			continue
+
+		# Skip CD_TEXT blocks
+		depth += line.count('{') - line.count('}')
+		if depth > 0 or '}' in line:
+			continue
+
+		words = line.split()
+		keyword = words[0]
+
+		if keyword in ['CD_DA', 'CD_ROM', 'CD_ROM_XA', 'CD_I']:
+			disc_type = keyword
+		elif keyword == 'TRACK':
+			start = track.end if track else 0
+			track = Track(len(tracks) + 1, words[1], start)
+			if len(words) > 2 and words[2] in SUBCHANNEL_MODES:
+				track.sub_channel = words[2]
+			tracks.append(track)
+		elif keyword in ['SILENCE', 'ZERO']:
+			length = [w for w in words[1 : ] if w[0].isdigit()]
+			track.add_segment(_to_sectors(length[-1], RAW_SECTOR_SIZE, track.is_audio))
+		elif keyword == 'START':
+			if len(words) > 1:
+				track.pregap = _to_sectors(words[1], RAW_SECTOR_SIZE, track.is_audio)
+			else:
+				track.pregap = track.length
+		elif keyword in ['DATAFILE', 'FILE', 'AUDIOFILE']:
+			m = FILE_LINE.match(line)
+			data_file = resolve_data_file(toc_name, m.group(2))
+			sector_size = TOC_SECTOR_SIZES[track.mode]
+			if track.sub_channel:
+				sector_size += SUBCHANNEL_SIZE
+
+			args = m.group(3).split()
+			swap = 'SWAP' in args
+			args = [a for a in args if a != 'SWAP']
+
+			offset = file_ends.get(data_file, 0)
+			if args and args[0].startswith('#'):
+				offset = int(args.pop(0)[1 : ])
+
+			# Audio files take a start time before the length
+			if keyword != 'DATAFILE' and args:
+				offset += _to_sectors(args.pop(0), sector_size, track.is_audio) * sector_size
+
+			if args:
+				length = _to_sectors(args[0], sector_size, track.is_audio)
+			else:
+				length = (os.path.getsize(data_file) - offset) // sector_size
+
+			# cdrdao stores audio samples big endian, unless told to swap them
+			track.add_segment(length, data_file, offset, sector_size, track.is_audio and not swap)
+			file_ends[data_file] = offset + length * sector_size
+
+	return Disc(tracks, disc_type)
+
+
+def parse_cue(cue_name):
+	with open(cue_name, 'r') as f:
+		lines = f.read().splitlines()
+
+	tracks = []
+	data_file = None
+	big_endian = False
+	file_start = 0
+	track = None
+	indexes = []
+
+	# Index positions are relative to the start of the FILE, so collect
+	# them all first and work out the lengths at the end
+	for line in lines:
+		words = line.strip().split()
+		if not words:
+			continue
+
+		keyword = words[0].upper()
+		if keyword == 'FILE':
+			m = re.match(r'^\s*FILE\s+"([^"]*)"\s+(\S+)', line, re.IGNORECASE)
+			if m:
+				name, file_type = m.group(1), m.group(2)
+			else:
+				name, file_type = words[1], words[-1]
+			data_file = resolve_data_file(cue_name, name)
+			big_endian = file_type.upper() == 'MOTOROLA'
+		elif keyword == 'TRACK':
+			track = Track(int(words[1]), words[2].upper(), 0)
+			tracks.append(track)
+			indexes.append({'file' : data_file, 'big_endian' : big_endian, 'pregap' : 0, 'index' : {}})
+		elif keyword == 'PREGAP':
+			indexes[-1]['pregap'] = msf_to_frames(words[1])
+		elif keyword == 'INDEX':
+			indexes[-1]['index'][int(words[1])] = msf_to_frames(words[2])
+
+	start = 0
+	for i in range(len(tracks)):
+		track, info = tracks[i], indexes[i]
+		sector_size = CUE_SECTOR_SIZES[track.mode]
+		index1 = info['index'][1]
+		first = info['index'].get(0, index1)
+
+		# The track runs until the next track in the same file starts
+		if i + 1 < len(tracks) and indexes[i + 1]['file'] == info['file']:
+			next_info = indexes[i + 1]['index']
+			last = next_info.get(0, next_info[1])
+		else:
+			last = os.path.getsize(info['file']) // sector_size
+
+		track.start = start
+		if info['pregap']:
+			track.add_segment(info['pregap'])
+		track.add_segment(last - first, info['file'], first * sector_size, sector_size, track.is_audio and info['big_endian'])
+		track.pregap = info['pregap'] + index1 - first
+		start = track.end
+
+	return Disc(tracks)
+
+
+def parse_disc(name):
+	if name.lower().endswith('.cue'):
+		return parse_cue(name)
+	return parse_toc(name)